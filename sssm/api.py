@@ -1,16 +1,30 @@
 from __future__ import absolute_import, division, print_function
 
+import codecs
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from datetime import timedelta
+import json
+import logging
+import os
 import random
+import threading
 import time
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 from tornado import gen
 from tornado import gen
 import tornado.httpserver
 import tornado.ioloop
 import tornado.options
 import tornado.web
+import tornado.websocket
 from tornado.options import define, options
 import uuid
 
@@ -22,19 +36,460 @@ from sssm.backend import (
     Trader, 
     Transaction, 
     Shares_Trading,
-    Platform
+    Platform,
+    ShardedPlatform,
+    Journal
 )
 
 define("port", default=8888, help="run on the given port", type=int)
+define("simulate_traders", default=100, help="number of traders to simulate", type=int)
+define("simulate_trades", default=1800, help="number of trades to simulate", type=int)
+define("simulate_duration", default=30, help="mins of trading to simulate", type=float)
+define("simulate_symbols", default=5, help="number of stocks to simulate trading for", type=int)
+define("simulate_seed", default=None, help="random seed of simulated trades", type=int)
+define("journal", default=None, 
+       help="journal file - store is rebuilt from it on start and changes are recorded to it", type=str)
+define("journal_sync_every", default=1000, help="journal records committed at once", type=int)
+define("journal_sync_interval", default=0.05, help="secs journal records are committed within", type=float)
+define("snapshot", default=None, 
+       help="snapshot directory - store is loaded from it on start (replaying journal after it) "
+            "and saved to it periodically", type=str)
+define("snapshot_interval", default=300, help="secs between snapshots", type=float)
+define("retention", default=None, 
+       help="mins trades are kept for - older ones are compacted into per stock bars", type=float)
+define("retention_bucket", default=60, help="secs of trading each bar of compacted trades spans",
+       type=float)
+define("retention_bar_horizon", default=None, 
+       help="mins bars are kept for - older ones are merged into coarser bars", type=float)
+define("retention_bar_bucket", default=3600, help="secs of trading each coarser bar spans",
+       type=float)
+define("shards", default=1, 
+       help="worker processes stocks are partitioned across - journal and snapshot "
+            "are only supported unsharded", type=int)
+define("workers", default=4, help="threads computing analytics off the IOLoop", type=int)
+define("max_pending", default=64, 
+       help="analytics requests queued or running before further ones are rejected (503)", type=int)
+define("cache_size", default=1024, help="responses cached", type=int)
+define("cache_bucket", default=1.0, 
+       help="secs time dependent responses (volume weighted stock price) are cached for", type=float)
+define("trade_batch_size", default=1000, help="trades posted applied to platform at once", type=int)
+define("trade_workers", default=4, help="threads applying trades posted off the IOLoop", type=int)
+define("sequenced", default=False, 
+       help="apply trades posted in order on a single writer thread", type=bool)
+define("sequencer_max_pending", default=100000, help="trades queued in sequenced mode", type=int)
+define("sequencer_batch_size", default=1000, 
+       help="most trades applied at once in sequenced mode", type=int)
+define("feed_tick", default=1.0, help="secs between market data updates pushed to feed subscribers",
+       type=float)
+define("feed_max_stalled", default=10, 
+       help="ticks a feed subscriber may fall behind before being disconnected", type=int)
+define("transactions_page_size", default=10000, 
+       help="transactions sent per page of transaction history by default", type=int)
+define("transactions_chunk_size", default=1000, 
+       help="transactions read from store and sent at once while streaming a page", type=int)
+define("max_trade_body", default=256 * 1024 * 1024, help="max size (bytes) of trades posted", type=int)
 
-class Application(tornado.web.Application):
+class AnalyticsExecutor(object):
+    """ Bounded executor running analytics (VWSP, index) off the IOLoop.
+    
+        At most ``max_pending`` computations are queued or running at once;
+        requests beyond that are rejected with ``503 Service Unavailable``
+        rather than queueing without bound.
+        
+    """
+    
+    def __init__(self, workers=4, max_pending=64):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._max_pending = max_pending
+        self._pending = 0
+        
+    @property
+    def pending(self):
+        return self._pending
+    
+    @contextmanager
+    def reserve(self):
+        """ Hold a pending slot while in context - e.g. for all computations
+            of a streamed response, which can't be rejected once started.
+            Called from IOLoop.
+            
+        """
+        
+        if self._pending >= self._max_pending:
+            raise tornado.web.HTTPError(503, "API: Too many analytics requests in progress.")
+        
+        self._pending += 1
+        
+        try:
+            yield
+        finally:
+            self._pending -= 1
+            
+    def submit(self, func, *args, **kwargs):
+        """ Run ``func(*args, **kwargs)`` on executor - never rejected, so
+            within a ``reserve``'d slot.
+            
+        """
+        
+        return self._executor.submit(func, *args, **kwargs)
+    
+    @gen.coroutine
+    def run(self, func, *args, **kwargs):
+        """ Run ``func(*args, **kwargs)`` on executor - called from IOLoop. """
+        
+        with self.reserve():
+            result = yield self.submit(func, *args, **kwargs)
+            
+        raise gen.Return(result)
+        
+class ResponseCache(object):
+    """ Size bounded LRU cache of responses keyed on (request URI, store
+        version) - and time bucket, for time dependent responses.
+        
+        Time dependent responses (volume weighted stock price windows end
+        now) are only reused within the same ``bucket`` seconds.
+        
+    """
+    
+    def __init__(self, size=1024, bucket=1.0):
+        self._size = size
+        self._bucket = bucket
+        self._responses = OrderedDict()
+        
+        # distinguishes ETags of restarted service
+        self._epoch = uuid.uuid4().hex[:8]
+        
+    def __len__(self):
+        return len(self._responses)
+        
+    def key(self, uri, version, time_dependent=False):
+        if not time_dependent:
+            return (uri, version, None)
+        
+        bucket = int(time.time() // self._bucket) if self._bucket > 0 else 0
+        
+        return (uri, version, bucket)
+    
+    def etag(self, key):
+        if key[2] is None:
+            return '"{}-{}"'.format(self._epoch, key[1])
+        
+        return '"{}-{}-{}"'.format(self._epoch, key[1], key[2])
+    
+    def get(self, key):
+        response = self._responses.pop(key, None)
+        
+        if response is not None:
+            self._responses[key] = response
+            
+        return response
+    
+    def put(self, key, response):
+        self._responses[key] = response
+        
+        while len(self._responses) > self._size:
+            self._responses.popitem(last=False)
+    
+class FeedSubscription(object):
+    """ A subscriber's view of the market data feed - updates of stocks
+        ``symbols`` (all if None) sent through ``send``, which returns a
+        future resolved once the message is written out.
+        
+        While a previous message is still being written, updates are merged
+        into one pending update - the latest values of each stock - sent
+        on a later tick once the subscriber catches up. A subscriber
+        falling ``max_stalled`` ticks behind is disconnected through
+        ``close``.
+        
+    """
+    
+    def __init__(self, send, close, symbols=None, max_stalled=10):
+        self._send = send
+        self._close = close
+        self._max_stalled = max_stalled
+        self._sending = None
+        self._pending = None
+        self._stalled = 0
+        
+        self.symbols = frozenset(symbols) if symbols is not None else None
+        
+    @property
+    def stalled(self):
+        return self._stalled
+    
+    def view(self, update):
+        """ Part of ``update`` subscribed to - None if nothing. """
+        
+        stocks = update["stocks"]
+        
+        if self.symbols is not None:
+            stocks = dict((symbol, values) for symbol, values in stocks.items() \
+                          if symbol in self.symbols)
+        
+        if not stocks and "all_share_index" not in update:
+            return None
+        
+        view = dict(update)
+        view["stocks"] = stocks
+        
+        return view
+        
+    def push(self, update=None, messages=None):
+        """ Send ``update`` - merged into pending one if any - or keep it
+            pending while subscriber is behind. ``messages`` caches the
+            serialised views of ``update`` by subscription, shared by all
+            subscribers of a tick.
+            
+        Returns
+        -------
+        subscribed : bool
+            False if subscriber was disconnected.
+            
+        """
+        
+        writable = self._sending is None or self._sending.done()
+        
+        if writable and self._pending is None:
+            if update is None:
+                return True
+            
+            messages = messages if messages is not None else {}
+            
+            if self.symbols not in messages:
+                view = self.view(update)
+                messages[self.symbols] = json.dumps(view) if view is not None else None
+            
+            return self._write(messages[self.symbols])
+        
+        if update is not None:
+            self._merge(self.view(update))
+        
+        if self._pending is None:
+            return True
+        
+        if not writable:
+            self._stalled += 1
+            
+            if self._stalled >= self._max_stalled:
+                self._close()
+                return False
+            
+            return True
+        
+        message, self._pending = json.dumps(self._pending), None
+        
+        return self._write(message)
+    
+    def _merge(self, view):
+        if view is None:
+            return
+        
+        if self._pending is None:
+            self._pending = dict(view)
+            self._pending["stocks"] = dict(view["stocks"])
+            return
+        
+        stocks = self._pending["stocks"]
+        stocks.update(view["stocks"])
+        
+        self._pending.update(view)
+        self._pending["stocks"] = stocks
+        
+    def _write(self, message):
+        if message is None:
+            return True
+        
+        try:
+            self._sending = self._send(message)
+        except tornado.websocket.WebSocketClosedError:
+            return False
+        
+        self._stalled = 0
+        
+        return True
+    
+class MarketFeed(object):
+    """ Market data pushed to feed subscribers.
+    
+        Every ``tick`` secs, if any trade or price change occurred, a single
+        update - price and volume weighted stock price of each stock, and the
+        all share index - is computed on ``executor``, and what changed is
+        pushed to every subscriber, however many. Subscribers of the same
+        stocks share one serialised message. See ``FeedSubscription`` for
+        coalescing and backpressure.
+        
+    """
+    
+    def __init__(self, executor, tick=1.0):
+        self._executor = executor
+        self._tick = tick
+        self._subscriptions = set()
+        self._callback = None
+        self._computing = False
+        self._version = None
+        self._stocks = {}
+        self._index = None
+        
+        # metrics
+        self.updates = 0
+        
+    def __len__(self):
+        return len(self._subscriptions)
+        
+    def snapshot(self):
+        """ Last update of all values. """
+        
+        return {"all_share_index": self._index, "stocks": dict(self._stocks)}
+    
+    def subscribe(self, subscription):
+        self._subscriptions.add(subscription)
+        
+        if self._callback is None:
+            self._callback = tornado.ioloop.PeriodicCallback(self.tick, self._tick * 1000)
+            self._callback.start()
+            
+    def unsubscribe(self, subscription):
+        self._subscriptions.discard(subscription)
+        
+    def stop(self):
+        if self._callback is not None:
+            self._callback.stop()
+            self._callback = None
+    
+    @gen.coroutine
+    def refresh(self):
+        """ Compute values of platform if changed since last computed.
+        
+        Returns
+        -------
+        update : dict
+            values changed - ``all_share_index`` only if it did - or None.
+            
+        """
+        
+        version = p.version
+        
+        if self._computing or version == self._version:
+            raise gen.Return(None)
+        
+        self._computing = True
+        
+        try:
+            index, prices, vwsps = yield self._executor.run(market_data)
+        finally:
+            self._computing = False
+        
+        self._version = version
+        self.updates += 1
+        
+        index = None if index != index else index
+        stocks = {}
+        
+        for symbol in set(prices) | set(vwsps):
+            values = {"price": prices.get(symbol), 
+                      "volume_weighted_stock_price": vwsps.get(symbol)}
+            
+            if self._stocks.get(symbol) != values:
+                stocks[symbol] = self._stocks[symbol] = values
+                
+        update = {"time": datetime.now().isoformat(), "stocks": stocks}
+        
+        if index != self._index:
+            update["all_share_index"] = self._index = index
+            
+        raise gen.Return(update if stocks or "all_share_index" in update else None)
+    
+    @gen.coroutine
+    def tick(self):
+        if not self._subscriptions:
+            return
+        
+        try:
+            update = yield self.refresh()
+        except tornado.web.HTTPError:
+            # analytics busy - next tick
+            update = None
+            
+        messages = {}
+        
+        for subscription in list(self._subscriptions):
+            if not subscription.push(update, messages):
+                self.unsubscribe(subscription)
+                
+def is_trading(symbol):
+    return p.is_trading(symbol)
+
+class TradeStreamParser(object):
+    """ Incremental parser of trades posted as a single JSON object, a JSON
+        array of objects or newline delimited JSON objects.
+        
+        Chunks of body are fed as received; complete trades are returned as
+        soon as they are parsed, and incomplete trailing data is kept for the
+        next chunk.
+        
+    Examples
+    --------
+    >>> parser = TradeStreamParser()
+    >>> parser.feed(b'[{"symbol": "TEA"}, {"sym')
+    [{'symbol': 'TEA'}]
+    >>> parser.feed(b'bol": "GIN"}]')
+    [{'symbol': 'GIN'}]
+    >>> parser.close()
+    
+    """
+    
+    SEPARATORS = " \t\r\n,[]"
+    
     def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = u""
+        
+    def feed(self, chunk):
+        """ Parse ``chunk`` of body - returning trades completed by it. """
+        
+        buffer = self._buffer + self._text.decode(chunk)
+        trades = []
+        pos = 0
+        
+        while True:
+            while pos < len(buffer) and buffer[pos] in self.SEPARATORS:
+                pos += 1
+                
+            if pos == len(buffer):
+                break
+            
+            try:
+                trade, pos = self._decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # incomplete - wait for more of body
+                break
+            
+            trades.append(trade)
+            
+        self._buffer = buffer[pos:]
+        
+        return trades
+    
+    def close(self):
+        """ End of body - fails if any data couldn't be parsed. """
+        
+        if self._buffer.strip(self.SEPARATORS) or self._text.decode(b"", final=True):
+            raise ValueError("API: Malformed trades - can't parse {:.40}".format(self._buffer))
+
+class Application(tornado.web.Application):
+    def __init__(self, sequencer=None, **overrides):
         handlers = [
             (r"/", IndexHandler),
             (r"/stock", StockHandler),
+            (r"/stock/([^/]+)/bars", BarsHandler),
             (r"/stock/([^/]+)", StockHandler),
+            (r"/platform/trade", TradeHandler),
+            (r"/platform/sequencer", SequencerHandler),
             (r"/platform/([^/]+)", PlatformHandler),
             (r"/platform", PlatformHandler),
+            (r"/transactions", TransactionsHandler),
+            (r"/feed", FeedHandler),
             (r"/user", UserHandler),
         ]
         
@@ -43,6 +498,19 @@ class Application(tornado.web.Application):
             xsrf_cookies=True,
             debug=True,
         )
+        settings.update(overrides)
+        
+        self.executor = AnalyticsExecutor(workers=options.workers, 
+                                          max_pending=options.max_pending)
+        self.cache = ResponseCache(size=options.cache_size, bucket=options.cache_bucket)
+        self.feed = MarketFeed(self.executor, tick=options.feed_tick)
+        
+        # batches of trades posted are applied off the IOLoop - trading may wait on locks
+        # held by snapshots or compaction, and on journal syncs
+        self.trade_executor = ThreadPoolExecutor(max_workers=options.trade_workers)
+        
+        # sequenced mode - trades posted are applied through sequencer
+        self.sequencer = sequencer
         
         super(Application, self).__init__(handlers, **settings)
 
@@ -52,60 +520,432 @@ class IndexHandler(tornado.web.RequestHandler):
             Please see README.md for permitted operations. \
             Make sure to restart service every 30 mins as opertions would fail otherwise.")
     
-class StockHandler(tornado.web.RequestHandler):
+class CachedHandler(tornado.web.RequestHandler):
+    """ Handler whose GET responses are cached per store version.
+    
+        Responses are keyed on request URI and ``Store.version`` - and time
+        bucket if ``time_dependent`` - and sent with a matching ETag, so
+        unchanged responses are answered with ``304 Not Modified`` without
+        being computed or sent again. Subclasses compute responses in
+        ``respond``.
+        
+    """
+    
+    def time_dependent(self, *args):
+        """ Whether response changes with time alone - not only with store. """
+        
+        return False
+    
+    @gen.coroutine
+    def get(self, *args):
+        cache = self.application.cache
+        key = cache.key(self.request.uri, p.version, self.time_dependent(*args))
+        
+        self.set_header("Etag", cache.etag(key))
+        
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        
+        body = cache.get(key)
+        
+        if body is None:
+            body = yield self.respond(*args)
+            cache.put(key, body)
+            
+        self.write(body)
+        
+    @gen.coroutine
+    def respond(self, *args):
+        raise NotImplementedError()
+    
+class StockHandler(CachedHandler):
     @gen.coroutine
     def post(self):
         pass
     
-    def get(self, symbol=None):
-        if symbol not in Store().get_shares_trading():
-            self.write("Stock {} is not trading.".format(symbol))
-        else:    
-            s = Store()
-            
-            if self.get_argument("operation", None):
-                operation = self.get_argument("operation", None)
-                
-                if self.get_argument("price", None):
-                    price = self.get_argument("price", None)
-                else:
-                    self.write("Price must be provided for {}".format(operation))
-                 
-                if operation == "dividend":
-                    if s.get_type(symbol) == "Preferred":
-                        self.write(str(PreferredStock(s).dividend_yield(str(symbol), float(price))))
-                    else:
-                        self.write(str(CommonStock(s).dividend_yield(str(symbol), float(price))))
-                elif operation == "peratio":
-                    if s.get_type(symbol) == "Preferred":
-                        self.write(str(PreferredStock(s).pe_ratio(str(symbol), float(price))))
-                    else:
-                        self.write(str(CommonStock(s).pe_ratio(str(symbol), float(price))))
-                else:
-                    self.write("API: Specified operation not supported.")
-                    
-            else:
-                self.write("API: Operation must be provided")
+    @gen.coroutine
+    def respond(self, symbol=None):
+        if not is_trading(symbol):
+            raise gen.Return("Stock {} is not trading.".format(symbol))
+            
+        if not self.get_argument("operation", None):
+            raise gen.Return("API: Operation must be provided")
+            
+        operation = self.get_argument("operation", None)
+        price = self.get_argument("price", None)
+        run = self.application.executor.run
+        
+        if not price:
+            raise gen.Return("Price must be provided for {}".format(operation))
+        elif operation == "dividend":
+            result = yield run(p.compute_dividend_yield, str(symbol), float(price))
+        elif operation == "peratio":
+            result = yield run(p.pe_ratio, str(symbol), float(price))
+        else:
+            raise gen.Return("API: Specified operation not supported.")
+        
+        raise gen.Return(str(result))
                 
-class PlatformHandler(tornado.web.RequestHandler):
+class BarsHandler(CachedHandler):
+    """ OHLCV bars of a stock - ``res`` secs per bar (or e.g. ``1s``, ``5m``,
+        ``1h``), of buckets starting within ISO times [``from``, ``to``).
+        
+    """
+    
+    UNITS = {"s": 1, "m": 60, "h": 3600}
+    
+    @gen.coroutine
+    def respond(self, symbol):
+        if not is_trading(symbol):
+            raise gen.Return("Stock {} is not trading.".format(symbol))
+        
+        try:
+            res = self.get_argument("res", "1m")
+            res = int(res[:-1]) * self.UNITS[res[-1]] if res[-1:] in self.UNITS else int(res)
+            start, end = [self.get_argument(name, None) for name in ("from", "to")]
+            start, end = [parse_timestamp(time) if time else None for time in (start, end)]
+            
+            bars = yield self.application.executor.run(p.bars, symbol, res, start=start, end=end)
+        except ValueError as e:
+            raise gen.Return(str(e))
+        
+        for bar in bars:
+            bar["start"] = bar["start"].isoformat()
+            
+        raise gen.Return({"symbol": symbol, "res": res, "bars": bars})
+    
+class PlatformHandler(CachedHandler):
 
     @gen.coroutine
     def post(self):
         pass
     
-    def get(self, operation=None):
+    def time_dependent(self, operation=None):
+        # volume weighted stock price windows end now
+        return operation != "index"
+    
+    @gen.coroutine
+    def respond(self, operation=None):
+        run = self.application.executor.run
+        result = ""
+        
         if operation:
             if operation == "index":
-                self.write(str(p.all_share_index()))
+                result = yield run(p.all_share_index)
+                result = str(result)
             elif operation == "volume_weighted_stock_price":
-                self.write(str(p.volume_weighted_stock_price()))
+                symbol = self.get_argument("symbol", None)
+                
+                try:
+                    interval = self.get_argument("interval", "15")
+                    
+                    if not interval.isdigit() or int(interval) <= 0:
+                        raise ValueError("API: Interval must be a positive number of mins.")
+                    
+                    interval = int(interval)
+                    
+                    if symbol is None:
+                        result = yield run(p.volume_weighted_stock_price, since=interval)
+                        result = str(result)
+                    elif "," in symbol:
+                        # several stocks are answered together
+                        result = yield run(p.volume_weighted_stock_prices, since=interval, 
+                                           symbols=symbol.split(","))
+                    elif not is_trading(symbol):
+                        result = "Stock {} is not trading.".format(symbol)
+                    else:
+                        result = yield run(p.volume_weighted_stock_price, since=interval, 
+                                           symbol=symbol)
+                        result = str(result)
+                except ValueError as e:
+                    result = str(e)
         else:
-            info = {
-                "all_share_index": p.all_share_index(),
-                "volume_weighted_stock_price": p.volume_weighted_stock_price()
-            }
-            self.write(info)
+            result = yield run(platform_info)
+            
+        raise gen.Return(result)
+            
+@tornado.web.stream_request_body
+class TradeHandler(tornado.web.RequestHandler):
+    """ Trades posted as a single JSON object, a JSON array of objects or
+        newline delimited JSON objects - each object being a trade:
+        ``{"trader", "token", "symbol", "qty", "price", "type", "timestamp"}``
+        (``type`` BUY by default, ISO ``timestamp`` now by default).
+        
+        The body is parsed on the IOLoop as it streams in and trades are
+        applied through ``Platform.trade_many`` in batches of
+        ``--trade_batch_size`` on the application's trade executor - reading
+        the body waits for each batch, so batches apply in order - or, in
+        sequenced mode, submitted to the application's sequencer as they
+        arrive and awaited.
+        
+    """
+    
+    FIELDS = ("trader", "token", "symbol", "qty", "price")
+    
+    def check_xsrf_cookie(self):
+        # trades are authenticated by traders' tokens
+        pass
+    
+    def prepare(self):
+        self.request.connection.set_max_body_size(options.max_trade_body)
+        
+        self._parser = TradeStreamParser()
+        self._batch = []
+        self._results = []
+        self._pending = []
+        self._error = None
+        
+    @gen.coroutine
+    def data_received(self, chunk):
+        if self._error:
+            return
+        
+        try:
+            trades = self._parser.feed(chunk)
+        except ValueError as e:
+            self._error = str(e)
+            return
+        
+        for trade in trades:
+            self._batch.append(trade)
+            
+            if len(self._batch) >= options.trade_batch_size:
+                yield self.apply_batch()
+    
+    @gen.coroutine
+    def apply_batch(self):
+        """ Apply trades received so far as one batch. """
+        
+        batch, self._batch = self._batch, []
+        results = [None] * len(batch)
+        columns = dict((field, []) for field in self.FIELDS + ("type", "timestamp"))
+        rows = []
+        
+        for i, trade in enumerate(batch):
+            try:
+                missing = [field for field in self.FIELDS if field not in trade]
+                
+                if missing:
+                    raise ValueError("API: Trade is missing {}.".format(", ".join(missing)))
+                
+                if any(isinstance(trade[field], (list, dict)) for field in self.FIELDS):
+                    raise ValueError("API: Invalid trade.")
+                
+                timestamp = trade.get("timestamp")
+                timestamp = parse_timestamp(timestamp) if timestamp else datetime.now()
+            except (ValueError, TypeError, AttributeError) as e:
+                results[i] = {"status": str(e) if str(e) else "API: Invalid trade.", "id": None}
+                continue
+                
+            for field in self.FIELDS:
+                columns[field].append(trade[field])
+                
+            columns["type"].append(trade.get("type", "BUY"))
+            columns["timestamp"].append(timestamp)
+            rows.append(i)
+            
+        sequencer = self.application.sequencer
+        
+        if rows and sequencer:
+            trades = zip(*[columns[field] for field in self.FIELDS + ("type", "timestamp")])
+            
+            for i, trade in zip(rows, trades):
+                # awaited once body is received
+                try:
+                    future = sequencer.submit(*trade, block=False)
+                    self._pending.append((len(self._results) + i, future))
+                except queue.Full:
+                    results[i] = {"status": "API: Too many trades pending.", "id": None}
+        elif rows:
+            try:
+                statuses, txn_ids = yield self.application.trade_executor.submit(
+                    p.trade_many, columns["trader"], columns["token"], columns["symbol"],
+                    columns["qty"], columns["price"], trade_types=columns["type"], 
+                    timestamps=columns["timestamp"])
+            except Exception as e:
+                # reported per trade of batch
+                logging.error("API: Failed to apply trades - {}".format(e))
+                statuses = [str(e) or "API: Failed to apply trades."] * len(rows)
+                txn_ids = [None] * len(rows)
             
+            for i, status, txn_id in zip(rows, statuses, txn_ids):
+                results[i] = {"status": status, "id": txn_id}
+                
+        self._results.extend(results)
+        
+    @gen.coroutine
+    def post(self):
+        if not self._error:
+            try:
+                self._parser.close()
+            except ValueError as e:
+                self._error = str(e)
+        
+        if self._batch:
+            yield self.apply_batch()
+            
+        for i, future in self._pending:
+            try:
+                txn_id = yield future
+                self._results[i] = {"status": "OK", "id": txn_id}
+            except ValueError as e:
+                self._results[i] = {"status": str(e), "id": None}
+            except Exception as e:
+                # failed batch of sequencer - reported per trade
+                logging.error("API: Failed to apply trade - {}".format(e))
+                self._results[i] = {"status": str(e) or "API: Failed to apply trade.", "id": None}
+            
+        accepted = sum(1 for result in self._results if result["status"] == "OK")
+        response = {
+            "accepted": accepted,
+            "rejected": len(self._results) - accepted,
+            "results": self._results
+        }
+        
+        if self._error:
+            self.set_status(400)
+            response["error"] = self._error
+            
+        self.write(response)
+            
+class TransactionsHandler(tornado.web.RequestHandler):
+    """ Transaction history - trades within ISO times (``since``, ``until``],
+        of ``symbol`` and ``trader`` if given, in time order - a page of up
+        to ``limit`` trades following ``cursor`` at a time.
+        
+        A page is streamed as ``{"transactions": [...], "cursor": ...}`` in
+        chunks of ``--transactions_chunk_size`` trades, each read from the
+        store off the IOLoop and flushed to the client before the next - so
+        pages of any size are sent in constant memory. ``cursor`` is that of
+        the next page - null after the last.
+        
+    """
+    
+    @gen.coroutine
+    def get(self):
+        try:
+            since, until = [self.get_argument(name, None) for name in ("since", "until")]
+            since, until = [parse_timestamp(time) if time else None for time in (since, until)]
+            limit = int(self.get_argument("limit", options.transactions_page_size))
+            cursor = self.get_argument("cursor", None)
+            cursor = parse_cursor(cursor) if cursor else None
+            
+            if limit <= 0:
+                raise ValueError("API: Limit must be positive.")
+        except ValueError as e:
+            self.set_status(400)
+            self.write({"error": str(e)})
+            return
+        
+        symbol = self.get_argument("symbol", None)
+        trader = self.get_argument("trader", None)
+        executor = self.application.executor
+        remaining = limit
+        chunks = 0
+        
+        # rejected (503) before anything is sent - never once streaming
+        with executor.reserve():
+            while True:
+                records, cursor = yield executor.submit(
+                    p.transactions, since, until, symbol=symbol, trader=trader, cursor=cursor, 
+                    limit=min(remaining, options.transactions_chunk_size))
+                remaining -= len(records)
+                
+                if chunks == 0:
+                    self.set_header("Content-Type", "application/json; charset=UTF-8")
+                    self.write('{"transactions": [')
+                elif records:
+                    self.write(", ")
+                
+                for record in records:
+                    record["ts"] = record["ts"].isoformat()
+                    
+                self.write(", ".join(json.dumps(record) for record in records))
+                chunks += 1
+                
+                if cursor is None or remaining <= 0:
+                    break
+                
+                # sent before next chunk is read
+                yield self.flush()
+                
+        self.write('], "cursor": {}}}'.format(json.dumps(format_cursor(cursor))))
+            
+def parse_cursor(cursor):
+    """ Parse transactions ``cursor`` - ``<epoch timestamp (us)>:<id>``. """
+    
+    ts, sep, txn_id = cursor.partition(":")
+    
+    if not sep:
+        raise ValueError("API: Malformed cursor {:.40}".format(cursor))
+    
+    return int(ts), int(txn_id) if txn_id.lstrip("-").isdigit() else txn_id
+    
+def format_cursor(cursor):
+    return "{}:{}".format(*cursor) if cursor is not None else None
+
+def parse_timestamp(timestamp):
+    """ Parse ISO format ``timestamp`` - with or without microseconds. """
+    
+    fmt = "%Y-%m-%dT%H:%M:%S.%f" if "." in timestamp else "%Y-%m-%dT%H:%M:%S"
+    
+    return datetime.strptime(timestamp, fmt)
+    
+def platform_info():
+    return {
+        "all_share_index": p.all_share_index(),
+        "volume_weighted_stock_price": p.volume_weighted_stock_price(),
+        "volume_weighted_stock_prices": p.volume_weighted_stock_prices()
+    }
+    
+def market_data():
+    return p.all_share_index(), p.stock_prices(), p.volume_weighted_stock_prices()
+    
+class FeedHandler(tornado.websocket.WebSocketHandler):
+    """ WebSocket market data feed - of stocks ``symbols`` (comma separated,
+        all by default). Subscribers receive the last values at once, then
+        updates of what changed at most once per ``--feed_tick`` secs:
+        ``{"time", "all_share_index", "stocks": {symbol: {"price",
+        "volume_weighted_stock_price"}}}``, ``all_share_index`` only if it
+        changed.
+        
+    """
+    
+    def open(self):
+        symbols = self.get_argument("symbols", None)
+        feed = self.application.feed
+        
+        self.subscription = FeedSubscription(self.write_message, self.close_slow,
+                                             symbols=symbols.split(",") if symbols else None,
+                                             max_stalled=options.feed_max_stalled)
+        
+        # updates pushed later are relative to last values
+        snapshot = feed.snapshot()
+        snapshot["time"] = datetime.now().isoformat()
+        
+        feed.subscribe(self.subscription)
+        self.subscription.push(snapshot)
+        
+    def close_slow(self):
+        self.close(1008, "API: Subscriber too slow.")
+        
+    def on_message(self, message):
+        pass
+    
+    def on_close(self):
+        if hasattr(self, "subscription"):
+            self.application.feed.unsubscribe(self.subscription)
+            
+class SequencerHandler(tornado.web.RequestHandler):
+    def get(self):
+        sequencer = self.application.sequencer
+        
+        if not sequencer:
+            raise tornado.web.HTTPError(404, "API: Not in sequenced mode.")
+        
+        self.write(sequencer.metrics())
+    
 class UserHandler(tornado.web.RequestHandler):
     @gen.coroutine
     def set_current_price(self):
@@ -120,13 +960,79 @@ class UserHandler(tornado.web.RequestHandler):
     def dividend_yield(self):
         pass
 
+def save_snapshots(platform, path, interval):
+    """ Save snapshot of ``platform``'s store to ``path`` every ``interval`` secs. """
+    
+    while True:
+        time.sleep(interval)
+        
+        try:
+            platform.save_snapshot(path)
+        except (IOError, OSError) as e:
+            logging.error("API: Failed to save snapshot - {}".format(e))
+
+def compact_transactions(platform, horizon, bucket, bar_horizon, bar_bucket):
+    """ Compact trades of ``platform`` older than ``horizon`` mins every ``bucket`` secs. """
+    
+    while True:
+        time.sleep(bucket)
+        
+        try:
+            platform.compact(horizon, bucket=bucket, bar_horizon=bar_horizon,
+                             bar_bucket=bar_bucket)
+        except Exception as e:
+            logging.error("API: Failed to compact transactions - {}".format(e))
+
 s = Store()
 p = Platform(s)
-p.simulate()
 
 def main():
+    global s, p
+    
     tornado.options.parse_command_line()
-    http_server = tornado.httpserver.HTTPServer(Application())
+    
+    journal = None
+    
+    if options.journal:
+        journal = Journal(options.journal, sync_every=options.journal_sync_every,
+                          sync_interval=options.journal_sync_interval)
+        
+    if options.shards > 1:
+        p = ShardedPlatform(shards=options.shards)
+    elif options.snapshot and os.path.exists(options.snapshot):
+        s = Store.load_snapshot(options.snapshot, journal=journal)
+        p = Platform(s)
+    elif journal:
+        s = Store(journal=journal)
+        p = Platform(s)
+    
+    # trades are only simulated into a new store
+    if options.shards > 1 or len(s['transactions']) == 0:
+        p.simulate(traders=options.simulate_traders, trades=options.simulate_trades,
+                   duration=options.simulate_duration, symbols=options.simulate_symbols,
+                   seed=options.simulate_seed)
+    
+    sequencer = None
+    
+    if options.sequenced:
+        sequencer = p.sequenced(max_pending=options.sequencer_max_pending,
+                                batch_size=options.sequencer_batch_size)
+    
+    if options.snapshot and options.shards <= 1:
+        snapshots = threading.Thread(target=save_snapshots, name="Snapshots",
+                                     args=(p, options.snapshot, options.snapshot_interval))
+        snapshots.daemon = True
+        snapshots.start()
+    
+    if options.retention:
+        retention = threading.Thread(target=compact_transactions, name="Retention",
+                                     args=(p, options.retention, options.retention_bucket,
+                                           options.retention_bar_horizon,
+                                           options.retention_bar_bucket))
+        retention.daemon = True
+        retention.start()
+    
+    http_server = tornado.httpserver.HTTPServer(Application(sequencer=sequencer))
     http_server.listen(options.port)
     tornado.ioloop.IOLoop.current().start()
 
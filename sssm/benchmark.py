@@ -0,0 +1,272 @@
+""" Super Simple Stock Market benchmarks.
+
+Times trading, transactions search, volume weighted stock price, all share 
+index and shares trading lookups - plus end-to-end latency of the API 
+service - at several store sizes. Results are written as JSON.
+
+Example
+-------
+    python benchmark.py --sizes=1e3,1e4,1e5 --symbols=5,100 --output=bench.json
+    python benchmark.py --sizes=1e3,1e5,1e7 --symbols=5,10000
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+from datetime import datetime
+from datetime import timedelta
+import json
+import logging
+import platform as host
+import sys
+import threading
+import time
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+import tornado
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+
+from sssm.backend import Store, Trader, Transaction, Platform
+
+timer = getattr(time, 'perf_counter', time.time)
+
+ENDPOINTS = [
+    "/platform",
+    "/platform/index",
+    "/platform/volume_weighted_stock_price",
+    "/platform/volume_weighted_stock_price?symbol={symbol}",
+    "/stock/{symbol}?operation=dividend&price=12.0",
+]
+
+def summarise(name, times, ops=1, **params):
+    """ Benchmark result record for ``times`` (secs) of ``len(times)`` runs, each 
+        of ``ops`` operations.
+    
+    """
+    
+    times = np.array(times)
+    
+    result = {
+        "benchmark": name,
+        "runs": len(times),
+        "ops_per_run": ops,
+        "mean_s": float(times.mean()),
+        "p50_s": float(np.percentile(times, 50)),
+        "p99_s": float(np.percentile(times, 99)),
+        "ops_per_s": float(ops * len(times) / times.sum()) if times.sum() > 0 else None,
+    }
+    result.update(params)
+    
+    return result
+
+def run(func, repeat):
+    """ Times of ``repeat`` calls of ``func``. """
+    
+    times = []
+    
+    for i in range(repeat):
+        start = timer()
+        func()
+        times.append(timer() - start)
+        
+    return times
+
+def build_market(size, symbols, traders, seed):
+    """ Store and platform holding ``size`` transactions over ``symbols`` stocks
+        traded within the last hour. Stocks are added with enough shares trading
+        for every trade to succeed.
+    
+    """
+    
+    s = Store()
+    p = Platform(s)
+    
+    symbols = ['BM{}'.format(i) for i in range(symbols)]
+    
+    start = timer()
+    recorded = p.simulate(traders=traders, trades=size, duration=60, symbols=symbols, 
+                          seed=seed, sell_ratio=0.0)
+    
+    return s, p, recorded, timer() - start
+
+def bench_store(s, p, repeat, seed):
+    """ Benchmarks of store and platform operations on market ``s``. """
+    
+    rng = np.random.RandomState(seed)
+    
+    now = datetime.now()
+    symbols = [symbol for symbol in sorted(s['stocks']) if symbol.startswith('BM')]
+    symbol = symbols[0]
+    txn_orm = Transaction(None, None, symbol, store=s)
+    
+    results = [
+        summarise("transaction_find_15m", run(lambda: txn_orm.find(now - timedelta(minutes=15)), repeat)),
+        summarise("transaction_find_1m_symbol", 
+                  run(lambda: txn_orm.find(now - timedelta(minutes=1), symbol=symbol), repeat)),
+        summarise("volume_weighted_stock_price", run(lambda: p.volume_weighted_stock_price(), repeat)),
+        summarise("volume_weighted_stock_price_30m", 
+                  run(lambda: p.volume_weighted_stock_price(since=30), repeat)),
+        summarise("volume_weighted_stock_prices", run(lambda: p.volume_weighted_stock_prices(), repeat)),
+        summarise("volume_weighted_stock_prices_30m", 
+                  run(lambda: p.volume_weighted_stock_prices(since=30), repeat)),
+        summarise("all_share_index", run(p.all_share_index, repeat)),
+        summarise("get_shares_trading", run(s.get_shares_trading, repeat)),
+    ]
+    
+    # trading
+    trader = 'benchmark-trader'
+    token = Trader(trader, store=s).save()
+    
+    n = 1000
+    picks = [symbols[i] for i in rng.randint(0, len(symbols), n)]
+    qtys = rng.randint(1, 100, n).tolist()
+    prices = (22.0 + 10 * rng.random_sample(n)).tolist()
+    
+    start = timer()
+    
+    for i in range(n):
+        p.trade(trader, token, picks[i], qtys[i], prices[i], timestamp=datetime.now())
+        
+    results.append(summarise("trade", [timer() - start], ops=n))
+    
+    n = 10000
+    picks = [symbols[i] for i in rng.randint(0, len(symbols), n)]
+    
+    start = timer()
+    p.trade_many([trader] * n, [token] * n, picks, rng.randint(1, 100, n), 
+                 22.0 + 10 * rng.random_sample(n), 
+                 timestamps=[datetime.now()] * n)
+    
+    results.append(summarise("trade_many", [timer() - start], ops=n))
+    
+    return results
+
+def serve(app, started):
+    """ Serve ``app`` on an unused local port from current thread. """
+    
+    try:
+        import asyncio
+        asyncio.set_event_loop(asyncio.new_event_loop())
+    except ImportError:
+        pass
+    
+    sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    
+    loop = tornado.ioloop.IOLoop.current()
+    started.put((loop, sockets[0].getsockname()[1]))
+    loop.start()
+    
+    server.stop()
+
+def bench_http(s, p, repeat):
+    """ End-to-end latency of API service endpoints serving market ``s`` -
+        computing every response (response cache disabled), then answering
+        from the response cache.
+        
+    """
+    
+    import api
+    
+    api.s, api.p = s, p
+    
+    app = api.Application(debug=False)
+    cache = app.cache
+    
+    started = queue.Queue()
+    thread = threading.Thread(target=serve, args=(app, started))
+    thread.daemon = True
+    thread.start()
+    
+    loop, port = started.get()
+    symbol = 'BM0'
+    results = []
+    
+    try:
+        for endpoint in ENDPOINTS:
+            url = "http://127.0.0.1:{}{}".format(port, endpoint.format(symbol=symbol))
+            
+            # nothing kept - every request computed
+            app.cache = api.ResponseCache(size=0)
+            results.append(summarise("http " + endpoint, run(lambda: urlopen(url).read(), repeat),
+                                     cached=False))
+            
+            app.cache = cache
+            urlopen(url).read()
+            results.append(summarise("http cached " + endpoint, 
+                                     run(lambda: urlopen(url).read(), repeat), cached=True))
+    finally:
+        loop.add_callback(loop.stop)
+        thread.join()
+        
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Super Simple Stock Market benchmarks")
+    parser.add_argument("--sizes", default="1e3,1e4,1e5", 
+                        help="comma separated numbers of transactions in store")
+    parser.add_argument("--symbols", default="5,100", 
+                        help="comma separated numbers of stocks trading")
+    parser.add_argument("--traders", type=int, default=100, help="number of traders")
+    parser.add_argument("--repeat", type=int, default=50, help="runs of each benchmark")
+    parser.add_argument("--seed", type=int, default=42, help="random seed")
+    parser.add_argument("--no-http", dest="http", action="store_false", 
+                        help="skip API service benchmarks")
+    parser.add_argument("--output", default="-", help="JSON results file - stdout by default")
+    args = parser.parse_args(argv)
+    
+    logging.getLogger().setLevel(logging.WARNING)
+    
+    report = {
+        "meta": {
+            "created": datetime.now().isoformat(),
+            "python": sys.version.split()[0],
+            "numpy": np.__version__,
+            "tornado": tornado.version,
+            "platform": host.platform(),
+        },
+        "results": []
+    }
+    
+    for size in [int(float(size)) for size in args.sizes.split(",")]:
+        for symbols in [int(float(symbols)) for symbols in args.symbols.split(",")]:
+            s, p, recorded, elapsed = build_market(size, symbols, args.traders, args.seed)
+            
+            params = {"size": recorded, "symbols": symbols}
+            
+            results = [summarise("simulate", [elapsed], ops=size)]
+            results.extend(bench_store(s, p, args.repeat, args.seed))
+            
+            if args.http:
+                results.extend(bench_http(s, p, args.repeat))
+                
+            for result in results:
+                result.update(params)
+                print("{size:>10} {symbols:>6}  {benchmark:<56} p50 {p50_s:.6f}s".format(**result),
+                      file=sys.stderr)
+                
+            report["results"].extend(results)
+            
+    output = json.dumps(report, indent=2, sort_keys=True)
+    
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,8 @@
+from .analytics import RollingVWSP, AllShareIndex, BarBuilder
 from .data_store import Store
-from .models import Stock, CommonStock, PreferredStock, Transaction, Trader, Shares_Trading
+from .models import Stock, CommonStock, PreferredStock, Transaction, Trader, Portfolio, Shares_Trading
 from util import validate_stock
-from .platform import Platform
\ No newline at end of file
+from .journal import Journal
+from .sequencer import Sequencer
+from .platform import Platform
+from .sharding import ShardedPlatform
\ No newline at end of file
@@ -0,0 +1,732 @@
+from __future__ import absolute_import, division, print_function
+
+from collections import defaultdict
+from datetime import datetime
+from datetime import timedelta
+import heapq
+import itertools
+import math
+from threading import RLock
+
+import numpy as np
+
+from sssm.backend.util import synchronized, datetime_to_us, us_to_datetime
+
+class RollingVWSP(object):
+    """ Rolling window volume weighted stock price aggregator.
+    
+        Keeps running sums of ``price * qty`` and ``qty`` - overall and per
+        stock symbol - over trades within the last ``window`` minutes. Trades are fed as they occur and expired
+        once they leave the window, so the price is read in O(1).
+        
+    Examples
+    --------
+    >>> from datetime import datetime
+    >>> from sssm.backend import RollingVWSP
+    >>> vwsp = RollingVWSP(window=15)
+    >>> now = datetime.now()
+    >>> vwsp.add(now, 10.0, 100, symbol='TEA')
+    >>> vwsp.add(now, 20.0, 300, symbol='POP')
+    >>> vwsp.value(now)
+    17.5
+    >>> vwsp.value(now, symbol='TEA')
+    10.0
+    
+    """
+    
+    def __init__(self, window=15):
+        """ Rolling aggregator setup.
+        
+        Parameters
+        ----------
+        window : int
+            window length in mins.
+            
+        """
+        
+        self._window = window
+        self._delta = timedelta(minutes=window)
+        self._trades = []
+        self._seq = itertools.count()
+        self._price_qty = 0.0
+        self._qty = 0
+        self._symbols = defaultdict(lambda: [0.0, 0])
+        self._cutoff = None
+        self._lock = RLock()
+        
+    @property
+    def window(self):
+        return self._window
+        
+    def __len__(self):
+        return len(self._trades)
+        
+    @synchronized
+    def add(self, timestamp, price, qty, symbol=None):
+        """ Account for trade of ``qty`` ``symbol`` stocks at ``price`` made at ``timestamp``.
+            Trades fed in time order cost amortised O(1).
+        
+        """
+        
+        if self._cutoff is not None and timestamp <= self._cutoff:
+            # already out of window
+            return
+        
+        price_qty = price * qty
+        
+        heapq.heappush(self._trades, (timestamp, next(self._seq), price_qty, qty, symbol))
+        
+        self._price_qty += price_qty
+        self._qty += qty
+        
+        sums = self._symbols[symbol]
+        sums[0] += price_qty
+        sums[1] += qty
+        
+    @synchronized
+    def extend(self, timestamps, prices, qtys, symbols=None):
+        """ Account for trades in bulk - one per element of the given
+            equal-length sequences. See ``RollingVWSP.add``.
+        
+        """
+        
+        if symbols is None:
+            symbols = [None] * len(timestamps)
+            
+        trades = self._trades
+        cutoff = self._cutoff
+        
+        for timestamp, price, qty, symbol in zip(timestamps, prices, qtys, symbols):
+            if cutoff is not None and timestamp <= cutoff:
+                continue
+            
+            price_qty = price * qty
+            trades.append((timestamp, next(self._seq), price_qty, qty, symbol))
+            
+            self._price_qty += price_qty
+            self._qty += qty
+            
+            sums = self._symbols[symbol]
+            sums[0] += price_qty
+            sums[1] += qty
+            
+        heapq.heapify(trades)
+        
+    @synchronized
+    def covers(self, time_ref):
+        """ Whether the window ending at ``time_ref`` can be answered - expired
+            trades can't be brought back for an earlier time reference.
+        
+        """
+        
+        return self._cutoff is None or time_ref - self._delta >= self._cutoff
+        
+    @synchronized
+    def expire(self, time_ref):
+        """ Drop trades that occured ``window`` mins or more before ``time_ref``.
+        
+        """
+        
+        cutoff = time_ref - self._delta
+        
+        if self._cutoff is not None and cutoff < self._cutoff:
+            raise ValueError("[ERROR] RollingVWSP: Window already moved past {}.".format(time_ref))
+        
+        self._cutoff = cutoff
+        trades = self._trades
+        
+        while trades and trades[0][0] <= cutoff:
+            _, _, price_qty, qty, symbol = heapq.heappop(trades)
+            self._price_qty -= price_qty
+            self._qty -= qty
+            
+            sums = self._symbols[symbol]
+            sums[0] -= price_qty
+            sums[1] -= qty
+            
+            if sums[1] == 0:
+                # reset running sums to avoid accumulating rounding errors
+                del self._symbols[symbol]
+            
+        if not trades:
+            self._price_qty = 0.0
+            self._qty = 0
+        
+    @synchronized
+    def value(self, time_ref=None, symbol=None):
+        """ Volume weighted stock price over the window ending at ``time_ref``.
+        
+        Parameters
+        ----------
+        time_ref : datetime.datetime
+            end of window - defaults to now.
+        symbol : str
+            stock symbol to compute price for - all trades if not given.
+            
+        Returns
+        -------
+        price : float
+            weighted volume stock price.
+            
+        """
+        
+        price_qty, qty = self.sums(time_ref, symbol)
+        
+        if qty == 0:
+            raise ValueError("[ERROR] RollingVWSP: No transaction found.")
+            
+        return price_qty / qty
+    
+    @synchronized
+    def sums(self, time_ref=None, symbol=None):
+        """ Sums of ``price * qty`` and ``qty`` over the window ending at ``time_ref``.
+        
+        Returns
+        -------
+        sums : tuple
+            (sum of price * qty, sum of qty) - of ``symbol`` trades if given.
+            
+        """
+        
+        self.expire(time_ref if time_ref else datetime.now())
+        
+        if symbol is None:
+            return self._price_qty, self._qty
+        
+        price_qty, qty = self._symbols.get(symbol, (0.0, 0))
+        
+        return price_qty, qty
+    
+    @synchronized
+    def sums_if_covered(self, time_ref, symbol=None):
+        """ ``RollingVWSP.sums`` if the window ending at ``time_ref`` can be
+            answered - None otherwise. Checked and read at once, so another
+            thread can't move the window in between.
+            
+        """
+        
+        if not self.covers(time_ref):
+            return None
+        
+        return self.sums(time_ref, symbol)
+    
+    @synchronized
+    def values_if_covered(self, time_ref, symbols=None):
+        """ ``RollingVWSP.values`` if the window ending at ``time_ref`` can be
+            answered - None otherwise. See ``RollingVWSP.sums_if_covered``.
+            
+        """
+        
+        if not self.covers(time_ref):
+            return None
+        
+        return self.values(time_ref, symbols)
+    
+    @synchronized
+    def values(self, time_ref=None, symbols=None):
+        """ Volume weighted stock price per symbol over the window ending at ``time_ref``.
+        
+        Returns
+        -------
+        prices : dict
+            weighted volume stock price of each of ``symbols`` (all by
+            default) traded within window.
+            
+        """
+        
+        self.expire(time_ref if time_ref else datetime.now())
+        
+        if symbols is None:
+            symbols = [symbol for symbol in self._symbols if symbol is not None]
+        
+        return dict((symbol, self._symbols[symbol][0] / self._symbols[symbol][1]) \
+                    for symbol in symbols if symbol in self._symbols)
+
+
+class AllShareIndex(object):
+    """ All share index - geometric mean of the prices of stocks trading,
+        maintained incrementally in log space.
+        
+        Keeps log-prices of trading stocks and their running sum, so price
+        or trading changes update the index in O(1) and it doesn't overflow
+        or underflow for large numbers of stocks. Stocks without a price yet
+        (non-positive price) aren't part of the index. Updates of different
+        stocks may come from concurrent trades, so they are serialised.
+        
+    Examples
+    --------
+    >>> from sssm.backend import AllShareIndex
+    >>> index = AllShareIndex()
+    >>> index.update('TEA', 2.0)
+    >>> index.update('POP', 8.0)
+    >>> index.value()
+    4.0
+    
+    """
+    
+    def __init__(self):
+        self._logs = {}
+        self._log_sum = 0.0
+        self._updates = 0
+        self._lock = RLock()
+        
+    def __len__(self):
+        return len(self._logs)
+        
+    @synchronized
+    def update(self, symbol, price, trading=True):
+        """ Account for stock ``symbol`` now priced at ``price`` and (not) ``trading``.
+        
+        """
+        
+        log_price = self._logs.pop(symbol, None)
+        
+        if log_price is not None:
+            self._log_sum -= log_price
+            
+        if trading and price > 0:
+            log_price = self._logs[symbol] = math.log(price)
+            self._log_sum += log_price
+            
+        self._updates += 1
+        
+        # re-sum exactly every len(index) updates - amortised O(1) - to bound rounding errors
+        if self._updates >= len(self._logs):
+            self._log_sum = math.fsum(self._logs.values())
+            self._updates = 0
+            
+    @synchronized
+    def components(self):
+        """ Sum of log-prices and number of stocks in index. """
+        
+        return self._log_sum, len(self._logs)
+    
+    @synchronized
+    def value(self):
+        """ All share index - NaN when no stock trading has a price. """
+        
+        if not self._logs:
+            return float('nan')
+        
+        return math.exp(self._log_sum / len(self._logs))
+
+class BarBuilder(object):
+    """ Per stock OHLCV bars at several resolutions, built as trades occur.
+    
+        Each resolution keeps the last ``capacity`` bars of every stock in
+        preallocated ring arrays - a row per stock, the bar of time bucket
+        ``b`` at column ``b % capacity`` - holding open, high, low, close,
+        volume, sum of ``price * qty`` (so VWAP), trades count and bucket.
+        Trades update the bar of their bucket - late trades too, while their
+        bucket is still in the ring. The bar being traded is kept as plain
+        values and written to its ring as trading moves to another bucket
+        or bars are read, so a trade costs a few scalar updates.
+        
+        Sums over an interval aligned to a resolution read one bar per
+        bucket and stock - time proportional to the number of bars, not of
+        trades.
+        
+    Examples
+    --------
+    >>> from datetime import datetime
+    >>> from sssm.backend import BarBuilder
+    >>> bars = BarBuilder()
+    >>> start = datetime(2017, 1, 1, 10)
+    >>> bars.add(start, 10.0, 100, 'TEA')
+    >>> bars.add(start, 12.0, 300, 'TEA')
+    >>> bars.bars('TEA', 60)[0]['vwap']
+    11.5
+    
+    """
+    
+    # resolution (secs) => bars kept
+    RESOLUTIONS = ((1, 900), (60, 1440), (300, 576), (3600, 720))
+    
+    FIELDS = (('bucket', np.int64), ('open_ts', np.int64), ('close_ts', np.int64),
+              ('open', np.float64), ('high', np.float64), ('low', np.float64),
+              ('close', np.float64), ('volume', np.int64), ('price_qty', np.float64),
+              ('count', np.int64))
+    
+    def __init__(self, resolutions=None, symbols=8):
+        """ Bar builder setup.
+        
+        Parameters
+        ----------
+        resolutions : list
+            ``(secs, capacity)`` of each resolution - bars of ``secs`` and
+            how many of them to keep. Defaults to ``BarBuilder.RESOLUTIONS``.
+        symbols : int
+            stocks to allocate rows for - rows grow as stocks are traded.
+            
+        """
+        
+        self._resolutions = sorted(resolutions if resolutions else self.RESOLUTIONS)
+        self._rows = {}
+        self._rings = [self._ring(symbols, capacity) for res, capacity in self._resolutions]
+        
+        # latest bucket of each resolution - older buckets may be overwritten
+        self._latest = [None] * len(self._resolutions)
+        
+        # bar being traded of each resolution - stock row => field values, written to
+        # ring as trading moves to another bucket or rings are read
+        self._open = [{} for res in self._resolutions]
+        
+        # first bucket of each resolution whose trades are all held - None if all are
+        self._held = [None] * len(self._resolutions)
+        self._lock = RLock()
+        
+    def _ring(self, symbols, capacity):
+        ring = dict((name, np.zeros((symbols, capacity), dtype=dtype)) \
+                    for name, dtype in self.FIELDS)
+        ring['bucket'][:] = -1
+        
+        return ring
+    
+    @property
+    def resolutions(self):
+        return [res for res, capacity in self._resolutions]
+    
+    @property
+    def span(self):
+        """ Secs of trading the longest ring holds. """
+        
+        return max(res * capacity for res, capacity in self._resolutions)
+    
+    def _row(self, symbol):
+        row = self._rows.get(symbol)
+        
+        if row is None:
+            row = self._rows[symbol] = len(self._rows)
+            
+            if row == len(self._rings[0]['bucket']):
+                # twice the stocks
+                for i, (res, capacity) in enumerate(self._resolutions):
+                    ring = self._ring(2 * row, capacity)
+                    
+                    for name, dtype in self.FIELDS:
+                        ring[name][:row] = self._rings[i][name]
+                        
+                    self._rings[i] = ring
+                
+        return row
+    
+    def _store(self, i, row, bar):
+        ring = self._rings[i]
+        slot = bar[0] % self._resolutions[i][1]
+        
+        for (name, dtype), value in zip(self.FIELDS, bar):
+            ring[name][row, slot] = value
+            
+    def _flush(self):
+        """ Write open bars to their rings. """
+        
+        for i, bars in enumerate(self._open):
+            for row, bar in bars.items():
+                self._store(i, row, bar)
+                
+    @synchronized
+    def add(self, timestamp, price, qty, symbol):
+        """ Account for trade of ``qty`` ``symbol`` stocks at ``price`` made at ``timestamp``. """
+        
+        row = self._row(symbol)
+        ts = datetime_to_us(timestamp)
+        
+        for i, (res, capacity) in enumerate(self._resolutions):
+            bucket = ts // (res * 1000000)
+            bar = self._open[i].get(row)
+            
+            if bar is None or bar[0] != bucket:
+                # open bar of trade's bucket
+                if bar is not None:
+                    self._store(i, row, bar)
+                    
+                ring = self._rings[i]
+                slot = bucket % capacity
+                current = ring['bucket'][row, slot]
+                
+                if current > bucket:
+                    # out of ring
+                    continue
+                
+                if current == bucket:
+                    bar = [ring[name][row, slot].item() for name, dtype in self.FIELDS]
+                else:
+                    bar = [bucket, ts, ts, price, price, price, price, 0, 0.0, 0]
+                    
+                self._open[i][row] = bar
+                
+                if self._latest[i] is None or bucket > self._latest[i]:
+                    self._latest[i] = bucket
+                    
+            # bucket, open_ts, close_ts, open, high, low, close, volume, price_qty, count
+            if price > bar[4]:
+                bar[4] = price
+                
+            if price < bar[5]:
+                bar[5] = price
+                
+            if ts < bar[1]:
+                bar[1], bar[3] = ts, price
+                
+            if ts >= bar[2]:
+                bar[2], bar[6] = ts, price
+                
+            bar[7] += qty
+            bar[8] += price * qty
+            bar[9] += 1
+            
+    @synchronized
+    def extend(self, timestamps, prices, qtys, symbols):
+        """ Account for trades in bulk - one per element of the given
+            equal-length sequences (or arrays). See ``BarBuilder.add``.
+            
+        """
+        
+        if len(timestamps) == 0:
+            return
+        
+        self._flush()
+        
+        for bars in self._open:
+            bars.clear()
+            
+        if isinstance(timestamps, np.ndarray):
+            ts = timestamps.astype('datetime64[us]').astype(np.int64)
+        else:
+            ts = np.array([datetime_to_us(timestamp) for timestamp in timestamps], dtype=np.int64)
+            
+        prices = np.asarray(prices, dtype=np.float64)
+        qtys = np.asarray(qtys, dtype=np.int64)
+        rows = np.array([self._row(symbol) for symbol in symbols], dtype=np.int64)
+        
+        for i in range(len(self._resolutions)):
+            self._merge(i, rows, ts, ts, prices, prices, prices, prices, qtys, prices * qtys,
+                        np.ones(len(ts), dtype=np.int64))
+            
+    @synchronized
+    def extend_bars(self, starts, ends, symbols, counts, qtys, price_qtys, lows, highs, 
+                    firsts, lasts):
+        """ Account for trades already aggregated into bars - e.g. compacted
+            out of a ``TransactionLog`` (see ``Bars``) - spanning [``starts``,
+            ``ends``) us since epoch. Resolutions finer than a bar can't hold
+            it - they hold trades from the end of the latest such bar on only.
+            
+        """
+        
+        if len(starts) == 0:
+            return
+        
+        self._flush()
+        
+        for bars in self._open:
+            bars.clear()
+            
+        starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+        rows = np.array([self._row(symbol) for symbol in symbols], dtype=np.int64)
+        columns = [np.asarray(column) for column in (firsts, highs, lows, lasts, qtys, 
+                                                     price_qtys, counts)]
+        
+        for i, (res, capacity) in enumerate(self._resolutions):
+            width = res * 1000000
+            fits = starts // width == (ends - 1) // width
+            
+            if not fits.all():
+                self._hold_since(i, -(-int(ends[~fits].max()) // width))
+                
+            if fits.any():
+                self._merge(i, rows[fits], starts[fits], ends[fits] - 1, 
+                            *[column[fits] for column in columns])
+                
+    def _merge(self, i, rows, open_ts, close_ts, opens, highs, lows, closes, volumes, 
+               price_qtys, counts):
+        """ Merge bars - or trades - in ``open_ts`` order into ring of resolution ``i``. """
+        
+        res, capacity = self._resolutions[i]
+        buckets = open_ts // (res * 1000000)
+        
+        # bars of batch - per stock and bucket, in time order
+        idx = np.lexsort((open_ts, buckets, rows))
+        row, bucket = rows[idx], buckets[idx]
+        
+        heads = np.flatnonzero(np.concatenate([[True], (row[1:] != row[:-1]) | \
+                                                       (bucket[1:] != bucket[:-1])]))
+        tails = np.append(heads[1:], len(idx)) - 1
+        
+        bars = {
+            'bucket': bucket[heads], 'open_ts': open_ts[idx][heads], 
+            'close_ts': close_ts[idx][tails],
+            'open': opens[idx][heads], 'close': closes[idx][tails],
+            'high': np.maximum.reduceat(highs[idx], heads),
+            'low': np.minimum.reduceat(lows[idx], heads),
+            'volume': np.add.reduceat(volumes[idx], heads),
+            'price_qty': np.add.reduceat(price_qtys[idx], heads),
+            'count': np.add.reduceat(counts[idx], heads)
+        }
+        row = row[heads]
+        slot = bars['bucket'] % capacity
+        
+        # a bar per slot - the latest bucket's
+        idx = np.lexsort((bars['bucket'], slot, row))
+        last = np.flatnonzero(np.append((row[idx][1:] != row[idx][:-1]) | \
+                                        (slot[idx][1:] != slot[idx][:-1]), True))
+        idx = idx[last]
+        row, slot = row[idx], slot[idx]
+        bars = dict((name, values[idx]) for name, values in bars.items())
+        
+        ring = self._rings[i]
+        current = ring['bucket'][row, slot]
+        latest = int(bars['bucket'].max())
+        
+        if self._latest[i] is None or latest > self._latest[i]:
+            self._latest[i] = latest
+            
+        new = current < bars['bucket']
+        
+        for name, dtype in self.FIELDS:
+            ring[name][row[new], slot[new]] = bars[name][new]
+            
+        same = current == bars['bucket']
+        
+        if not same.any():
+            return
+        
+        row, slot = row[same], slot[same]
+        bars = dict((name, values[same]) for name, values in bars.items())
+        
+        ring['high'][row, slot] = np.maximum(ring['high'][row, slot], bars['high'])
+        ring['low'][row, slot] = np.minimum(ring['low'][row, slot], bars['low'])
+        
+        earlier = bars['open_ts'] < ring['open_ts'][row, slot]
+        ring['open_ts'][row[earlier], slot[earlier]] = bars['open_ts'][earlier]
+        ring['open'][row[earlier], slot[earlier]] = bars['open'][earlier]
+        
+        later = bars['close_ts'] >= ring['close_ts'][row, slot]
+        ring['close_ts'][row[later], slot[later]] = bars['close_ts'][later]
+        ring['close'][row[later], slot[later]] = bars['close'][later]
+        
+        for name in ('volume', 'price_qty', 'count'):
+            ring[name][row, slot] += bars[name]
+            
+    def _hold_since(self, i, bucket):
+        if self._held[i] is None or bucket > self._held[i]:
+            self._held[i] = bucket
+            
+    @synchronized
+    def hold_since(self, since):
+        """ Trades before ``since`` aren't all held - e.g. rings were seeded
+            with later ones only. Bars of buckets starting earlier aren't
+            read (see ``BarBuilder.sums``, ``BarBuilder.bars``).
+            
+        """
+        
+        since = datetime_to_us(since)
+        
+        for i, (res, capacity) in enumerate(self._resolutions):
+            self._hold_since(i, -(-since // (res * 1000000)))
+            
+    def _resolution(self, res):
+        for i, (secs, capacity) in enumerate(self._resolutions):
+            if secs == res:
+                return i
+            
+        raise ValueError("[ERROR] BarBuilder: Resolution {} isn't kept - one of {}.".format(
+                         res, self.resolutions))
+        
+    @synchronized
+    def bars(self, symbol, res, start=None, end=None):
+        """ Bars of stock ``symbol`` at resolution ``res`` secs, in time
+            order - whose buckets start within [``start``, ``end``) if given.
+            
+        Returns
+        -------
+        bars : list
+            bars as dictionaries - ``start`` time, ``open``, ``high``,
+            ``low``, ``close``, ``volume``, ``vwap`` and ``count``.
+            
+        """
+        
+        i = self._resolution(res)
+        row = self._rows.get(symbol)
+        
+        if row is None:
+            return []
+        
+        self._flush()
+        
+        ring = self._rings[i]
+        buckets = ring['bucket'][row]
+        width = res * 1000000
+        mask = buckets >= 0
+        
+        if self._held[i] is not None:
+            mask &= buckets >= self._held[i]
+            
+        if start is not None:
+            mask &= buckets >= -(-datetime_to_us(start) // width)
+            
+        if end is not None:
+            mask &= buckets < -(-datetime_to_us(end) // width)
+            
+        slots = np.flatnonzero(mask)
+        slots = slots[np.argsort(buckets[slots])]
+        
+        return [{
+                'start': us_to_datetime(int(ring['bucket'][row, slot]) * width),
+                'open': float(ring['open'][row, slot]),
+                'high': float(ring['high'][row, slot]),
+                'low': float(ring['low'][row, slot]),
+                'close': float(ring['close'][row, slot]),
+                'volume': int(ring['volume'][row, slot]),
+                'vwap': float(ring['price_qty'][row, slot] / ring['volume'][row, slot]),
+                'count': int(ring['count'][row, slot])
+            } for slot in slots.tolist()]
+    
+    @synchronized
+    def sums(self, start, end, symbol=None):
+        """ Sums of ``price * qty`` and ``qty`` over trades within [``start``,
+            ``end``) - of ``symbol`` if given - from the coarsest resolution
+            both are aligned to and whose ring still holds the interval.
+            
+        Returns
+        -------
+        sums : tuple
+            (sum of price * qty, sum of qty) - None if no resolution can
+            answer the interval.
+            
+        """
+        
+        start, end = datetime_to_us(start), datetime_to_us(end)
+        self._flush()
+        
+        for i in reversed(range(len(self._resolutions))):
+            res, capacity = self._resolutions[i]
+            width = res * 1000000
+            
+            if start % width or end % width:
+                continue
+            
+            first, last = start // width, end // width
+            latest = self._latest[i]
+            
+            if last - first > capacity or (latest is not None and first <= latest - capacity) \
+               or (self._held[i] is not None and first < self._held[i]):
+                # ring doesn't hold interval
+                continue
+            
+            if symbol is not None:
+                if symbol not in self._rows:
+                    return 0.0, 0
+                
+                rows = [self._rows[symbol]]
+            else:
+                rows = slice(0, len(self._rows))
+                
+            buckets = np.arange(first, last)
+            slots = buckets % capacity
+            ring = self._rings[i]
+            held = ring['bucket'][rows][:, slots] == buckets
+            
+            return float(ring['price_qty'][rows][:, slots][held].sum()), \
+                   int(ring['volume'][rows][:, slots][held].sum())
+        
+        return None
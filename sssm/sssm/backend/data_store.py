@@ -1,8 +1,1094 @@
 from __future__ import absolute_import, division, print_function
 
 from collections import defaultdict, MutableMapping
+import copy
+from datetime import datetime
+import hmac
+import itertools
+import json
+import numbers
+import os
+import shutil
+from threading import RLock
+import numpy as np
 from sssm.backend import data
+from sssm.backend.analytics import AllShareIndex
+from sssm.backend.util import datetime_to_us, us_to_datetime, synchronized, MonotonicIds
 
+class Codes(object):
+    """ Two-way mapping between values (stock symbols, trader ids) and
+        the integer codes they are stored as in columnar collections.
+        
+    Examples
+    --------
+    >>> from sssm.backend.data_store import Codes
+    >>> codes = Codes()
+    >>> codes.encode('TEA')
+    0
+    >>> codes.decode(0)
+    'TEA'
+    
+    """
+    
+    def __init__(self, values=None):
+        self._codes = {}
+        self._values = []
+        
+        for value in values if values else []:
+            self.encode(value)
+        
+    def __len__(self):
+        return len(self._values)
+    
+    def __contains__(self, value):
+        return value in self._codes
+        
+    def encode(self, value):
+        """ Code of ``value`` - a new code is assigned to unseen values. """
+        
+        code = self._codes.get(value)
+        
+        if code is None:
+            code = self._codes[value] = len(self._values)
+            self._values.append(value)
+            
+        return code
+    
+    def get(self, value, default=-1):
+        """ Code of ``value`` or ``default`` if value was never encoded. """
+        
+        return self._codes.get(value, default)
+    
+    def decode(self, code):
+        return self._values[code] if code >= 0 else None
+    
+    @property
+    def values(self):
+        return self._values
+
+class TraderSessions(object):
+    """ Traders' records and tokens by trader id - authenticating trades.
+    
+        A trader's session - record and token as bytes - is resolved from
+        ``traders`` records when first used, and reused while the record
+        and its token stay the same. Authenticating costs a dictionary
+        lookup and a constant time comparison of tokens by value - as
+        ``str``, ``bytes`` or e.g. ``uuid.UUID``, so tokens received over
+        HTTP match.
+    
+    Examples
+    --------
+    >>> from sssm.backend.data_store import TraderSessions
+    >>> sessions = TraderSessions({'trader1': {'id': 'trader1', 'token': 'abc'}})
+    >>> sessions.authenticate('trader1', b'abc')['id']
+    'trader1'
+    >>> sessions.authenticate('trader1', 'abd') is None
+    True
+    
+    """
+    
+    def __init__(self, traders):
+        self._traders = traders
+        self._sessions = {}
+        
+    def __len__(self):
+        return len(self._sessions)
+    
+    @staticmethod
+    def _key(token):
+        if isinstance(token, bytes):
+            return token
+        
+        return (token if isinstance(token, type(u'')) else str(token)).encode('utf-8')
+    
+    def _session(self, trader):
+        record = self._traders.get(trader)
+        
+        if record is None:
+            self._sessions.pop(trader, None)
+            return None
+        
+        session = self._sessions.get(trader)
+        token = record.get('token')
+        
+        if session is None or session[0] is not record or session[1] is not token:
+            session = self._sessions[trader] = (record, token, self._key(token))
+            
+        return session
+    
+    def authenticate(self, trader, token):
+        """ Record of ``trader`` if ``token`` is its token - None otherwise
+            (or if there's no such trader).
+        
+        """
+        
+        session = self._session(trader)
+        
+        if session is None or token is None:
+            return None
+        
+        record, stored, key = session
+        
+        if token is stored or hmac.compare_digest(self._key(token), key):
+            return record
+        
+        return None
+    
+class IdColumn(object):
+    """ Transaction ids by row - in a growable NumPy array, whose rows
+        loaded from a snapshot may be memory-mapped.
+        
+        Integer ids take 8 bytes a row and, while they increase row by row
+        (as generated by ``MonotonicIds``), rows are found by binary search
+        - with no index. Otherwise (e.g. text ids) ids are held as objects
+        and rows indexed by a dictionary, built on first lookup.
+        
+    """
+    
+    def __init__(self, base=None):
+        self._values = base if base is not None else np.empty(0, dtype=np.int64)
+        self._size = len(self._values)
+        self._index = None
+        self._increasing = self._values.dtype.kind in 'iu' and \
+                           bool(np.all(self._values[1:] > self._values[:-1]))
+        
+        # last id - while increasing
+        self._last = int(self._values[-1]) if self._increasing and self._size else None
+        
+    def __len__(self):
+        return self._size
+    
+    def __getitem__(self, row):
+        txn_id = self._values[row]
+        
+        return txn_id.item() if isinstance(txn_id, np.generic) else txn_id
+    
+    def __iter__(self):
+        return iter(self.take(slice(0, self._size)))
+    
+    def take(self, rows):
+        """ Ids at ``rows`` - an array of rows or a slice - as a list. """
+        
+        return self._values[:self._size][rows].tolist()
+    
+    def array(self):
+        """ All ids as a NumPy array. """
+        
+        return self._values[:self._size]
+    
+    def last(self):
+        """ Greatest integer id - None if there isn't one. """
+        
+        if self._increasing:
+            return self._last
+        
+        if not self._size or self._values.dtype.kind not in 'iu':
+            return None
+        
+        return int(self._values[:self._size].max())
+    
+    def row(self, txn_id):
+        """ Last row holding ``txn_id`` - None if it's not held. """
+        
+        if not self._increasing:
+            return self._rows().get(txn_id)
+        
+        if not isinstance(txn_id, numbers.Integral) or self._last is None or txn_id > self._last:
+            return None
+        
+        values = self._values[:self._size]
+        row = int(np.searchsorted(values, txn_id))
+        
+        return row if row < self._size and values[row] == txn_id else None
+    
+    def rows(self, txn_ids):
+        """ Last rows holding any of ``txn_ids``. """
+        
+        last = self.last()
+        
+        if self._increasing and last is not None:
+            ids = np.asarray(txn_ids)
+            
+            if ids.dtype.kind in 'iu':
+                # new ids (e.g. generated) are past those held
+                if ids.min() > last:
+                    return []
+                
+                values = self._values[:self._size]
+                rows = np.minimum(np.searchsorted(values, ids), self._size - 1)
+                
+                return rows[values[rows] == ids].tolist()
+        
+        rows = [self.row(txn_id) for txn_id in txn_ids]
+        
+        return [row for row in rows if row is not None]
+    
+    def _rows(self):
+        if self._index is None:
+            self._index = dict((txn_id, row) for row, txn_id in enumerate(self))
+            
+        return self._index
+    
+    def keep(self, rows):
+        """ Keep ids at ``rows`` only - renumbered in order. """
+        
+        self._values = self._values[:self._size][rows]
+        self._size = len(self._values)
+        self._index = None
+        self._last = int(self._values[-1]) if self._increasing and self._size else None
+        
+    def append(self, txn_id):
+        """ Append ``txn_id`` - see ``IdColumn.extend``. """
+        
+        if self._increasing and self._size < len(self._values) and \
+                isinstance(txn_id, numbers.Integral) and self._values.dtype.kind in 'iu' and \
+                (self._last is None or txn_id > self._last):
+            self._values[self._size] = txn_id
+            self._size += 1
+            self._last = txn_id
+            
+            return []
+        
+        return self.extend([txn_id])
+    
+    def extend(self, txn_ids):
+        """ Append ``txn_ids``.
+        
+        Returns
+        -------
+        rows : list
+            rows whose ids are held again by rows appended.
+            
+        """
+        
+        start, k = self._size, len(txn_ids)
+        ids = np.asarray(txn_ids)
+        
+        if ids.dtype.kind not in 'iu' or self._values.dtype.kind not in 'iu':
+            # held as objects - as given
+            ids = np.empty(k, dtype=object)
+            ids[:] = txn_ids
+            
+        if start + k > len(self._values) or ids.dtype != self._values.dtype:
+            capacity = max(len(self._values), 1024)
+            
+            while capacity < start + k:
+                capacity *= 2
+                
+            values = np.empty(capacity, dtype=ids.dtype)
+            values[:start] = self._values[:start]
+            self._values = values
+            
+        if self._increasing and ids.dtype.kind in 'iu' and \
+                (start == 0 or ids[0] > self._values[start - 1]) and \
+                bool(np.all(ids[1:] > ids[:-1])):
+            self._values[start:start + k] = ids
+            self._size += k
+            self._last = int(ids[-1])
+            
+            return []
+        
+        index = self._rows()
+        self._increasing = False
+        self._last = None
+        self._values[start:start + k] = ids
+        self._size += k
+        
+        replaced = []
+        
+        for row, txn_id in enumerate(self.take(slice(start, start + k)), start):
+            if txn_id in index:
+                replaced.append(index[txn_id])
+                
+            index[txn_id] = row
+            
+        return replaced
+
+class Bars(object):
+    """ Aggregates of trades compacted out of a ``TransactionLog`` - per
+        stock and time bucket: trades count, sum of qty, sum of ``price *
+        qty``, low/high price and first/last price. Bars are held in NumPy
+        columns, stock symbols by code of the log they were compacted from.
+        
+        Bars count towards a time range if their bucket lies within it - so
+        volume weighted prices over old time ranges are answered at bucket
+        resolution.
+        
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from sssm.backend.data_store import Bars
+    >>> bars = Bars()
+    >>> prices = np.array([10.0, 12.0])
+    >>> bars.add(60000000, np.array([0, 1000]), np.array([0, 0]), np.ones(2, dtype=np.int64),
+    ...          np.array([100, 300]), prices * [100, 300], prices, prices, prices, prices)
+    >>> bars.column('price_qty')
+    array([4600.])
+    
+    """
+    
+    COLUMNS = (('start', np.int64), ('end', np.int64), ('symbol', np.int32),
+               ('count', np.int64), ('qty', np.int64), ('price_qty', np.float64),
+               ('low', np.float64), ('high', np.float64), ('first', np.float64),
+               ('last', np.float64))
+    
+    def __init__(self, columns=None):
+        self._columns = columns if columns is not None else \
+                        dict((name, np.empty(0, dtype=dtype)) for name, dtype in self.COLUMNS)
+        
+    def __len__(self):
+        return len(self._columns['start'])
+    
+    def column(self, name):
+        """ Values of column ``name`` - one of ``Bars.COLUMNS`` - indexed by bar. """
+        
+        return self._columns[name]
+    
+    def add(self, width, start, symbol, count, qty, price_qty, low, high, first, last):
+        """ Add bars of ``width`` us buckets aggregating the given columns -
+            trades (or bars) in time order, ``start`` of each in us since epoch.
+            
+        """
+        
+        if not len(start):
+            return
+        
+        bucket = start // width * width
+        
+        # stable - time order kept within each bucket and stock
+        idx = np.lexsort((symbol, bucket))
+        bucket, symbol = bucket[idx], symbol[idx]
+        
+        heads = np.flatnonzero(np.concatenate([[True], (bucket[1:] != bucket[:-1]) | \
+                                                       (symbol[1:] != symbol[:-1])]))
+        tails = np.append(heads[1:], len(idx)) - 1
+        
+        added = {
+            'start': bucket[heads],
+            'end': bucket[heads] + width,
+            'symbol': symbol[heads],
+            'count': np.add.reduceat(count[idx], heads),
+            'qty': np.add.reduceat(qty[idx], heads),
+            'price_qty': np.add.reduceat(price_qty[idx], heads),
+            'low': np.minimum.reduceat(low[idx], heads),
+            'high': np.maximum.reduceat(high[idx], heads),
+            'first': first[idx][heads],
+            'last': last[idx][tails]
+        }
+        
+        for name, dtype in self.COLUMNS:
+            self._columns[name] = np.concatenate([self._columns[name], 
+                                                  added[name].astype(dtype)])
+            
+    def compact(self, before, width):
+        """ Merge bars ending by ``before`` (us since epoch) into bars of
+            ``width`` us buckets.
+        
+        Returns
+        -------
+        merged : int
+            number of bars merged.
+            
+        """
+        
+        c = self._columns
+        old = (c['end'] <= before) & (c['end'] - c['start'] < width)
+        
+        if not old.any():
+            return 0
+        
+        rows = np.flatnonzero(old)
+        rows = rows[np.argsort(c['start'][rows], kind='mergesort')]
+        merged = dict((name, c[name][rows]) for name, dtype in self.COLUMNS)
+        
+        for name, dtype in self.COLUMNS:
+            c[name] = c[name][~old]
+            
+        self.add(width, *[merged[name] for name in ('start', 'symbol', 'count', 'qty',
+                                                     'price_qty', 'low', 'high', 'first', 'last')])
+        
+        return len(rows)
+    
+    def select(self, since=None, until=None, symbol=None):
+        """ Bars whose buckets lie within time range [``since``, ``until``] -
+            us since epoch, open ended if not given - of stock ``symbol`` code.
+        
+        """
+        
+        c = self._columns
+        mask = np.ones(len(self), dtype=bool)
+        
+        if since is not None:
+            mask &= c['start'] >= since
+            
+        if until is not None:
+            mask &= c['end'] <= until
+            
+        if symbol is not None:
+            mask &= c['symbol'] == symbol
+            
+        return np.flatnonzero(mask)
+    
+    def save(self, directory):
+        for name, dtype in self.COLUMNS:
+            np.save(os.path.join(directory, 'bars_' + name + '.npy'), self._columns[name])
+            
+    @classmethod
+    def load(cls, directory):
+        """ Bars saved to ``directory`` by ``Bars.save`` - none if there aren't any. """
+        
+        if not os.path.exists(os.path.join(directory, 'bars_start.npy')):
+            return cls()
+        
+        return cls(dict((name, np.load(os.path.join(directory, 'bars_' + name + '.npy'))) \
+                        for name, dtype in cls.COLUMNS))
+
+class TransactionLog(MutableMapping):
+    """ Columnar in-memory store of transactions.
+    
+        Trades are held in growable typed NumPy arrays - epoch timestamp (us),
+        symbol code, qty, price, trade type and trader code - alongside a
+        timestamp-sorted order of rows, so time range searches and analytics
+        run as NumPy masks and reductions. Transaction records are still
+        accessed as a dictionary of records keyed by transaction id.
+        
+        Writes and searches are serialised by an internal lock - searches
+        may reorder rows. Writes are recorded to ``journal``, if set.
+        
+        Old transactions can be compacted into ``bars`` - per stock, time
+        bucket aggregates - and evicted (see ``TransactionLog.compact``).
+        Volume weighted sums span both.
+        
+    Examples
+    --------
+    >>> from datetime import datetime
+    >>> from sssm.backend.data_store import TransactionLog
+    >>> log = TransactionLog()
+    >>> log.append('txn1', datetime(2017, 1, 1, 10), 'TEA', 100, 15.0, 'BUY', 'trader1')
+    >>> log['txn1']['value']
+    1500.0
+    >>> log.find(datetime(2017, 1, 1, 9))
+    ['txn1']
+    
+    """
+    
+    TYPES = ('BUY', 'SELL')
+    
+    COLUMNS = (('ts', np.int64), ('symbol', np.int32), ('qty', np.int64),
+               ('price', np.float64), ('type', np.int8), ('trader', np.int32))
+    
+    def __init__(self, capacity=1024):
+        self._size = 0
+        self._capacity = capacity
+        self._columns = dict((name, np.empty(capacity, dtype=dtype)) \
+                             for name, dtype in self.COLUMNS)
+        self._live = np.ones(capacity, dtype=bool)
+        self._deleted = 0
+        
+        # rows [0, _sorted) ordered by timestamp
+        self._order = np.empty(capacity, dtype=np.int64)
+        self._sorted_ts = np.empty(capacity, dtype=np.int64)
+        self._sorted = 0
+        
+        self._ids = IdColumn()
+        self.bars = Bars()
+        self.symbols = Codes()
+        self.traders = Codes()
+        self.journal = None
+        
+        # generates ids of transactions stored without one - see MonotonicIds
+        self.ids = None
+        self._lock = RLock()
+        
+    def __len__(self):
+        return self._size - self._deleted
+    
+    @synchronized
+    def _row(self, txn_id):
+        """ Row of transaction ``txn_id`` - None if it's not stored. """
+        
+        row = self._ids.row(txn_id)
+        
+        return row if row is not None and self._live[row] else None
+    
+    def __iter__(self):
+        live = self._live
+        
+        for row, txn_id in enumerate(self._ids):
+            if live[row]:
+                yield txn_id
+                
+    def __contains__(self, txn_id):
+        return self._row(txn_id) is not None
+    
+    def __getitem__(self, txn_id):
+        row = self._row(txn_id)
+        
+        if row is None:
+            raise KeyError(txn_id)
+        
+        return self.record(row)
+    
+    def __setitem__(self, txn_id, record):
+        qty = record.get('volume')
+        price = record.get('per_price')
+        
+        if price is None and qty:
+            price = record.get('value', 0.0) / qty
+            
+        self.append(txn_id, record['ts'], record['symbol'], qty, price, 
+                    record.get('type', 'BUY'), record.get('trader'))
+    
+    @synchronized
+    def max_id(self):
+        """ Greatest integer transaction id recorded - None if there isn't one. """
+        
+        return self._ids.last()
+    
+    @synchronized
+    def __delitem__(self, txn_id):
+        row = self._row(txn_id)
+        
+        if row is None:
+            raise KeyError(txn_id)
+        
+        self._live[row] = False
+        self._deleted += 1
+        
+        if self.journal is not None:
+            self.journal.delete(txn_id)
+    
+    def column(self, name):
+        """ Stored values of column ``name`` - one of ``ts``, ``symbol``, ``qty``, 
+            ``price``, ``type`` or ``trader`` - indexed by row.
+        
+        """
+        
+        return self._columns[name][:self._size]
+    
+    def record(self, row):
+        """ Transaction record stored at ``row``. """
+        
+        c = self._columns
+        qty = int(c['qty'][row])
+        price = float(c['price'][row])
+        
+        return {
+                'trader': self.traders.decode(c['trader'][row]),
+                'id': self._ids[row],
+                'type': self.TYPES[c['type'][row]],
+                'ts':  us_to_datetime(c['ts'][row]),
+                'symbol' : self.symbols.decode(c['symbol'][row]),
+                'volume' : qty,
+                'value': qty * price,
+                'per_price': price
+               }
+    
+    @synchronized
+    def append(self, txn_id, timestamp, symbol, qty, price, trade_type, trader):
+        """ Store transaction ``txn_id`` - replacing any transaction stored
+            under the same id. A ``txn_id`` of None is allocated from ``ids``
+            while the log is locked - so ids increase in the order stored.
+        
+        Returns
+        -------
+        txn_id : int
+            id of stored transaction.
+            
+        """
+        
+        if txn_id is None:
+            txn_id = self._allocate(1)[0]
+        elif self._row(txn_id) is not None:
+            del self[txn_id]
+        
+        if trade_type not in self.TYPES:
+            raise ValueError("Store: [ERROR] Invalid trade type {}.".format(trade_type))
+        
+        if self._size == self._capacity:
+            self._grow(max(2 * self._capacity, 1024))
+            
+        row = self._size
+        ts = datetime_to_us(timestamp)
+        
+        c = self._columns
+        c['ts'][row] = ts
+        c['symbol'][row] = self.symbols.encode(symbol)
+        c['qty'][row] = qty
+        c['price'][row] = price
+        c['type'][row] = self.TYPES.index(trade_type)
+        c['trader'][row] = self.traders.encode(trader) if trader is not None else -1
+        
+        if self.journal is not None:
+            self.journal.trades([txn_id], [ts], [symbol], [qty], [price], 
+                                [c['type'][row]], [trader])
+        
+        # trades in time order extend sorted rows directly
+        if self._sorted == row and (row == 0 or ts >= self._sorted_ts[row - 1]):
+            self._order[row] = row
+            self._sorted_ts[row] = ts
+            self._sorted += 1
+        
+        self._ids.append(txn_id)
+        self._size += 1
+        
+        return txn_id
+        
+    @synchronized
+    def extend(self, txn_ids, timestamps, symbols, qtys, prices, trade_types, traders):
+        """ Store transactions in bulk - one per element of the given
+            equal-length sequences or arrays - ``txn_ids`` allocated if None.
+            See ``TransactionLog.append``.
+        
+        Returns
+        -------
+        txn_ids : list
+            ids of stored transactions.
+            
+        """
+        
+        k = len(timestamps)
+        
+        if k == 0:
+            return []
+        
+        types = self.TYPES
+        
+        for trade_type in set(trade_types):
+            if trade_type not in types:
+                raise ValueError("Store: [ERROR] Invalid trade type {}.".format(trade_type))
+        
+        if txn_ids is None:
+            txn_ids = self._allocate(k)
+        else:
+            for row in self._ids.rows(txn_ids):
+                if self._live[row]:
+                    del self[self._ids[row]]
+        
+        if self._size + k > self._capacity:
+            capacity = max(self._capacity, 1024)
+            
+            while capacity < self._size + k:
+                capacity *= 2
+                
+            self._grow(capacity)
+            
+        start = self._size
+        end = start + k
+        
+        if isinstance(timestamps, np.ndarray):
+            ts = timestamps.astype('datetime64[us]').astype(np.int64)
+        else:
+            ts = np.array([datetime_to_us(timestamp) for timestamp in timestamps], dtype=np.int64)
+        
+        c = self._columns
+        c['ts'][start:end] = ts
+        c['symbol'][start:end] = [self.symbols.encode(symbol) for symbol in symbols]
+        c['qty'][start:end] = qtys
+        c['price'][start:end] = prices
+        c['type'][start:end] = [types.index(trade_type) for trade_type in trade_types]
+        c['trader'][start:end] = [self.traders.encode(trader) if trader is not None else -1 \
+                                  for trader in traders]
+        
+        if self.journal is not None:
+            self.journal.trades(txn_ids, ts, symbols, qtys, prices, c['type'][start:end], traders)
+        
+        # batch in time order, following sorted rows, extends them directly
+        if self._sorted == start and np.all(ts[1:] >= ts[:-1]) and \
+                (start == 0 or ts[0] >= self._sorted_ts[start - 1]):
+            self._order[start:end] = np.arange(start, end)
+            self._sorted_ts[start:end] = ts
+            self._sorted = end
+            
+        for row in self._ids.extend(txn_ids):
+            # repeated within batch
+            if self._live[row]:
+                self._live[row] = False
+                self._deleted += 1
+            
+        self._size = end
+        
+        return txn_ids
+    
+    def _allocate(self, k):
+        if self.ids is None:
+            raise ValueError("Store: [ERROR] No ids to allocate transaction ids from.")
+        
+        return self.ids.take(k)
+        
+    def _grow(self, capacity):
+        n = self._size
+        
+        for name, dtype in self.COLUMNS:
+            column = np.empty(capacity, dtype=dtype)
+            column[:n] = self._columns[name][:n]
+            self._columns[name] = column
+            
+        for name in ('_order', '_sorted_ts'):
+            column = np.empty(capacity, dtype=np.int64)
+            column[:self._sorted] = getattr(self, name)[:self._sorted]
+            setattr(self, name, column)
+            
+        live = np.ones(capacity, dtype=bool)
+        live[:n] = self._live[:n]
+        self._live = live
+        
+        self._capacity = capacity
+        
+    def _sort(self):
+        """ Merge rows appended out of time order into sorted rows. """
+        
+        start, n = self._sorted, self._size
+        
+        if start == n:
+            return
+        
+        ts = self._columns['ts'][start:n]
+        idx = np.argsort(ts, kind='mergesort')
+        
+        pos = np.searchsorted(self._sorted_ts[:start], ts[idx], side='right')
+        
+        self._order[:n] = np.insert(self._order[:start], pos, np.arange(start, n)[idx])
+        self._sorted_ts[:n] = np.insert(self._sorted_ts[:start], pos, ts[idx])
+        self._sorted = n
+        
+    @synchronized
+    def select(self, since=None, until=None, symbol=None):
+        """ Rows of transactions which occured within time range (``since``, ``until``].
+        
+        Parameters
+        ----------
+        since : datetime.datetime
+            exclusive lower bound of trade time - open ended if not given.
+        until : datetime.datetime
+            inclusive upper bound of trade time - open ended if not given.
+        symbol : str
+            restrict search to trades of given stock symbol.
+            
+        Returns
+        -------
+        rows : numpy.ndarray
+            rows of stored transactions in time order.
+            
+        """
+        
+        self._sort()
+        
+        n = self._size
+        sorted_ts = self._sorted_ts[:n]
+        
+        start = np.searchsorted(sorted_ts, datetime_to_us(since), side='right') \
+                    if since is not None else 0
+        end = np.searchsorted(sorted_ts, datetime_to_us(until), side='right') \
+                    if until is not None else n
+        
+        rows = self._order[start:end].copy()
+        
+        if self._deleted > 0:
+            rows = rows[self._live[rows]]
+            
+        if symbol is not None:
+            if symbol not in self.symbols:
+                return rows[:0]
+            
+            rows = rows[self._columns['symbol'][rows] == self.symbols.get(symbol)]
+            
+        return rows
+    
+    @synchronized
+    def page(self, since=None, until=None, symbol=None, trader=None, after=None, limit=1000):
+        """ A page of transactions which occured within time range (``since``,
+            ``until``] - in (timestamp, id) order, following ``after``. Pages
+            are read in time proportional to their size, not to the range's,
+            and consistently with trades recorded meanwhile.
+            
+        Parameters
+        ----------
+        since, until, symbol : 
+            see ``TransactionLog.select``.
+        trader : str
+            restrict search to trades of given trader.
+        after : tuple
+            cursor - (epoch timestamp (us), id) of last transaction of
+            previous page. A page following a deleted or compacted
+            transaction having a text id may repeat transactions of its
+            timestamp.
+        limit : int
+            most transactions in page.
+            
+        Returns
+        -------
+        page : tuple
+            (transaction records, cursor of next page - None if there isn't one)
+            
+        """
+        
+        self._sort()
+        
+        n = self._size
+        sorted_ts = self._sorted_ts[:n]
+        c = self._columns
+        
+        start = np.searchsorted(sorted_ts, datetime_to_us(since), side='right') \
+                    if since is not None else 0
+        end = np.searchsorted(sorted_ts, datetime_to_us(until), side='right') \
+                    if until is not None else n
+        
+        codes = []
+        
+        for name, codec, value in (('symbol', self.symbols, symbol), 
+                                   ('trader', self.traders, trader)):
+            if value is not None:
+                if value not in codec:
+                    return [], None
+                
+                codes.append((c[name], codec.get(value)))
+        
+        tie_end = start
+        
+        if after is not None:
+            after_ts, after_id = after
+            start = max(start, np.searchsorted(sorted_ts, after_ts, side='left'))
+            tie_end = max(start, np.searchsorted(sorted_ts, after_ts, side='right'))
+            
+            row = self._ids.row(after_id)
+            
+            if row is not None:
+                found = np.flatnonzero(self._order[start:tie_end] == row)
+                
+                if len(found):
+                    # transactions of same timestamp up to cursor's were read
+                    start += int(found[0]) + 1
+                    tie_end = start
+        
+        block = max(limit, 1024)
+        rows = []
+        pos = start
+        
+        while pos < end and len(rows) < limit:
+            block_rows = self._order[pos:min(pos + block, end)]
+            keep = self._live[block_rows]
+            
+            for column, code in codes:
+                keep &= column[block_rows] == code
+            
+            if pos < tie_end:
+                # cursor's transaction is gone - ids following it (integer) go on
+                tie = np.arange(pos, pos + len(block_rows)) < tie_end
+                
+                for i in np.flatnonzero(tie & keep).tolist():
+                    txn_id = self._ids[block_rows[i]]
+                    keep[i] = not isinstance(after_id, numbers.Integral) or \
+                              not isinstance(txn_id, numbers.Integral) or txn_id > after_id
+                    
+            rows.extend(block_rows[keep][:limit - len(rows)].tolist())
+            pos += block
+            
+        if len(rows) < limit or not rows:
+            return [self.record(row) for row in rows], None
+        
+        return [self.record(row) for row in rows], (int(c['ts'][rows[-1]]), self._ids[rows[-1]])
+    
+    @synchronized
+    def compact(self, before, bucket=60):
+        """ Compact transactions which occured before ``before`` into ``bars``
+            of ``bucket`` secs, evicting them - and rows of deleted
+            transactions - from the log.
+        
+        Returns
+        -------
+        compacted : int
+            number of transactions compacted.
+            
+        """
+        
+        self._sort()
+        
+        n = self._size
+        k = np.searchsorted(self._sorted_ts[:n], datetime_to_us(before), side='left')
+        
+        old = self._order[:k]
+        old = old[self._live[old]]
+        
+        if len(old) == 0 and self._deleted == 0:
+            return 0
+        
+        c = self._columns
+        price, qty = c['price'][old], c['qty'][old]
+        
+        self.bars.add(int(bucket * 1e6), c['ts'][old], c['symbol'][old],
+                      np.ones(len(old), dtype=np.int64), qty, price * qty,
+                      price, price, price, price)
+        
+        # evict - kept rows renumbered in row order
+        keep = self._live[:n].copy()
+        keep[old] = False
+        kept = np.flatnonzero(keep)
+        
+        rows = np.full(n, -1, dtype=np.int64)
+        rows[kept] = np.arange(len(kept))
+        order = self._order[k:n]
+        sorted_keep = keep[order]
+        
+        m = len(kept)
+        capacity = max(2 * m, 1024)
+        
+        for name, dtype in self.COLUMNS:
+            column = np.empty(capacity, dtype=dtype)
+            column[:m] = c[name][kept]
+            c[name] = column
+            
+        for name, column in (('_order', rows[order[sorted_keep]]),
+                             ('_sorted_ts', self._sorted_ts[k:n][sorted_keep])):
+            values = np.empty(capacity, dtype=np.int64)
+            values[:m] = column
+            setattr(self, name, values)
+            
+        self._live = np.ones(capacity, dtype=bool)
+        self._ids.keep(kept)
+        self._size = self._sorted = m
+        self._capacity = capacity
+        self._deleted = 0
+        
+        return len(old)
+    
+    @synchronized
+    def compact_bars(self, before, bucket=3600):
+        """ Merge bars ending before ``before`` into bars of ``bucket`` secs -
+            see ``Bars.compact``.
+            
+        """
+        
+        return self.bars.compact(datetime_to_us(before), int(bucket * 1e6))
+    
+    @synchronized
+    def save(self, directory):
+        """ Save transactions to ``directory`` - a NumPy ``.npy`` file per column.
+        
+        Returns
+        -------
+        meta : dict
+            what else is needed to load transactions - see ``TransactionLog.load``.
+            
+        """
+        
+        self._sort()
+        
+        n = self._size
+        ids = self._ids.array()
+        
+        if ids.dtype == object:
+            ids = ids.astype('U')
+            
+        columns = [(name, self._columns[name][:n]) for name, dtype in self.COLUMNS]
+        columns += [('live', self._live[:n]), ('order', self._order[:n]),
+                    ('sorted_ts', self._sorted_ts[:n]), ('ids', ids)]
+        
+        for name, column in columns:
+            np.save(os.path.join(directory, name + '.npy'), column)
+            
+        self.bars.save(directory)
+            
+        return {
+            'deleted': self._deleted,
+            'symbols': list(self.symbols.values),
+            'traders': list(self.traders.values)
+        }
+    
+    @classmethod
+    def load(cls, directory, meta):
+        """ Load transactions saved to ``directory`` by ``TransactionLog.save``.
+        
+            Columns are memory-mapped (copy-on-write), so transactions are
+            searchable at once and read from disk as accessed. Increasing
+            integer ids are searched in place - other ids are indexed on
+            first lookup by id. Columns are copied into memory once
+            transactions are added.
+            
+        """
+        
+        def load_column(name):
+            return np.load(os.path.join(directory, name + '.npy'), mmap_mode='c')
+        
+        log = cls(capacity=0)
+        log._columns = dict((name, load_column(name)) for name, dtype in cls.COLUMNS)
+        log._live = load_column('live')
+        log._order = load_column('order')
+        log._sorted_ts = load_column('sorted_ts')
+        log._ids = IdColumn(load_column('ids'))
+        log.bars = Bars.load(directory)
+        
+        log._size = log._capacity = log._sorted = len(log._live)
+        log._deleted = meta['deleted']
+        log.symbols = Codes(meta['symbols'])
+        log.traders = Codes(meta['traders'])
+        
+        return log
+    
+    def find(self, since=None, until=None, symbol=None):
+        """ Ids of transactions which occured within time range (``since``, ``until``],
+            in time order. See ``TransactionLog.select``.
+        
+        """
+        
+        return self._ids.take(self.select(since, until, symbol))
+    
+    @synchronized
+    def volume_weighted(self, since=None, until=None, symbol=None):
+        """ Sums of ``price * qty`` and ``qty`` over transactions in time range.
+        
+        Returns
+        -------
+        sums : tuple
+            (sum of price * qty, sum of qty)
+            
+        """
+        
+        rows = self.select(since, until, symbol)
+        qty = self._columns['qty'][rows]
+        price_qty, qty = float(np.dot(self._columns['price'][rows], qty)), int(qty.sum())
+        
+        if len(self.bars):
+            bars = self._bars(since, until, self.symbols.get(symbol) if symbol is not None else None)
+            price_qty += float(self.bars.column('price_qty')[bars].sum())
+            qty += int(self.bars.column('qty')[bars].sum())
+            
+        return price_qty, qty
+    
+    def _bars(self, since, until, symbol=None):
+        return self.bars.select(datetime_to_us(since) if since is not None else None,
+                                datetime_to_us(until) if until is not None else None, symbol)
+    
+    @synchronized
+    def volume_weighted_by_symbol(self, since=None, until=None):
+        """ Sums of ``price * qty`` and ``qty`` per stock symbol over transactions
+            in time range - grouped in a single pass.
+        
+        Returns
+        -------
+        sums : dict
+            stock symbol => (sum of price * qty, sum of qty), for symbols traded.
+            
+        """
+        
+        rows = self.select(since, until)
+        codes = self._columns['symbol'][rows]
+        qty = self._columns['qty'][rows].astype(np.float64)
+        
+        n = len(self.symbols)
+        price_qty_sums = np.bincount(codes, weights=self._columns['price'][rows] * qty, minlength=n)
+        qty_sums = np.bincount(codes, weights=qty, minlength=n)
+        
+        if len(self.bars):
+            bars = self._bars(since, until)
+            codes = self.bars.column('symbol')[bars]
+            price_qty_sums += np.bincount(codes, weights=self.bars.column('price_qty')[bars],
+                                          minlength=n)
+            qty_sums += np.bincount(codes, weights=self.bars.column('qty')[bars], minlength=n)
+        
+        return dict((self.symbols.decode(code), (float(price_qty_sums[code]), int(qty_sums[code]))) \
+                    for code in np.flatnonzero(qty_sums))
+    
 class Store(MutableMapping):
     """ Store - In-memory store for Super Simple Stock Market.
     
@@ -21,7 +1107,7 @@ class Store(MutableMapping):
     
     """
     
-    def __init__(self, stocks=None, shares_trading=None):
+    def __init__(self, stocks=None, shares_trading=None, journal=None, node=0):
         """ In-memory store setup.
         
         Parameters
@@ -30,23 +1116,38 @@ class Store(MutableMapping):
             array of stock symbols
         shares_trading : dict
             Record mapper for shares trading
+        journal : Journal
+            journal of changes - replayed into store, then recorded to.
+        node : int
+            node (0-15) of ``transaction_ids`` - generating ids of saved
+            transactions. Stores whose transactions are combined need
+            distinct nodes.
             
         """
         
-        if stocks and type(stocks) == dict:
+        if stocks is not None and type(stocks) == dict:
             self.stocks = stocks
         else:
-            self.stocks = data.STOCKS
+            self.stocks = copy.deepcopy(data.STOCKS)
             
         if shares_trading and type(shares_trading) == dict:
             self.shares_trading = shares_trading
         else:
-            self.shares_trading = data.SHARES_TRADING
+            self.shares_trading = dict(data.SHARES_TRADING)
             
         self.data = dict()
         self.keys = set()
+        
+        # bumped on every change to prices, shares trading or trades
+        self._versions = itertools.count(1)
+        self.version = 0
         self.transactions = {}
+        self.transaction_ids = MonotonicIds(node)
+        self.journal = None
         self.initialise_store()
+        
+        if journal is not None:
+            self.open_journal(journal)
     
     def initialise_store(self):
         """ Store initialiser - sets up Super Simple Stock Market data in
@@ -54,9 +1155,16 @@ class Store(MutableMapping):
         
         """
         
-        self.transactions = {}
+        self.transactions = TransactionLog()
+        self.transactions.ids = self.transaction_ids
         self.traders = {}
+        self.sessions = TraderSessions(self.traders)
         self.portfolio = {}
+        self.share_index = AllShareIndex()
+        
+        for symbol, stock in self.stocks.items():
+            self.share_index.update(symbol, stock['Price'], 
+                                    self.shares_trading.get(symbol, 0) > 0)
         
         self.data['stocks'] = self.stocks
         self.data['transactions'] = self.transactions
@@ -64,6 +1172,35 @@ class Store(MutableMapping):
         self.data['shares_trading'] = self.shares_trading
         self.data['traders'] = self.traders
             
+    def open_journal(self, journal, offset=0):
+        """ Replay ``journal`` from ``offset`` into store, then record
+            further changes to it.
+        
+        """
+        
+        end = journal.replay(self, offset)
+        journal.open(end)
+        
+        self.journal = self.data['transactions'].journal = journal
+        self.advance_transaction_ids()
+        
+    def advance_transaction_ids(self):
+        """ Ensure ids of new transactions are greater than those stored. """
+        
+        last = self.data['transactions'].max_id()
+        
+        if last is not None:
+            self.transaction_ids.advance(last)
+        
+    @property
+    def symbols(self):
+        """ Stock symbols registry - the stocks mapping itself, looked up live so stocks
+            written straight into ``store['stocks']`` are registered too.
+            
+        """
+        
+        return self.data['stocks']
+    
     def __setitem__(self, key, value):
         raise ValueError("Super Simple Stock Market Store does not support addition of new items.")
         
@@ -86,24 +1223,11 @@ class Store(MutableMapping):
         if not isinstance(key, str):
             raise IndexError("Store: Invalid key type specified.")
         
-        if key not in data.COLLECTIONS:
+        try:
+            return self.data[key]
+        except KeyError:
             raise KeyError("Store: [ERROR] Collection {} does not exist.".format(key))
         
-        if key is "traders":
-            return self.data["traders"]
-
-        if key is "transactions":
-            return self.data["transactions"]
-        
-        if key is "shares_trading":
-            return self.data["shares_trading"]
-        
-        if key is "portfolio":
-            return self.data["portfolio"]
-        
-        if key is "stocks":
-            return self.data["stocks"]
-        
     def __len__(self):
         return len(self.data)
 
@@ -116,9 +1240,235 @@ class Store(MutableMapping):
     def get_traders(self):
         return self.data['traders'].keys()
 
+    def save_snapshot(self, path):
+        """ Save point-in-time snapshot of store to directory ``path`` - 
+            replacing any snapshot there.
+            
+            Transactions are saved column by column (see ``TransactionLog.save``),
+            other collections as JSON. With a journal, the snapshot records
+            the journal offset it's consistent with. Changes made while the
+            snapshot is taken may be in it and also after that offset -
+            replaying them again over the snapshot doesn't change it. Trades
+            should be paused meanwhile - see ``Platform.save_snapshot``.
+            
+        """
+        
+        offset = self.journal.sync() if self.journal is not None else 0
+        
+        tmp = path + '.tmp'
+        
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+            
+        os.makedirs(tmp)
+        
+        meta = {
+            'journal_offset': offset,
+            'stocks': copy.deepcopy(self.data['stocks']),
+            'shares_trading': dict(self.data['shares_trading']),
+            'traders': [{
+                    'id': trader['id'],
+                    'token': str(trader['token']),
+                    'created': datetime_to_us(trader['created']) if trader.get('created') else -1,
+                    'portfolio': [dict(position) for position in trader['portfolio']]
+                } for trader in list(self.data['traders'].values())],
+            'transactions': self.data['transactions'].save(tmp)
+        }
+        
+        with open(os.path.join(tmp, 'store.json'), 'w') as f:
+            json.dump(meta, f)
+            
+        # swap in new snapshot
+        if os.path.exists(path):
+            old = path + '.old'
+            os.rename(path, old)
+            os.rename(tmp, path)
+            shutil.rmtree(old)
+        else:
+            os.rename(tmp, path)
+    
+    @classmethod
+    def load_snapshot(cls, path, journal=None):
+        """ Store loaded from snapshot saved to directory ``path`` - with the
+            tail of ``journal`` after the snapshot replayed, if given.
+            
+            Transactions are memory-mapped (see ``TransactionLog.load``) so
+            the store is queryable without reading them all in.
+            
+        """
+        
+        from sssm.backend.models import Portfolio
+        
+        with open(os.path.join(path, 'store.json')) as f:
+            meta = json.load(f)
+            
+        store = cls(stocks=meta['stocks'], shares_trading=meta['shares_trading'])
+        
+        for trader in meta['traders']:
+            store.data['traders'][trader['id']] = {
+                'id': trader['id'],
+                'token': trader['token'],
+                '_type': 'User',
+                'created': us_to_datetime(trader['created']) if trader['created'] >= 0 else None,
+                'portfolio': Portfolio(trader['portfolio'])
+            }
+            
+        store.transactions = store.data['transactions'] = \
+            TransactionLog.load(path, meta['transactions'])
+        store.transactions.ids = store.transaction_ids
+        
+        if journal is not None:
+            store.open_journal(journal, offset=meta['journal_offset'])
+        else:
+            store.advance_transaction_ids()
+            
+        return store
+        
+    def save_trader(self, record):
+        """ Save trader ``record`` - keyed by its ``id``. """
+        
+        self.data['traders'][record['id']] = record
+        
+        if self.journal is not None:
+            self.journal.trader(record)
+            
     def get_transactions(self):
         return self.data['transactions'].keys()
     
+    def compact(self, horizon, bucket=60, bar_horizon=None, bar_bucket=3600, time_ref=None):
+        """ Retention - compact transactions older than ``horizon`` mins
+            into per stock bars of ``bucket`` secs, evicting them (see
+            ``TransactionLog.compact``). Bars older than ``bar_horizon``
+            mins, if given, are merged into bars of ``bar_bucket`` secs.
+            
+        Parameters
+        ----------
+        time_ref : datetime.datetime
+            time horizons are counted back from - defaults to now.
+            
+        Returns
+        -------
+        compacted : int
+            number of transactions compacted.
+            
+        """
+        
+        if horizon <= 0 or bucket <= 0 or bar_bucket <= 0:
+            raise ValueError("[ERROR] Store: Retention horizon and buckets must be positive.")
+        
+        now = datetime_to_us(time_ref if time_ref else datetime.now())
+        log = self.data['transactions']
+        
+        # horizons fall on bucket boundaries - so buckets aren't split
+        width = int(bucket * 1e6)
+        compacted = log.compact(us_to_datetime((now - int(horizon * 60e6)) // width * width),
+                                bucket)
+        
+        if bar_horizon is not None:
+            width = int(bar_bucket * 1e6)
+            log.compact_bars(us_to_datetime((now - int(bar_horizon * 60e6)) // width * width),
+                             bar_bucket)
+            
+        if compacted:
+            self.bump_version()
+            
+        return compacted
+    
+    def find_transactions(self, since, until=None, symbol=None):
+        """ Find transactions which occured within time range (``since``, ``until``].
+        
+        Parameters
+        ----------
+        since : datetime.datetime
+            exclusive lower bound of trade time.
+        until : datetime.datetime
+            inclusive upper bound of trade time - open ended if not given.
+        symbol : str
+            restrict search to trades of given stock symbol.
+            
+        Returns
+        -------
+        txn_ids : list
+            Ids of stored transactions in time order.
+            
+        """
+        
+        return self.data['transactions'].find(since, until=until, symbol=symbol)
+    
+    def add_stock(self, symbol, stock_type="Common", last_dividend=0, 
+                  fixed_dividend="NA", par_value=100, price=-1.0, shares_trading=0):
+        """ Add new stock ``symbol`` to store.
+        
+        Parameters
+        ----------
+        symbol : str
+            stock symbol.
+        stock_type : str
+            ``Common`` or ``Preferred``.
+        shares_trading : int
+            quantity of stock trading.
+            
+        """
+        
+        if symbol in self.data['stocks']:
+            raise ValueError("Store: [ERROR] Stock {} already exists.".format(symbol))
+        
+        self.data['stocks'][symbol] = {
+            "Symbol": symbol, "Type": stock_type,
+            "Last_Dividend": last_dividend, "Fixed_Dividend": fixed_dividend,
+            "Par_Value": par_value, "Price": price
+        }
+        self.data['shares_trading'][symbol] = shares_trading
+        self.share_index.update(symbol, price, shares_trading > 0)
+        
+        if self.journal is not None:
+            self.journal.stock(self.data['stocks'][symbol], shares_trading)
+        
+    def set_price(self, symbol, price):
+        """ Set current price of stock ``symbol`` - keeping all share index up to date.
+        
+        """
+        
+        self.data['stocks'][symbol]['Price'] = price
+        self.share_index.update(symbol, price, self.data['shares_trading'].get(symbol, 0) > 0)
+        
+        if self.journal is not None:
+            self.journal.price(symbol, price)
+            
+        self.bump_version()
+        
+    def set_shares_trading(self, symbol, qty):
+        """ Set quantity of stock ``symbol`` trading - keeping all share index up to date.
+        
+        """
+        
+        shares_trading = self.data['shares_trading']
+        was_trading = shares_trading.get(symbol, 0) > 0
+        
+        shares_trading[symbol] = qty
+        
+        if was_trading != (qty > 0):
+            self.share_index.update(symbol, self.data['stocks'][symbol]['Price'], qty > 0)
+            
+        if self.journal is not None:
+            self.journal.shares(symbol, qty)
+            
+        self.bump_version()
+        
+    def bump_version(self):
+        """ Mark store as changed - readers caching results compare ``Store.version``.
+        
+        """
+        
+        self.version = next(self._versions)
+            
+    def all_share_index(self):
+        """ All share index - geometric mean of prices of stocks trading.
+        
+        """
+        
+        return self.share_index.value()
+    
     def get_shares_trading(self):
         shares_trading = list()
         
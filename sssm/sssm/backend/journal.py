@@ -0,0 +1,367 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+import numbers
+import os
+import struct
+from threading import Event, Lock, Thread
+import zlib
+
+import numpy as np
+
+from sssm.backend.models import Portfolio
+from sssm.backend.util import datetime_to_us, us_to_datetime
+
+class Journal(object):
+    """ Append-only write-ahead journal of store changes.
+        
+        A store opened with a journal writes each change - trade recorded or
+        deleted, trader saved, stock added, price or shares trading set - as
+        a compact binary record, and replays the journal to rebuild itself
+        when opened again. Positions aren't journaled: replaying trades
+        moves the positions of the traders who made them.
+        
+        Records are buffered and committed in groups: written and fsync'ed
+        once ``sync_every`` records are pending, or ``sync_interval`` secs
+        after the first of them, by a background thread. So a change is
+        durable at most ``sync_interval`` secs after it's made - ``sync``
+        makes pending changes durable at once.
+        
+        Each record is a header - kind, payload length and CRC-32 of
+        payload - followed by its payload. Replay stops at a torn or corrupt
+        record (e.g. a crash mid-write), which is truncated away. Integer
+        transaction ids are written as 8 bytes, others as text.
+    
+    Examples
+    --------
+    >>> from sssm.backend import Store, Journal
+    >>> s = Store(journal=Journal('sssm.journal'))
+    >>> s.set_price('TEA', 12.0)
+    >>> s.journal.close()
+    >>> Store(journal=Journal('sssm.journal'))['stocks']['TEA']['Price']
+    12.0
+    
+    """
+    
+    TRADE, DELETE, TRADER, STOCK, PRICE, SHARES = range(1, 7)
+    
+    HEADER = struct.Struct('<BII')
+    TRADE_FIELDS = struct.Struct('<qqdb')
+    LENGTH = struct.Struct('<H')
+    INT = struct.Struct('<q')
+    FLOAT = struct.Struct('<d')
+    
+    TYPES = ('BUY', 'SELL')
+    
+    # text length marking None - or an integer id following
+    NONE = 0xFFFF
+    INT_ID = 0xFFFE
+    
+    def __init__(self, path, sync_every=1000, sync_interval=0.05):
+        self.path = path
+        self.syncs = 0
+        
+        self._sync_every = sync_every
+        self._sync_interval = sync_interval
+        self._file = None
+        self._buffer = []
+        self._pending = 0
+        self._lock = Lock()
+        
+        # serialises writes to file - records are buffered meanwhile
+        self._io_lock = Lock()
+        self._wake = Event()
+        self._closed = Event()
+        self._thread = None
+    
+    def open(self, offset=None):
+        """ Open journal for appending - after record ending at ``offset``,
+            discarding anything beyond it (a torn record).
+        
+        """
+        
+        if self._file is not None:
+            raise ValueError("[ERROR] Journal: Already open.")
+        
+        self._file = open(self.path, 'ab')
+        
+        if offset is not None and os.path.getsize(self.path) > offset:
+            self._file.truncate(offset)
+            
+        # at end - truncating doesn't move the position reported as synced offset
+        self._file.seek(0, os.SEEK_END)
+        
+        self._closed.clear()
+        self._thread = Thread(target=self._run, name="Journal")
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def close(self):
+        """ Make pending changes durable and close journal. """
+        
+        if self._file is None:
+            return
+        
+        self._closed.set()
+        self._wake.set()
+        self._thread.join()
+        
+        self.sync()
+        self._file.close()
+        self._file = None
+    
+    @property
+    def pending(self):
+        """ Number of records not yet durable. """
+        
+        return self._pending
+    
+    def sync(self):
+        """ Write and fsync pending records.
+        
+        Returns
+        -------
+        offset : int
+            offset of end of records durable.
+            
+        """
+        
+        with self._io_lock:
+            with self._lock:
+                records, self._buffer = self._buffer, []
+                self._pending = 0
+            
+            if records:
+                self._file.write(b''.join(records))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                
+                self.syncs += 1
+                
+            return self._file.tell()
+    
+    def _run(self):
+        while True:
+            self._wake.wait()
+            
+            # group records arriving within interval
+            self._closed.wait(self._sync_interval)
+            self._wake.clear()
+            
+            if self._closed.is_set():
+                return
+            
+            self.sync()
+    
+    def _write(self, records):
+        with self._lock:
+            self._buffer.extend(records)
+            self._pending += len(records)
+            
+            pending = self._pending
+        
+        if pending >= self._sync_every:
+            self.sync()
+        elif pending == len(records):
+            # first of group
+            self._wake.set()
+    
+    def _record(self, kind, payload):
+        return self.HEADER.pack(kind, len(payload), zlib.crc32(payload) & 0xFFFFFFFF) + payload
+    
+    def _text(self, value):
+        if value is None:
+            return self.LENGTH.pack(self.NONE)
+        
+        data = value if isinstance(value, bytes) else value.encode('utf-8')
+        
+        return self.LENGTH.pack(len(data)) + data
+    
+    def _id(self, value):
+        if isinstance(value, numbers.Integral):
+            return self.LENGTH.pack(self.INT_ID) + self.INT.pack(value)
+        
+        return self._text(value)
+    
+    # records of store changes
+    
+    def trades(self, txn_ids, timestamps, symbols, qtys, prices, trade_types, traders):
+        """ Journal transactions - ``timestamps`` in microseconds since epoch,
+            ``trade_types`` indices of ``Journal.TYPES``.
+        
+        """
+        
+        pack, text, txn_id_, record = self.TRADE_FIELDS.pack, self._text, self._id, self._record
+        
+        self._write([record(self.TRADE, pack(int(ts), int(qty), float(price), int(trade_type)) \
+                                        + txn_id_(txn_id) + text(symbol) + text(trader))
+                     for txn_id, ts, symbol, qty, price, trade_type, trader in \
+                     zip(txn_ids, timestamps, symbols, qtys, prices, trade_types, traders)])
+    
+    def delete(self, txn_id):
+        self._write([self._record(self.DELETE, self._id(txn_id))])
+    
+    def trader(self, record):
+        created = record.get('created')
+        created = datetime_to_us(created) if created else -1
+        portfolio = json.dumps([dict(position) for position in record.get('portfolio') or []])
+        
+        self._write([self._record(self.TRADER, self._text(record['id']) \
+                                  + self._text(str(record.get('token'))) \
+                                  + self.INT.pack(created) + self._text(portfolio))])
+    
+    def stock(self, stock, shares_trading):
+        self._write([self._record(self.STOCK, self._text(json.dumps(stock)) \
+                                  + self.INT.pack(shares_trading))])
+    
+    def price(self, symbol, price):
+        self._write([self._record(self.PRICE, self._text(symbol) + self.FLOAT.pack(price))])
+    
+    def shares(self, symbol, qty):
+        self._write([self._record(self.SHARES, self._text(symbol) + self.INT.pack(qty))])
+    
+    # replay
+    
+    def records(self, offset=0):
+        """ Records from ``offset`` on - as ``(kind, payload, end offset)``. """
+        
+        if not os.path.exists(self.path):
+            return
+        
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        
+        header = self.HEADER
+        pos = 0
+        
+        while pos + header.size <= len(data):
+            kind, length, crc = header.unpack_from(data, pos)
+            start = pos + header.size
+            payload = data[start:start + length]
+            
+            if len(payload) < length or zlib.crc32(payload) & 0xFFFFFFFF != crc:
+                # torn record
+                return
+            
+            pos = start + length
+            
+            yield kind, payload, offset + pos
+    
+    def _texts(self, payload, pos, n):
+        texts = []
+        
+        for i in range(n):
+            length, = self.LENGTH.unpack_from(payload, pos)
+            pos += self.LENGTH.size
+            
+            if length == self.NONE:
+                texts.append(None)
+            elif length == self.INT_ID:
+                texts.append(self.INT.unpack_from(payload, pos)[0])
+                pos += self.INT.size
+            else:
+                texts.append(payload[pos:pos + length].decode('utf-8'))
+                pos += length
+        
+        return texts, pos
+    
+    def replay(self, store, offset=0, batch_size=100000):
+        """ Apply records from ``offset`` on to ``store``.
+        
+        Returns
+        -------
+        offset : int
+            offset of end of last record replayed.
+        
+        """
+        
+        log = store['transactions']
+        traders = store['traders']
+        columns = [[] for i in range(7)]
+        
+        # integer ids past those stored before replay (e.g. in snapshot) aren't stored
+        last = log.max_id()
+        
+        def flush():
+            if columns[0]:
+                timestamps = np.array(columns[1], dtype='datetime64[us]')
+                log.extend(columns[0], timestamps, *columns[2:])
+                
+                for column in columns:
+                    del column[:]
+        
+        end = offset
+        
+        for kind, payload, end in self.records(offset):
+            if kind == self.TRADE:
+                ts, qty, price, trade_type = self.TRADE_FIELDS.unpack_from(payload)
+                (txn_id, symbol, trader), _ = self._texts(payload, self.TRADE_FIELDS.size, 3)
+                trade_type = self.TYPES[trade_type]
+                
+                for column, value in zip(columns, (txn_id, ts, symbol, qty, price, trade_type, trader)):
+                    column.append(value)
+                
+                # positions move with trades - unless already recorded (in snapshot)
+                if isinstance(txn_id, numbers.Integral):
+                    stored = last is not None and txn_id <= last and txn_id in log
+                else:
+                    stored = txn_id in log
+                
+                record = traders.get(trader) if not stored else None
+                
+                if record is not None:
+                    try:
+                        if trade_type == 'BUY':
+                            record['portfolio'].buy(symbol, qty, price)
+                        else:
+                            record['portfolio'].sell(symbol, qty)
+                    except ValueError:
+                        # trade recorded without holding position
+                        pass
+                
+                if len(columns[0]) >= batch_size:
+                    flush()
+                
+                continue
+            
+            flush()
+            
+            if kind == self.DELETE:
+                (txn_id,), _ = self._texts(payload, 0, 1)
+                
+                if txn_id in log:
+                    del log[txn_id]
+            elif kind == self.TRADER:
+                (trader, token), pos = self._texts(payload, 0, 2)
+                created, = self.INT.unpack_from(payload, pos)
+                (portfolio,), _ = self._texts(payload, pos + self.INT.size, 1)
+                
+                traders[trader] = {
+                    'id': trader,
+                    'token': token,
+                    '_type': 'User',
+                    'created': us_to_datetime(created) if created >= 0 else None,
+                    'portfolio': Portfolio(json.loads(portfolio))
+                }
+            elif kind == self.STOCK:
+                (stock,), pos = self._texts(payload, 0, 1)
+                shares_trading, = self.INT.unpack_from(payload, pos)
+                stock = json.loads(stock)
+                
+                if stock['Symbol'] not in store['stocks']:
+                    store.add_stock(stock['Symbol'], stock_type=stock['Type'],
+                                    last_dividend=stock['Last_Dividend'],
+                                    fixed_dividend=stock['Fixed_Dividend'],
+                                    par_value=stock['Par_Value'], price=stock['Price'],
+                                    shares_trading=shares_trading)
+            elif kind == self.PRICE:
+                (symbol,), pos = self._texts(payload, 0, 1)
+                store.set_price(symbol, self.FLOAT.unpack_from(payload, pos)[0])
+            elif kind == self.SHARES:
+                (symbol,), pos = self._texts(payload, 0, 1)
+                store.set_shares_trading(symbol, self.INT.unpack_from(payload, pos)[0])
+        
+        flush()
+        
+        return end
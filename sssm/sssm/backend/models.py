@@ -1,6 +1,7 @@
 from __future__ import absolute_import, division, print_function
 
 import abc
+from collections import OrderedDict, Sequence
 from datetime import datetime
 from functools import wraps
 from sssm.backend import Store
@@ -26,6 +27,8 @@ class Shares_Trading(object):
     
     
     """
+    
+    __slots__ = ('_store',)
 
     def __init__(self, store=None):
         self._store = store if store else Store()
@@ -63,8 +66,8 @@ class Shares_Trading(object):
         >>> st.buy(stock, qty)
 
         """
-        self._store['shares_trading'][symbol] = \
-            self._store['shares_trading'][symbol] - qty
+        self._store.set_shares_trading(symbol, 
+            self._store['shares_trading'][symbol] - qty)
             
     def sell(self, symbol, qty):
         """
@@ -92,8 +95,8 @@ class Shares_Trading(object):
 
         """
         
-        self._store['shares_trading'][symbol] = \
-            self._store['shares_trading'][symbol] + qty
+        self._store.set_shares_trading(symbol, 
+            self._store['shares_trading'][symbol] + qty)
         
     def get_qty(self, symbol):
         """
@@ -121,6 +124,158 @@ class Shares_Trading(object):
         """
         return self._store['shares_trading'][symbol]
     
+class Position(object):
+    """ Trader's position in a stock - a compact record, read and compared
+        like the ``{'symbol', 'qty', 'price'}`` dictionary it replaces.
+        
+    Examples
+    --------
+    >>> from sssm.backend.models import Position
+    >>> position = Position('TEA', 100, 15.0)
+    >>> position['qty'] += 20
+    >>> position == {'symbol': 'TEA', 'qty': 120, 'price': 15.0}
+    True
+    
+    """
+    
+    __slots__ = ('symbol', 'qty', 'price')
+    
+    def __init__(self, symbol, qty, price):
+        self.symbol = symbol
+        self.qty = qty
+        self.price = price
+        
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        
+        return getattr(self, key)
+    
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        
+        setattr(self, key, value)
+        
+    def keys(self):
+        return list(self.__slots__)
+    
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+    
+    def __eq__(self, other):
+        if isinstance(other, (dict, Position)):
+            return dict(self) == dict(other)
+        
+        return NotImplemented
+    
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        
+        return equal if equal is NotImplemented else not equal
+    
+    __hash__ = None
+    
+    def __repr__(self):
+        return "{{'symbol': {!r}, 'qty': {!r}, 'price': {!r}}}".format(self.symbol, self.qty,
+                                                                   self.price)
+    
+class Portfolio(Sequence):
+    """ Trader's stock positions keyed by stock symbol.
+    
+        Positions are looked up and updated in constant time. It reads as
+        a list of position records - ``Position``, each read like a
+        ``{'symbol', 'qty', 'price'}`` dictionary.
+        
+    Examples
+    --------
+    >>> from sssm.backend import Portfolio
+    >>> portfolio = Portfolio()
+    >>> portfolio.buy('TEA', 100, 15.0)
+    >>> portfolio.sell('TEA', 40)
+    >>> portfolio.qty('TEA')
+    60
+    >>> portfolio
+    [{'symbol': 'TEA', 'qty': 60, 'price': 15.0}]
+    
+    """
+    
+    __slots__ = ('_positions',)
+    
+    def __init__(self, positions=None):
+        self._positions = OrderedDict()
+        
+        for record in positions if positions else []:
+            self.append(record)
+            
+    def __getitem__(self, idx):
+        return list(self._positions.values())[idx]
+    
+    def __len__(self):
+        return len(self._positions)
+    
+    def __iter__(self):
+        return iter(self._positions.values())
+    
+    def __eq__(self, other):
+        if isinstance(other, (list, Portfolio)):
+            return list(self) == list(other)
+        
+        return NotImplemented
+    
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        
+        return equal if equal is NotImplemented else not equal
+    
+    __hash__ = None
+    
+    def __repr__(self):
+        return repr(list(self))
+    
+    def append(self, record):
+        """ Add position ``record`` - replacing any position in the same stock. """
+        
+        if not isinstance(record, Position):
+            record = Position(record['symbol'], record['qty'], record['price'])
+            
+        self._positions[record.symbol] = record
+        
+    def get(self, symbol):
+        """ Position record for stock ``symbol`` or None if trader doesn't hold it. """
+        
+        return self._positions.get(symbol)
+    
+    def qty(self, symbol):
+        """ Quantity of stock ``symbol`` held. """
+        
+        record = self._positions.get(symbol)
+        
+        return record.qty if record else 0
+    
+    def buy(self, symbol, qty, price):
+        """ Add ``qty`` of stock ``symbol`` to position - opened at ``price`` if new. """
+        
+        record = self._positions.get(symbol)
+        
+        if record:
+            record.qty += qty
+        else:
+            self._positions[symbol] = Position(symbol, qty, price)
+            
+    def sell(self, symbol, qty):
+        """ Take ``qty`` of stock ``symbol`` off position. """
+        
+        record = self._positions.get(symbol)
+        
+        if not record:
+            raise ValueError("[ERROR] Portfolio: Stock {} isn't held.".format(symbol))
+        
+        if record.qty < qty:
+            raise ValueError("[ERROR] Portfolio: Insufficient qty for stock {}.".format(symbol))
+        
+        record.qty -= qty
+    
 class Trader(object):
     """ Record mapper and data access class for users.
     
@@ -135,6 +290,8 @@ class Trader(object):
     
     """
     
+    __slots__ = ('_id', '_token', '_store', '_created', '_portfolio', '_updated', '_record')
+    
     def __init__(self, trader_id, store=None, token=None, 
                  created=None, portfolio=None):
     
@@ -145,7 +302,7 @@ class Trader(object):
         self._token = token if token else uuid.uuid4() 
         self._store = store if store else Store()
         self._created = created if created else datetime.now()
-        self._portfolio = portfolio if portfolio else []
+        self._portfolio = portfolio if isinstance(portfolio, Portfolio) else Portfolio(portfolio)
         self._updated = False
         
     @property    
@@ -154,7 +311,7 @@ class Trader(object):
     
     @portfolio.setter
     def portfolio(self, portfolio):
-        self._portfolio = portfolio
+        self._portfolio = portfolio if isinstance(portfolio, Portfolio) else Portfolio(portfolio)
         self._updated = True
         
     @property    
@@ -203,7 +360,7 @@ class Trader(object):
                 'portfolio': self._portfolio
             }
         
-        self._store['traders'][self._id] = self._record
+        self._store.save_trader(self._record)
         
         return self._token
     
@@ -249,8 +406,13 @@ class Transaction(object):
         
     """
     
+    __slots__ = ('_store', '_stock', '_qty', '_price', '_timestamp', '_trade_type', '_user',
+                 '_transaction_id', '_value', '_record')
+    
+    TYPES = ('BUY', 'SELL')
+    
     def __init__(self, stock, qty, price, 
-                 timestamp=datetime.now(), user=None,
+                 timestamp=None, user=None,
                  store=None, trade_type="BUY", txn_id=None):
     
         self._store = store if store else Store()
@@ -261,7 +423,7 @@ class Transaction(object):
             self._stock = stock
             self._qty = qty
             self._price = price if price else self._store['stocks'][self._stock]['Price']
-            self._timestamp = timestamp
+            self._timestamp = timestamp if timestamp is not None else datetime.now()
             self._trade_type = trade_type
             self._user = user
             
@@ -326,40 +488,21 @@ class Transaction(object):
         
         Returns
         -------
-        transaction_id : UUID
-            ID associated with current/saved transaction.
+        transaction_id : int
+            ID associated with current/saved transaction - see ``MonotonicIds``.
             
         """
         
         if self._user not in self._store.get_traders():
             raise ValueError("[ERROR] Transaction: User {} doesn't exist.".format(self._user))
         
-        
-        self._transaction_id = str(uuid.uuid3(
-                                        uuid.NAMESPACE_DNS,
-                                         str(self._timestamp) \
-                                         + self._trade_type  \
-                                         + str(self._price) \
-                                         + self._user \
-                                         + self._stock \
-                                         + str(self._qty) 
-                              ))
-            
         self._value = self._qty * self._price
         
-        #logging.debug('[INFO] Model: Recording trade {}'.format(self._transaction_id))
-        
-        self._record = {
-                'trader': self._user,
-                'id': self._transaction_id,
-                'type': self._trade_type,
-                'ts':  self._timestamp,
-                'symbol' : self._stock,
-                'volume' : self._qty,
-                'value': self._value,
-                'per_price': self._price
-               }
-        self._store['transactions'][self._transaction_id] = self._record
+        # straight into transaction log's columns - no record built, id allocated as
+        # it's appended
+        self._transaction_id = self._store['transactions'].append(
+            None, self._timestamp, self._stock, self._qty, self._price, self._trade_type, 
+            self._user)
         
         return self._transaction_id
     
@@ -387,13 +530,17 @@ class Transaction(object):
         self._value = record['value']
         self._price = record['per_price']
     
-    def find(self, timestamp=None):
+    def find(self, timestamp=None, until=None, symbol=None):
         """ Search / find transactions that occured at a later time than specified datetime.
         
         Parameter
         ---------
         timestamp : datetime.datetime
             Time of transaction.
+        until : datetime.datetime
+            Upper bound (inclusive) of transaction time. Open ended if not given.
+        symbol : str
+            Restrict search to transactions of given stock symbol.
             
         Returns
         -------
@@ -402,16 +549,10 @@ class Transaction(object):
             
         """
         
-        txn_ids = []
-        
         if not timestamp:
             raise ValueError("[ERROR] Transaction: Search time must be provided.")
         
-        for id, txn in self._store['transactions'].items():
-            if txn['ts'] > timestamp:
-                txn_ids.append(id)
-        
-        return txn_ids
+        return self._store.find_transactions(timestamp, until=until, symbol=symbol)
             
 class Stock(object):
     __metaclass__ = abc.ABCMeta
@@ -422,36 +563,46 @@ class Stock(object):
     See implementation examples.
     """
     
+    __slots__ = ('store',)
+    
     def __init__(self, store=None):
         if store:
             self.store = store
         else:
             self.store = Store()
         
+    def _stock(self, symbol):
+        """ Stock record of ``symbol`` - unvalidated, for use once validated. """
+        
+        return self.store.data['stocks'][symbol]
+        
     @validate_stock('')
     def get_current_price(self, symbol):
-        stock = self.store['stocks'][symbol]
-        return stock['Price']
+        return self._stock(symbol)['Price']
     
     @validate_stock('')
     def set_current_price(self, symbol, price):
-        self.store['stocks'][symbol]['Price'] = price
+        self.store.set_price(symbol, price)
     
     @validate_stock('')
     def get_last_dividend(self, symbol):
-        return self.store['stocks'][symbol]['Last_Dividend']
+        return self._stock(symbol)['Last_Dividend']
     
     @validate_stock('')
     def get_par_value(self, symbol):
-        return self.store['stocks'][symbol]['Par_Value']
+        return self._stock(symbol)['Par_Value']
 
+    @validate_stock('')
+    def dividend_yield(self, symbol, price):
+        return self._dividend_yield(symbol, price)
+        
     @abc.abstractmethod
-    def dividend_yield(self, symbol):
+    def _dividend_yield(self, symbol, price):
         raise NotImplementedError("[ERROR] Stock: Dividend Yield is not implemented.")
         
     @validate_stock('')
     def pe_ratio(self, symbol, price):
-        return price / self.dividend_yield(symbol, price)
+        return price / self._dividend_yield(symbol, price)
     
 class CommonStock(Stock):
     """ A Common Stock model - Record mapper and data access class for common stocks.
@@ -466,14 +617,14 @@ class CommonStock(Stock):
     -1.0
     """
     
+    __slots__ = ()
+    
     def __init__(self, *args, **kwargs):
         super(CommonStock, self).__init__(*args, **kwargs)
         
-    @validate_stock('')
-    def dividend_yield(self, symbol, price):
+    def _dividend_yield(self, symbol, price):
         
-        ld = self.get_last_dividend(symbol)
-        self.get_current_price(symbol)
+        ld = self._stock(symbol)['Last_Dividend']
         
         return ld / price
     
@@ -490,6 +641,8 @@ class PreferredStock(Stock):
     -1.0
     """
     
+    __slots__ = ()
+    
     def __init__(self, *args, **kwargs):
         super(PreferredStock, self).__init__(*args, **kwargs)
     
@@ -498,16 +651,12 @@ class PreferredStock(Stock):
         """ Retrive fixed dividend for preferred stock specified.
         
         """
-        return self.store['stocks'][symbol]['Fixed_Dividend']
+        return self._stock(symbol)['Fixed_Dividend']
     
-    @validate_stock('')
-    def dividend_yield(self, symbol, price):
+    def _dividend_yield(self, symbol, price):
         """ Compute dividend yield for preferred stock specified.
         
         """
-        fd = self.get_fixed_dividend(symbol)
-        par_value = self.get_par_value(symbol)
-
-        self.get_current_price(symbol)
+        stock = self._stock(symbol)
         
-        return fd * par_value / price
\ No newline at end of file
+        return stock['Fixed_Dividend'] * stock['Par_Value'] / price
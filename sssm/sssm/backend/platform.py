@@ -1,12 +1,11 @@
 from __future__ import absolute_import, division, print_function
 
 import logging
+import numbers
 from datetime import datetime
 from datetime import timedelta
-from threading import Lock
 from functools import wraps
 import uuid
-import random
 
 from sssm.backend import (
     Store, 
@@ -14,10 +13,14 @@ from sssm.backend import (
     PreferredStock, 
     Trader, 
     Transaction, 
-    Shares_Trading
+    Portfolio,
+    Shares_Trading,
+    RollingVWSP,
+    BarBuilder,
+    Sequencer
 )
 
-from sssm.backend.util import validate_stock
+from sssm.backend.util import validate_stock, KeyedLocks, datetime_to_us, us_to_datetime
 
 logging.basicConfig(level=logging.DEBUG,
                     format='(%(threadName)-10s) %(message)s',
@@ -27,10 +30,16 @@ class Platform():
     """ Trading platform for traders. It simulates ~30mins of trade
         using the Platform.simulate() method for testing.
         
+        Trades may be conducted concurrently (e.g. from a thread pool). A
+        trade holds the lock of its trader - guarding portfolio - and then
+        of its stock - guarding shares trading and price - so trades of
+        different traders and stocks proceed in parallel.
+        
     """
     
     def __init__(self, store=None, p_stock_orm=None, 
-                    c_stock_orm=None, shares_trading_orm=None):
+                    c_stock_orm=None, shares_trading_orm=None, vwsp_window=15,
+                    bar_resolutions=None):
         
         if store:
             self._store = store
@@ -40,51 +49,248 @@ class Platform():
         self._common_stock = c_stock_orm if c_stock_orm else CommonStock(store=self._store)
         self._preferred_stock = p_stock_orm if p_stock_orm else PreferredStock(store=self._store)
         self._shares_trading = shares_trading_orm if shares_trading_orm else Shares_Trading(store=self._store)
+        
+        # trader locks are always acquired before stock locks
+        self._trader_locks = KeyedLocks()
+        self._symbol_locks = KeyedLocks()
+        
+        # rolling volume weighted stock price - seeded with trades already in store
+        self._vwsp = RollingVWSP(window=vwsp_window)
+        
+        if len(self._store['transactions']) > 0:
+            now = datetime.now()
+            
+            log = self._store['transactions']
+            rows = log.select(now - timedelta(minutes=vwsp_window))
+            symbols = log.symbols.values
+            
+            self._vwsp.extend(log.column('ts')[rows].astype('datetime64[us]').tolist(),
+                              log.column('price')[rows].tolist(), log.column('qty')[rows].tolist(),
+                              [symbols[code] for code in log.column('symbol')[rows].tolist()])
+                
+            # older trades were not seeded
+            self._vwsp.expire(now)
+            
+        # OHLCV bars - seeded with trades (and bars compacted out of them) within longest
+        # resolution's ring
+        self._bars = BarBuilder(resolutions=bar_resolutions)
+        
+        log = self._store['transactions']
+        
+        if len(log) > 0 or len(log.bars) > 0:
+            since = datetime.now() - timedelta(seconds=self._bars.span)
+            rows = log.select(since - timedelta(microseconds=1))
+            symbols = log.symbols.values
+            
+            self._bars.extend(log.column('ts')[rows].astype('datetime64[us]'),
+                              log.column('price')[rows], log.column('qty')[rows],
+                              [symbols[code] for code in log.column('symbol')[rows].tolist()])
+            
+            bars = log.bars.column('end') > datetime_to_us(since)
+            columns = dict((name, log.bars.column(name)[bars]) \
+                           for name in ('start', 'end', 'symbol', 'count', 'qty', 'price_qty',
+                                        'low', 'high', 'first', 'last'))
+            
+            self._bars.extend_bars(columns['start'], columns['end'],
+                                   [symbols[code] for code in columns['symbol'].tolist()],
+                                   columns['count'], columns['qty'], columns['price_qty'],
+                                   columns['low'], columns['high'], columns['first'],
+                                   columns['last'])
+            
+            # older trades were not seeded
+            self._bars.hold_since(since)
 
-    def simulate(self):
-        base_price = 22.0
-        stocks = ['TEA', 'GIN', 'JOE', 'ALE', 'POP']
-        trade_types = ['SELL', 'BUY']
+    def simulate(self, traders=100, trades=1800, duration=30, symbols=None, 
+                 seed=None, base_price=22.0, max_qty=10000, sell_ratio=0.5,
+                 batch_size=100000):
+        """ Simulate random trading - by default ~30mins of trade by 100
+            traders over the stocks in store.
+            
+            Trades are drawn in bulk with NumPy and recorded through
+            ``Platform.trade_many``, in batches of ``batch_size``.
+        
+        Parameters
+        ----------
+        traders : int
+            number of traders to create.
+        trades : int
+            number of trades to attempt.
+        duration : float
+            trades are evenly spread over the last ``duration`` mins.
+        symbols : int or list
+            stock symbols to trade, or number of stocks to trade. Stocks missing
+            from store are added as common stocks with enough shares trading
+            for all trades. Defaults to all stocks in store.
+        seed : int
+            random seed - for reproducible trades.
+        base_price : float
+            trades are priced within [base_price, base_price + 10).
+        max_qty : int
+            trades are for quantities within [1, max_qty).
+        sell_ratio : float
+            probability of a trade being a SELL.
+        batch_size : int
+            number of trades recorded at once.
+            
+        Returns
+        -------
+        recorded : int
+            number of trades recorded - trades failing validation (e.g. selling
+            stock not held) are dropped.
+            
+        """
+        
+        # let's leverage numpy capabilities
+        import numpy as np
+        
+        rng = np.random.RandomState(seed)
+        stocks = self.stock_symbols()
+        
+        if symbols is None:
+            symbols = stocks
+        elif isinstance(symbols, int):
+            symbols = stocks[:symbols] + \
+                      ['SYM{}'.format(i) for i in range(symbols - len(stocks))]
+        
+        known = set(stocks)
+        
+        for symbol in symbols:
+            if symbol not in known:
+                self.add_stock(symbol, shares_trading=trades * max_qty)
+                
+        symbols = np.array(symbols, dtype=object)
+        trade_types = np.array(['SELL', 'BUY'], dtype=object)
       
-        traders = []
-        tokens = []
-
         # create traders
-        for i in range(100):
-            trader = uuid.uuid4()
-            traders.append(str(trader))
-            td = Trader(str(trader), store=self._store)
-            tokens.append(td.save())
-
-            # trading times: simulate 30mins of trading
-        now = datetime.now()
-        txn_times = [now - timedelta(seconds=i) for i in range(1800)]
-        txn_ids = []
-
-        for time in txn_times:
-            idx = random.randint(0, 99)
-            qty = random.randrange(1, 10000, 1)
-            ttype_idx = random.randint(0, 1)
-            stocks_idx = random.randint(0, 4)
-            price = base_price + 10 * random.random()
-
-            try:        
-                txn_ids.append(self.trade(traders[idx], tokens[idx], stocks[stocks_idx], 
-                    qty, price, trade_type=trade_types[ttype_idx], timestamp=time))
+        trader_ids = [str(uuid.uuid4()) for i in range(traders)]
+        tokens = [self.create_user(trader) for trader in trader_ids]
+        
+        trader_ids = np.array(trader_ids, dtype=object)
+        tokens = np.array(tokens, dtype=object)
 
-            except ValueError:
-                pass    
+        # trading times: evenly spread up to now
+        now = np.datetime64(datetime.now(), 'us')
+        step = duration * 60 * 1e6 / max(trades, 1)
         
-    @validate_stock('Platform')
-    def create_user(id):
-        return Trade(id, store=self.store).save()
+        recorded = 0
+        
+        for start in range(0, trades, batch_size):
+            k = min(batch_size, trades - start)
+            
+            idx = rng.randint(0, traders, k)
+            offsets = (trades - 1 - np.arange(start, start + k)) * step
+            
+            statuses, _ = self.trade_many(
+                    trader_ids[idx], tokens[idx], 
+                    symbols[rng.randint(0, len(symbols), k)],
+                    rng.randint(1, max_qty, k), 
+                    base_price + 10 * rng.random_sample(k),
+                    trade_types=trade_types[(rng.random_sample(k) >= sell_ratio).astype(int)],
+                    timestamps=now - offsets.astype('timedelta64[us]'))
+            
+            recorded += statuses.count('OK')
+            
+        return recorded
+        
+    @property
+    def store(self):
+        return self._store
     
+    def save_snapshot(self, path):
+        """ Save point-in-time snapshot of store to directory ``path`` - see
+            ``Store.save_snapshot``. Trading is paused meanwhile, so positions
+            and transactions in the snapshot agree.
+            
+        """
+        
+        with self._trader_locks.hold(*self._store.get_traders()):
+            self._store.save_snapshot(path)
+    
+    def compact(self, horizon, bucket=60, bar_horizon=None, bar_bucket=3600, time_ref=None):
+        """ Retention - compact trades older than ``horizon`` mins into per
+            stock bars - see ``Store.compact``. Volume weighted stock prices
+            over older time ranges are answered from bars.
+            
+        Returns
+        -------
+        compacted : int
+            number of trades compacted.
+            
+        """
+        
+        return self._store.compact(horizon, bucket=bucket, bar_horizon=bar_horizon,
+                                   bar_bucket=bar_bucket, time_ref=time_ref)
+    
+    def sequenced(self, max_pending=10000, batch_size=1000):
+        """ Sequenced mode - trades submitted to the returned (started) 
+            ``Sequencer`` are queued and applied in order by a single writer
+            thread, in micro-batches of up to ``batch_size`` trades.
+            
+        Parameters
+        ----------
+        max_pending : int
+            most trades queued at once.
+        batch_size : int
+            most trades applied at once.
+            
+        Returns
+        -------
+        sequencer : Sequencer
+            running sequencer - ``Sequencer.stop`` to stop.
+            
+        """
+        
+        return Sequencer(self, max_pending=max_pending, batch_size=batch_size).start()
+    
+    @property
+    def version(self):
+        """ Version of store - see ``Store.version``. """
+        
+        return self._store.version
+    
+    def create_user(self, id, token=None):
+        return Trader(id, store=self._store, token=token).save()
+    
+    def add_stock(self, symbol, **kwargs):
+        """ Add new stock ``symbol`` - see ``Store.add_stock``. """
+        
+        self._store.add_stock(symbol, **kwargs)
+        
+    def stock_symbols(self):
+        """ Symbols of stocks in store - sorted. """
+        
+        return sorted(self._store.symbols)
+    
+    def is_trading(self, symbol):
+        """ Whether stock ``symbol`` exists and has shares trading. """
+        
+        return symbol in self._store.symbols and self._store['shares_trading'][symbol] > 0
+    
+    def _stock_orm(self, symbol):
+        """ Stock record mapper for type of stock ``symbol``. """
+        
+        if self._store.data['stocks'][symbol]['Type'] == "Preferred":
+            return self._preferred_stock
+        
+        return self._common_stock
+    
+    @validate_stock('Platform')
     def pe_ratio(self, symbol, price):
-        pass
+        """
+        Compute P/E ratio given ``stock symbol`` and its ``price``.
+        
+        Returns
+        -------
+        pe_ratio : float
+            Stock's P/E ratio.
+            
+        """
+        
+        return price / self._stock_orm(symbol)._dividend_yield(symbol, price)
     
     #@validate_stock('Platform')
     def trade(self, trader, token, symbol, qty, 
-              price, trade_type='BUY', timestamp=datetime.now()):
+              price, trade_type='BUY', timestamp=None):
         """ Function to conduct trader with input parameters.
             
         Parameters
@@ -102,11 +308,11 @@ class Platform():
         trade_type : str
             indicator for trade type: BUY or SELL
         timestamp : datetime.datetime
-            time to record against trade
+            time to record against trade - now if not given.
             
         Return
         ------
-        txnid : str
+        txnid : int
             Id of saved/recorded transaction
             
         Example
@@ -121,98 +327,263 @@ class Platform():
         >>> s = Store()
         >>> p = Platform(s)
         >>> p.trade(trader, token, stock, qty, price, trade_type='SELL')
-        UUID('1317e634-4b7a-459a-b0d5-55beb351c190')
+        56640112836755232
         
         """
         if not symbol:
             raise ValueError("[ERROR] Platform: Stock symbol must be provided.")
+        
+        # validated once - internals below don't re-validate
+        if symbol not in self._store.symbols:
+            raise ValueError("[ERROR] Platform: Stock {} doesn't exist.".format(symbol))
 
-        if not qty:
+        if not isinstance(qty, numbers.Integral) or qty <= 0:
             raise ValueError("[ERROR] Platform: Stock quantity must be provided.")
-                
-        trd = Trader(trader, store=self._store)
-        t = trd.load(trader) 
         
-        #logging.debug('[INFO] Platform: Recording trade for trader .....{}'.format(t))
+        if not isinstance(price, (int, float)):
+            raise ValueError("[ERROR] Platform: Invalid price {}.".format(price))
         
-        if token is not t['token']:
-            raise ValueError("[ERROR] Platform: Failed authentication. Token doesn't match record.")
-           
-        trader_has_stock = False
+        # before positions are updated - nothing to undo
+        if trade_type not in Transaction.TYPES:
+            raise ValueError("[ERROR] Platform: Invalid trade type {}.".format(trade_type))
         
-        # buy/sell from/to shares trading
-        if trade_type == 'SELL':
-            # verify that trader have stock and in enough qty
+        if timestamp is None:
+            timestamp = datetime.now()
+        elif not isinstance(timestamp, datetime):
+            raise ValueError("[ERROR] Platform: Invalid timestamp {}.".format(timestamp))
+                
+        with self._trader_locks.hold(trader), self._symbol_locks.hold(symbol):
+            t = self._store.sessions.authenticate(trader, token)
+            
+            if t is None:
+                if trader not in self._store['traders']:
+                    raise ValueError("[ERROR] Platform: Trader {} doesn't exist.".format(trader))
+                
+                raise ValueError("[ERROR] Platform: Failed authentication. Token doesn't match record.")
+           
             portfolio = t['portfolio']
-            for record in portfolio:
-                if record['symbol'] == symbol:
-                    trader_has_stock = True
-                    
-                    if record['qty'] < qty:
-                        raise ValueError("[ERROR] Platform: Trader {} doesn't '\
-                        'have sufficient qty for stock {}". format(trader, symbol))
-                    
-                    break
-                    
-            if not trader_has_stock:
-                raise ValueError("[ERROR] Platform: Trader {} doesn't '\
-                        'have stock {}". format(trader, symbol))
-        else:
-            if self._shares_trading.get_qty(symbol) < qty:
-                raise ValueError("[ERROR] Platform: Stock {} doesn't '\
-                        'exist in sufficient qty {}". format(symbol, qty))
+        
+            if not isinstance(portfolio, Portfolio):
+                portfolio = t['portfolio'] = Portfolio(portfolio)
+        
+            # buy/sell from/to shares trading
+            if trade_type == 'SELL':
+                # verify that trader have stock and in enough qty
+                position = portfolio.get(symbol)
+            
+                if not position:
+                    raise ValueError("[ERROR] Platform: Trader {} doesn't '\
+                            'have stock {}". format(trader, symbol))
+                
+                if position.qty < qty:
+                    raise ValueError("[ERROR] Platform: Trader {} doesn't '\
+                            'have sufficient qty for stock {}". format(trader, symbol))
+            else:
+                if self._shares_trading.get_qty(symbol) < qty:
+                    raise ValueError("[ERROR] Platform: Stock {} doesn't '\
+                            'exist in sufficient qty {}". format(symbol, qty))
+            
+                self._shares_trading.buy(symbol, qty) 
+            
+            # update portfolio - positions are updated in place in trader's record
+            if trade_type == 'BUY':
+                portfolio.buy(symbol, qty, price)
+            else:
+                portfolio.sell(symbol, qty)
+        
+            # update stock price
+            self._store.set_price(symbol, price)
             
-            self._shares_trading.buy(symbol, qty) 
+            # record trade that has just occured - with position, for snapshots
+            txn = Transaction(symbol, qty, price, 
+                     timestamp=timestamp, user=t['id'],
+                     store=self._store, trade_type=trade_type)
             
-        # update portfolio
-        portfolio = t['portfolio']
+            txnid = txn.save()
         
-        updated = False
+        self._vwsp.add(timestamp, price, qty, symbol=symbol)
+        self._bars.add(timestamp, price, qty, symbol)
+        self._store.bump_version()
         
-        if len(portfolio) > 0:
-            for record in portfolio:
-                if record['symbol'] == symbol:
-                    if trade_type == 'BUY':
-                        record['qty'] += qty
+        return txnid
+    
+    def trade_many(self, traders, tokens, symbols, qtys, prices, 
+                   trade_types=None, timestamps=None):
+        """ Conduct a batch of trades - the i-th element of each input 
+            sequence (or array) describing the i-th trade as in ``Platform.trade``.
+            
+            Trades are validated and positions updated in order, then shares
+            trading, stock prices and transactions are written to store in
+            grouped passes. A failed trade doesn't stop the batch.
+            
+        Parameters
+        ----------
+        traders : sequence
+            Ids of traders
+        tokens : sequence
+            access tokens of traders
+        symbols : sequence
+            symbols of stocks to trade
+        qtys : sequence
+            quantities of stocks to trade
+        prices : sequence
+            stock prices
+        trade_types : sequence
+            trade types - BUY or SELL. All BUY if not given.
+        timestamps : sequence
+            times to record against trades - now if not given (or None).
+            
+        Return
+        ------
+        statuses : list
+            'OK' or error message for each trade
+        txn_ids : list
+            Id of saved/recorded transaction for each trade - None if trade failed.
+            
+        Example
+        -------
+        >>> from sssm.backend import Platform, Store, Trader
+        >>> s = Store()
+        >>> p = Platform(s)
+        >>> token = Trader('trader1', store=s).save()
+        >>> statuses, txn_ids = p.trade_many(['trader1', 'trader1'], [token, token], 
+        ...                                  ['GIN', 'GIN'], [1000, 2000], [15.0, 15.5],
+        ...                                  trade_types=['BUY', 'SELL'])
+        >>> statuses
+        ['OK', "[ERROR] Platform: Trader trader1 doesn't have sufficient qty for stock GIN"]
+        
+        """
+        
+        n = len(traders)
+        
+        if trade_types is None:
+            trade_types = ['BUY'] * n
+            
+        if timestamps is None:
+            timestamps = [datetime.now()] * n
+            
+        columns = [traders, tokens, symbols, qtys, prices, trade_types, timestamps]
+        
+        if any(len(column) != n for column in columns):
+            raise ValueError("[ERROR] Platform: Trades must be given as sequences of equal length.")
+        
+        # plain python values for arrays
+        traders, tokens, symbols, qtys, prices, trade_types, timestamps = \
+            [column.tolist() if hasattr(column, 'tolist') else column for column in columns]
+        
+        # converted as validated
+        timestamps = list(timestamps)
+        now = datetime.now()
+        
+        trader_records = self._store['traders']
+        sessions = self._store.sessions
+        registered = self._store.symbols
+        shares_trading = self._store['shares_trading']
+        
+        statuses = []
+        accepted = []
+        available = {}
+        last_price = {}
+        
+        # traders and stocks of batch are held throughout
+        held_traders = [trader for trader in set(traders) if trader in trader_records]
+        held_symbols = [symbol for symbol in set(symbols) if symbol in registered]
+        
+        with self._trader_locks.hold(*held_traders), self._symbol_locks.hold(*held_symbols):
+            # validate and update positions in order
+            for i in range(n):
+                trader, symbol, qty, trade_type = traders[i], symbols[i], qtys[i], trade_types[i]
+            
+                t = sessions.authenticate(trader, tokens[i])
+            
+                if t is None:
+                    if trader not in trader_records:
+                        statuses.append("[ERROR] Platform: Trader {} doesn't exist.".format(trader))
                     else:
-                        record['qty'] -= qty
-                    updated = True
-                    
-            if not updated:
-                record = {
-                    'symbol':symbol,
-                    'qty': qty,
-                    'price': price
-                }
+                        statuses.append("[ERROR] Platform: Failed authentication. Token doesn't "\
+                                        "match record.")
+                    continue
                 
-                portfolio.append(record)
-        else:
-            record = {
-                    'symbol':symbol,
-                    'qty': qty,
-                    'price': price
-                }
+                if symbol not in registered:
+                    statuses.append("[ERROR] Platform: Stock {} doesn't exist.".format(symbol))
+                    continue
+            
+                if not isinstance(qty, numbers.Integral) or qty <= 0:
+                    statuses.append("[ERROR] Platform: Stock quantity must be provided.")
+                    continue
+            
+                if not isinstance(prices[i], (int, float)):
+                    statuses.append("[ERROR] Platform: Invalid price {}.".format(prices[i]))
+                    continue
+                
+                # before positions are updated - recording can't fail on it
+                if timestamps[i] is None:
+                    timestamps[i] = now
+                elif not isinstance(timestamps[i], datetime):
+                    statuses.append("[ERROR] Platform: Invalid timestamp {}.".format(timestamps[i]))
+                    continue
+            
+                portfolio = t['portfolio']
+            
+                if not isinstance(portfolio, Portfolio):
+                    portfolio = t['portfolio'] = Portfolio(portfolio)
+            
+                if trade_type == 'SELL':
+                    if portfolio.qty(symbol) < qty:
+                        statuses.append("[ERROR] Platform: Trader {} doesn't have sufficient "\
+                                        "qty for stock {}".format(trader, symbol))
+                        continue
                 
-            portfolio.append(record)
+                    portfolio.sell(symbol, qty)
+                elif trade_type == 'BUY':
+                    shares = available.get(symbol)
                 
-        trd.portfolio = portfolio
-        
-        trd.save()
-        
-        # update stock price
-        if self._store.get_type(symbol) == "Preferred":
-            PreferredStock(self._store).set_current_price(symbol, price)
-        else:
-            CommonStock(self._store).set_current_price(symbol, price)
+                    if shares is None:
+                        shares = shares_trading[symbol]
+                    
+                    if shares < qty:
+                        statuses.append("[ERROR] Platform: Stock {} doesn't exist in "\
+                                        "sufficient qty {}".format(symbol, qty))
+                        continue
+                
+                    available[symbol] = shares - qty
+                    portfolio.buy(symbol, qty, prices[i])
+                else:
+                    statuses.append("[ERROR] Platform: Invalid trade type {}.".format(trade_type))
+                    continue
             
-        # record trade that has just occured
-        txn = Transaction(symbol, qty, price, 
-                 timestamp=timestamp, user=t['id'],
-                 store=self._store, trade_type=trade_type)
+                last_price[symbol] = prices[i]
+                accepted.append(i)
+                statuses.append('OK')
+            
+            # grouped writes - once per stock traded
+            for symbol, qty in available.items():
+                self._store.set_shares_trading(symbol, qty)
+            
+            for symbol, price in last_price.items():
+                self._store.set_price(symbol, price)
+            
+            # record trades that have just occured - with positions, for snapshots
+            columns = [[column[i] for i in accepted] for column in \
+                       (traders, symbols, qtys, prices, trade_types, timestamps)]
+            traders, symbols, qtys, prices, trade_types, timestamps = columns
+            
+            ids = self._store['transactions'].extend(None, timestamps, symbols, qtys, 
+                                                     prices, trade_types, traders)
         
-        txnid = txn.save()
+        for txn in zip(timestamps, prices, qtys, symbols):
+            self._vwsp.add(*txn)
+            
+        self._bars.extend(timestamps, prices, qtys, symbols)
+            
+        self._store.bump_version()
+            
+        txn_ids = [None] * n
         
-        return txnid
+        for i, txn_id in zip(accepted, ids):
+            txn_ids[i] = txn_id
+            
+        return statuses, txn_ids
     
     @validate_stock('Platform')
     def compute_dividend_yield(self, symbol, price):
@@ -233,7 +604,7 @@ class Platform():
         >>> stock_symbol = 'TEA'
         >>> price = 25.0
         >>> platform.compute_dividend_yield(stock_symbol, price)
-        0
+        0.0
 
         Returns
         -------
@@ -242,14 +613,9 @@ class Platform():
 
         """
 
-        stock_type = self.store.get_type(symbol)
-
-        if stock_type == "Preferred":
-            return PreferredStock(self.store).dividend_yield(symbol, price)
-
-        return CommonStock(self.store).dividend_yield(symbol)
+        return self._stock_orm(symbol)._dividend_yield(symbol, price)
         
-    def volume_weighted_stock_price(self, since=15, time_ref=None):
+    def volume_weighted_stock_price(self, since=15, time_ref=None, symbol=None):
         """
         Volume weighted stock price within given interval - default 15 mins.
         
@@ -261,46 +627,174 @@ class Platform():
         ref : datetime
             Reference of date/time from which relative time (``since``) should start.
             
+        symbol : str
+            Stock symbol to compute price for. Trades of all stocks are
+            weighted together if not given.
+            
         Returns
         -------
         price : float
             weighted volume stock price computed on given interval.
             
         """
-        start_dt = time_ref if time_ref else datetime.now()
+        price_qty, qty = self.volume_weighted_sums(since, time_ref, symbol)
         
-        qty = []
-        price_qty = []
+        if qty == 0:
+            raise ValueError("[ERROR] Platform: No transaction found.")
+            
+        return price_qty / qty
+    
+    def transactions(self, since=None, until=None, symbol=None, trader=None, cursor=None,
+                     limit=1000):
+        """ A page of transactions within time range (``since``, ``until``] -
+            of ``symbol`` and ``trader`` if given - following ``cursor``. See
+            ``TransactionLog.page``.
+            
+        Returns
+        -------
+        page : tuple
+            (transaction records, cursor of next page - None if there isn't one)
+            
+        """
         
-        txn_orm = Transaction(None, None, 'TEA', store=self._store)
-        ids = txn_orm.find(start_dt - timedelta(minutes=since))
+        return self._store['transactions'].page(since, until, symbol=symbol, trader=trader,
+                                                after=cursor, limit=limit)
+    
+    def bars(self, symbol, res=60, start=None, end=None):
+        """ OHLCV bars of stock ``symbol`` at resolution ``res`` secs - see
+            ``BarBuilder.bars``.
+            
+        """
+        
+        return self._bars.bars(symbol, res, start=start, end=end)
+    
+    def bar_volume_weighted_stock_price(self, start, end, symbol=None):
+        """ Volume weighted stock price over trades within [``start``, ``end``)
+            - see ``Platform.bar_volume_weighted_sums``.
+            
+        """
         
-        for txn_id in ids:
-            if txn_id:
-                txn = txn_orm.load(txn_id)
-                price_qty.append(txn['volume'] * txn['per_price'])
-                qty.append(txn['volume'])
+        price_qty, qty = self.bar_volume_weighted_sums(start, end, symbol)
         
-        if len(qty) == 0:
+        if qty == 0:
             raise ValueError("[ERROR] Platform: No transaction found.")
             
-        return sum(price_qty) / sum(qty)
+        return price_qty / qty
     
-    def all_share_index(self):
-
-        """ Obtain all share index for stock prices.
+    def bar_volume_weighted_sums(self, start, end, symbol=None):
+        """ Sums of ``price * qty`` and ``qty`` over trades within [``start``,
+            ``end``). Read from bars if both are aligned to a resolution
+            whose bars still cover the interval - in time proportional to
+            the number of bars - otherwise from transactions.
+            
+        Returns
+        -------
+        sums : tuple
+            (sum of price * qty, sum of qty)
+            
         """
         
-        # let's leverage numpy capabilities
-        import numpy as np
+        sums = self._bars.sums(start, end, symbol)
+        
+        if sums is not None:
+            return sums
+        
+        # (start - 1us, end - 1us] - as transactions are searched
+        return self._store['transactions'].volume_weighted(
+                    us_to_datetime(datetime_to_us(start) - 1), 
+                    us_to_datetime(datetime_to_us(end) - 1), symbol=symbol)
+    
+    def volume_weighted_sums(self, since=15, time_ref=None, symbol=None):
+        """ Sums of ``price * qty`` and ``qty`` over trades within given
+            interval - see ``Platform.volume_weighted_stock_price``. Sums of
+            several platforms (e.g. shards) combine into their overall price.
+            
+        Returns
+        -------
+        sums : tuple
+            (sum of price * qty, sum of qty)
+            
+        """
+        
+        start_dt = time_ref if time_ref else datetime.now()
+        
+        # default window is maintained incrementally as trades occur
+        if since == self._vwsp.window:
+            sums = self._vwsp.sums_if_covered(start_dt, symbol=symbol)
+            
+            if sums is not None:
+                return sums
+        
+        return self._store['transactions'].volume_weighted(
+                    start_dt - timedelta(minutes=since), symbol=symbol)
+    
+    def volume_weighted_stock_prices(self, since=15, time_ref=None, symbols=None):
+        """
+        Volume weighted stock price of each stock within given interval - default 15 mins.
+        All stocks are computed together in a single grouped pass over the interval's trades.
+        
+        Parameters
+        ----------- 
+        since : int
+            interval in mins since trade occured
+            
+        ref : datetime
+            Reference of date/time from which relative time (``since``) should start.
+            
+        symbols : list
+            Stock symbols to compute price for - defaults to all stocks trading.
+            
+        Returns
+        -------
+        prices : dict
+            weighted volume stock price of each stock traded on given interval.
             
-        shares_trading = self._store.get_shares_trading()
+        """
+        
+        start_dt = time_ref if time_ref else datetime.now()
+        
+        if symbols is None:
+            symbols = self._store.get_shares_trading()
+        
+        if since == self._vwsp.window:
+            prices = self._vwsp.values_if_covered(start_dt, symbols=symbols)
+            
+            if prices is not None:
+                return prices
+        
+        sums = self._store['transactions'].volume_weighted_by_symbol(
+                            start_dt - timedelta(minutes=since))
+        
+        return dict((symbol, sums[symbol][0] / sums[symbol][1]) \
+                    for symbol in symbols if symbol in sums)
+    
+    def stock_prices(self, symbols=None):
+        """ Last price of each stock - traded or set.
         
-        shares_prices = [PreferredStock(self._store).get_current_price(symbol) \
-                         if self._store.get_type(symbol) == 'Preferred' else \
-                         CommonStock(self._store).get_current_price(symbol) for \
-                         symbol in shares_trading \
-                        ]
-        shares_prices = np.array(shares_prices)
+        Parameters
+        ----------
+        symbols : list
+            Stock symbols to give price of - defaults to all stocks trading.
+            
+        Returns
+        -------
+        prices : dict
+            price of each stock having one.
+            
+        """
+        
+        stocks = self._store['stocks']
+        
+        if symbols is None:
+            symbols = self._store.get_shares_trading()
+            
+        return dict((symbol, stocks[symbol]['Price']) for symbol in symbols \
+                    if symbol in stocks and stocks[symbol]['Price'] > 0)
+    
+    def all_share_index(self):
+
+        """ Obtain all share index for stock prices - geometric mean of the
+            prices of stocks trading, maintained incrementally by the store.
+        """
         
-        return shares_prices.prod()**(1.0/len(shares_prices))
\ No newline at end of file
+        return self._store.all_share_index()
@@ -0,0 +1,185 @@
+from __future__ import absolute_import, division, print_function
+
+from concurrent.futures import Future
+from datetime import datetime
+from threading import Lock, Thread
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from sssm.backend.util import synchronized
+
+class Sequencer(object):
+    """ Single writer applying trades to a platform in the order submitted.
+        
+        Trades are submitted to a bounded queue and drained by one writer
+        thread in micro-batches of up to ``batch_size`` trades, each applied
+        through ``Platform.trade_many``. The queue holding at most
+        ``max_pending`` trades, submitting blocks (or fails) while full.
+    
+    Examples
+    --------
+    >>> from sssm.backend import Platform, Store, Trader
+    >>> s = Store()
+    >>> p = Platform(s)
+    >>> token = Trader('trader1', store=s).save()
+    >>> sequencer = p.sequenced()
+    >>> future = sequencer.submit('trader1', token, 'GIN', 1000, 15.0)
+    >>> future.result()
+    56640112836755232
+    >>> sequencer.stop()
+    
+    """
+    
+    def __init__(self, platform, max_pending=10000, batch_size=1000):
+        if max_pending <= 0 or batch_size <= 0:
+            raise ValueError("[ERROR] Sequencer: Queue size and batch size must be positive.")
+        
+        self._platform = platform
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._batch_size = batch_size
+        self._thread = None
+        self._lock = Lock()
+        
+        # metrics
+        self._trades = 0
+        self._batches = 0
+        self._max_batch = 0
+        self._max_depth = 0
+    
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+    
+    def start(self):
+        """ Start writer thread. """
+        
+        if self.running:
+            raise ValueError("[ERROR] Sequencer: Already running.")
+        
+        self._thread = Thread(target=self._run, name="Sequencer")
+        self._thread.daemon = True
+        self._thread.start()
+        
+        return self
+    
+    def stop(self, timeout=None):
+        """ Stop writer thread once trades already submitted are applied. """
+        
+        if not self.running:
+            return
+        
+        self._queue.put(None)
+        self._thread.join(timeout)
+    
+    def submit(self, trader, token, symbol, qty, price, trade_type='BUY',
+               timestamp=None, block=True, timeout=None):
+        """ Queue a trade - parameters as in ``Platform.trade``.
+        
+        Parameters
+        ----------
+        block : bool
+            wait for room in queue while full - ``queue.Full`` is raised
+            otherwise (or once ``timeout`` secs have passed).
+        timeout : float
+            secs to wait for room in queue.
+        
+        Returns
+        -------
+        future : concurrent.futures.Future
+            resolves to Id of saved/recorded transaction - or raises
+            ValueError if trade failed.
+        
+        """
+        
+        if not self.running:
+            raise ValueError("[ERROR] Sequencer: Not running.")
+        
+        if timestamp is None:
+            timestamp = datetime.now()
+        
+        future = Future()
+        
+        self._queue.put((future, (trader, token, symbol, qty, price, trade_type, timestamp)),
+                        block, timeout)
+        
+        depth = self._queue.qsize()
+        
+        if depth > self._max_depth:
+            self._max_depth = depth
+        
+        return future
+    
+    @synchronized
+    def metrics(self):
+        """ Queue depth and batching metrics.
+        
+        Returns
+        -------
+        metrics : dict
+            ``depth`` trades queued now, ``max_depth`` most trades queued at
+            once, ``trades`` and ``batches`` applied, ``max_batch`` and
+            ``mean_batch`` trades per batch.
+        
+        """
+        
+        return {
+            "depth": self._queue.qsize(),
+            "max_depth": self._max_depth,
+            "trades": self._trades,
+            "batches": self._batches,
+            "max_batch": self._max_batch,
+            "mean_batch": self._trades / self._batches if self._batches else 0.0
+        }
+    
+    def _run(self):
+        stopped = False
+        
+        while not stopped:
+            batch = [self._queue.get()]
+            
+            # drain whatever else is queued - up to batch size
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            
+            if None in batch:
+                stopped = True
+                batch = batch[:batch.index(None)]
+            
+            # cancelled trades aren't applied
+            batch = [item for item in batch if item[0].set_running_or_notify_cancel()]
+            
+            if batch:
+                self._apply(batch)
+    
+    def _apply(self, batch):
+        futures = [future for future, trade in batch]
+        traders, tokens, symbols, qtys, prices, trade_types, timestamps = \
+            [list(column) for column in zip(*[trade for future, trade in batch])]
+        
+        with self._lock:
+            self._trades += len(batch)
+            self._batches += 1
+            self._max_batch = max(self._max_batch, len(batch))
+        
+        try:
+            statuses, txn_ids = self._platform.trade_many(traders, tokens, symbols, qtys, prices,
+                                                          trade_types=trade_types,
+                                                          timestamps=timestamps)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            
+            return
+        
+        for future, status, txn_id in zip(futures, statuses, txn_ids):
+            if status == 'OK':
+                future.set_result(txn_id)
+            else:
+                future.set_exception(ValueError(status))
+
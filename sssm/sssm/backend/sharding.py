@@ -0,0 +1,466 @@
+from __future__ import absolute_import, division, print_function
+
+import copy
+from datetime import datetime
+import itertools
+import math
+from multiprocessing import Pipe, Process
+from threading import Lock
+import uuid
+import zlib
+
+from sssm.backend import data, Store
+from sssm.backend.platform import Platform
+from sssm.backend.util import MonotonicIds, datetime_to_us
+
+def shard_of(symbol, shards):
+    """ Shard owning stock ``symbol`` - stable across processes. """
+    
+    if not isinstance(symbol, (bytes, type(u''))):
+        return 0
+    
+    key = symbol if isinstance(symbol, bytes) else symbol.encode('utf-8')
+    
+    return zlib.crc32(key) % shards
+
+def serve_shard(conn, shard, stocks, shares_trading, vwsp_window):
+    """ Shard worker - owns a ``Platform`` (and ``Store``) of ``stocks`` and
+        runs requests ``(target, method, args, kwargs)`` received on ``conn``
+        against it until sent None. ``target`` names the attributes leading
+        from platform to the object whose ``method`` is called. Transaction
+        ids are generated as node ``shard`` - so they're unique across shards.
+    
+    """
+    
+    platform = Platform(Store(stocks=stocks, shares_trading=shares_trading, node=shard),
+                        vwsp_window=vwsp_window)
+    
+    while True:
+        request = conn.recv()
+        
+        if request is None:
+            break
+        
+        target, method, args, kwargs = request
+        
+        try:
+            obj = platform
+            
+            for name in target:
+                obj = getattr(obj, name)
+            
+            conn.send((True, getattr(obj, method)(*args, **kwargs)))
+        except Exception as e:
+            conn.send((False, e))
+    
+    conn.close()
+
+class ShardedPlatform(Platform):
+    """ Trading platform partitioned by stock symbol across ``shards`` worker
+        processes, each owning a ``Platform`` and ``Store`` of its stocks.
+        
+        Trades and queries of a stock are routed to the shard owning it, and
+        batches of trades are split by shard and run by all shards at once,
+        so trading scales with cores. Traders are created in every shard -
+        positions in a stock live in the shard owning it. Cross stock results
+        are combined from per-shard parts: the all share index from sums of
+        log-prices, the volume weighted stock price from sums of ``price *
+        qty`` and ``qty``.
+        
+        Journals and snapshots aren't supported, and there can be up to 16
+        shards - transaction ids being generated as a node per shard. Every
+        method of ``Platform`` is overridden - those not reading the store
+        directly run ``Platform``'s on the sharded ones.
+    
+    Examples
+    --------
+    >>> from sssm.backend import ShardedPlatform
+    >>> p = ShardedPlatform(shards=4)
+    >>> token = p.create_user('trader1')
+    >>> p.trade('trader1', token, 'GIN', 1000, 15.0)
+    56640112836755248
+    >>> p.all_share_index()
+    15.0
+    >>> p.close()
+    
+    """
+    
+    def __init__(self, shards=2, stocks=None, shares_trading=None, vwsp_window=15):
+        if not 0 < shards <= 1 << MonotonicIds.NODE_BITS:
+            raise ValueError("[ERROR] Platform: Number of shards must be within [1, {}].".format(
+                             1 << MonotonicIds.NODE_BITS))
+        
+        stocks = stocks if stocks is not None else copy.deepcopy(data.STOCKS)
+        shares_trading = shares_trading if shares_trading is not None else dict(data.SHARES_TRADING)
+        
+        self._store = None
+        self._shards = shards
+        self._symbols = dict((symbol, shard_of(symbol, shards)) for symbol in stocks)
+        self._versions = itertools.count(1)
+        self._version = 0
+        
+        # requests to a shard are serialised - several shards are locked in order
+        self._locks = [Lock() for i in range(shards)]
+        self._conns = []
+        self._workers = []
+        
+        for i in range(shards):
+            owned = [symbol for symbol in stocks if self._symbols[symbol] == i]
+            
+            conn, worker_conn = Pipe()
+            worker = Process(target=serve_shard, name="Shard-{}".format(i),
+                             args=(worker_conn, i, dict((symbol, stocks[symbol]) for symbol in owned),
+                                   dict((symbol, shares_trading.get(symbol, 0)) for symbol in owned),
+                                   vwsp_window))
+            worker.daemon = True
+            worker.start()
+            worker_conn.close()
+            
+            self._conns.append(conn)
+            self._workers.append(worker)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    @property
+    def shards(self):
+        return self._shards
+    
+    def close(self):
+        """ Stop shard workers. """
+        
+        for lock, conn, worker in zip(self._locks, self._conns, self._workers):
+            with lock:
+                if worker.is_alive():
+                    conn.send(None)
+                    worker.join()
+                
+                conn.close()
+        
+        self._workers = []
+        self._conns = []
+    
+    def _call(self, shard, method, *args, **kwargs):
+        """ Call ``method`` of shard's platform. """
+        
+        return self._call_all({shard: ((), method, args, kwargs)})[shard]
+    
+    def _call_all(self, requests):
+        """ Send requests - shard => ``(target, method, args, kwargs)`` - to
+            shards at once, then collect results by shard. Raises the first
+            shard's error - so only for requests whose effects on the other
+            shards needn't be reported.
+        
+        """
+        
+        replies = self._send_all(requests)
+        
+        for shard in sorted(replies):
+            ok, result = replies[shard]
+            
+            if not ok:
+                raise result
+            
+        return dict((shard, result) for shard, (ok, result) in replies.items())
+    
+    def _send_all(self, requests):
+        """ Send requests to shards at once - see ``ShardedPlatform._call_all``.
+        
+        Returns
+        -------
+        replies : dict
+            shard => ``(ok, result)`` - ``result`` the error raised if not ``ok``.
+            
+        """
+        
+        shards = sorted(requests)
+        replies = {}
+        
+        for shard in shards:
+            self._locks[shard].acquire()
+        
+        try:
+            for shard in shards:
+                self._conns[shard].send(requests[shard])
+            
+            for shard in shards:
+                replies[shard] = self._conns[shard].recv()
+        finally:
+            for shard in reversed(shards):
+                self._locks[shard].release()
+                
+        return replies
+    
+    def _shard(self, symbol):
+        shard = self._symbols.get(symbol)
+        
+        # unknown stocks are rejected by shard they would belong to
+        return shard if shard is not None else shard_of(symbol, self._shards)
+    
+    def _bump_version(self):
+        self._version = next(self._versions)
+    
+    @property
+    def version(self):
+        """ Bumped on every change made through platform. """
+        
+        return self._version
+    
+    def create_user(self, id, token=None):
+        token = token if token else uuid.uuid4()
+        
+        self._call_all(dict((shard, ((), 'create_user', (id, token), {})) \
+                            for shard in range(self._shards)))
+        
+        return token
+    
+    def add_stock(self, symbol, **kwargs):
+        shard = shard_of(symbol, self._shards)
+        
+        self._call_all({shard: (('store',), 'add_stock', (symbol,), kwargs)})
+        self._symbols[symbol] = shard
+        self._bump_version()
+    
+    def stock_symbols(self):
+        return sorted(self._symbols)
+    
+    def is_trading(self, symbol):
+        return symbol in self._symbols and self._call(self._symbols[symbol], 'is_trading', symbol)
+    
+    def pe_ratio(self, symbol, price):
+        return self._call(self._shard(symbol), 'pe_ratio', symbol, price)
+    
+    def compute_dividend_yield(self, symbol, price):
+        return self._call(self._shard(symbol), 'compute_dividend_yield', symbol, price)
+    
+    def trade(self, trader, token, symbol, qty, price, trade_type='BUY', timestamp=None):
+        """ Conduct trade - see ``Platform.trade``. """
+        
+        if not symbol:
+            raise ValueError("[ERROR] Platform: Stock symbol must be provided.")
+        
+        txn_id = self._call(self._shard(symbol), 'trade', trader, token, symbol, qty, price,
+                            trade_type=trade_type,
+                            timestamp=timestamp if timestamp else datetime.now())
+        self._bump_version()
+        
+        return txn_id
+    
+    def trade_many(self, traders, tokens, symbols, qtys, prices,
+                   trade_types=None, timestamps=None):
+        """ Conduct a batch of trades - see ``Platform.trade_many``. Trades are
+            split by shard and each shard's trades run at once. Trades of a
+            shard failing are given its error as status - those of the other
+            shards are recorded as usual.
+        
+        """
+        
+        n = len(traders)
+        
+        if trade_types is None:
+            trade_types = ['BUY'] * n
+        
+        if timestamps is None:
+            timestamps = [datetime.now()] * n
+        
+        columns = [traders, tokens, symbols, qtys, prices, trade_types, timestamps]
+        
+        if any(len(column) != n for column in columns):
+            raise ValueError("[ERROR] Platform: Trades must be given as sequences of equal length.")
+        
+        columns = [column.tolist() if hasattr(column, 'tolist') else column for column in columns]
+        
+        rows = {}
+        
+        for i, symbol in enumerate(columns[2]):
+            rows.setdefault(self._shard(symbol), []).append(i)
+        
+        requests = {}
+        
+        for shard, idx in rows.items():
+            traders, tokens, symbols, qtys, prices, trade_types, timestamps = \
+                [[column[i] for i in idx] for column in columns]
+            
+            requests[shard] = ((), 'trade_many', (traders, tokens, symbols, qtys, prices),
+                               {'trade_types': trade_types, 'timestamps': timestamps})
+        
+        replies = self._send_all(requests)
+        self._bump_version()
+        
+        statuses = [None] * n
+        txn_ids = [None] * n
+        
+        for shard, (ok, result) in replies.items():
+            if not ok:
+                status = "[ERROR] Platform: Shard {} failed to trade - {}".format(shard, result)
+                result = [status] * len(rows[shard]), [None] * len(rows[shard])
+                
+            for i, status, txn_id in zip(rows[shard], *result):
+                statuses[i] = status
+                txn_ids[i] = txn_id
+        
+        return statuses, txn_ids
+    
+    def volume_weighted_sums(self, since=15, time_ref=None, symbol=None):
+        time_ref = time_ref if time_ref else datetime.now()
+        
+        if symbol is not None:
+            if symbol not in self._symbols:
+                return 0.0, 0
+            
+            return self._call(self._symbols[symbol], 'volume_weighted_sums', since, time_ref,
+                              symbol)
+        
+        results = self._call_all(dict((shard, ((), 'volume_weighted_sums', (since, time_ref), {})) \
+                                      for shard in range(self._shards)))
+        
+        return math.fsum(price_qty for price_qty, qty in results.values()), \
+               sum(qty for price_qty, qty in results.values())
+    
+    def transactions(self, since=None, until=None, symbol=None, trader=None, cursor=None,
+                     limit=1000):
+        """ A page of transactions - see ``Platform.transactions``. Pages of
+            every shard are merged in (timestamp, id) order.
+            
+        """
+        
+        kwargs = {'symbol': symbol, 'trader': trader, 'cursor': cursor, 'limit': limit}
+        shards = [self._shard(symbol)] if symbol is not None else range(self._shards)
+        results = self._call_all(dict((shard, ((), 'transactions', (since, until), kwargs)) \
+                                      for shard in shards))
+        
+        records = sorted(itertools.chain.from_iterable(page for page, more in results.values()),
+                         key=lambda record: (record['ts'], record['id']))[:limit]
+        
+        if not records or \
+                (len(records) < limit and all(more is None for page, more in results.values())):
+            return records, None
+        
+        return records, (datetime_to_us(records[-1]['ts']), records[-1]['id'])
+    
+    def bars(self, symbol, res=60, start=None, end=None):
+        return self._call(self._shard(symbol), 'bars', symbol, res, start=start, end=end)
+    
+    def bar_volume_weighted_sums(self, start, end, symbol=None):
+        if symbol is not None:
+            if symbol not in self._symbols:
+                return 0.0, 0
+            
+            return self._call(self._symbols[symbol], 'bar_volume_weighted_sums', start, end, symbol)
+        
+        results = self._call_all(dict((shard, ((), 'bar_volume_weighted_sums', (start, end), {})) \
+                                      for shard in range(self._shards)))
+        
+        return math.fsum(price_qty for price_qty, qty in results.values()), \
+               sum(qty for price_qty, qty in results.values())
+    
+    def volume_weighted_stock_prices(self, since=15, time_ref=None, symbols=None):
+        time_ref = time_ref if time_ref else datetime.now()
+        
+        if symbols is None:
+            # stocks trading in each shard
+            shard_symbols = dict((shard, None) for shard in range(self._shards))
+        else:
+            shard_symbols = {}
+            
+            for symbol in symbols:
+                if symbol in self._symbols:
+                    shard_symbols.setdefault(self._symbols[symbol], []).append(symbol)
+        
+        results = self._call_all(dict((shard, ((), 'volume_weighted_stock_prices',
+                                               (since, time_ref, shard_symbols[shard]), {})) \
+                                      for shard in shard_symbols))
+        prices = {}
+        
+        for result in results.values():
+            prices.update(result)
+        
+        return prices
+    
+    def stock_prices(self, symbols=None):
+        if symbols is None:
+            shard_symbols = dict((shard, None) for shard in range(self._shards))
+        else:
+            shard_symbols = {}
+            
+            for symbol in symbols:
+                if symbol in self._symbols:
+                    shard_symbols.setdefault(self._symbols[symbol], []).append(symbol)
+                    
+        results = self._call_all(dict((shard, ((), 'stock_prices', (shard_symbols[shard],), {})) \
+                                      for shard in shard_symbols))
+        prices = {}
+        
+        for result in results.values():
+            prices.update(result)
+            
+        return prices
+    
+    def all_share_index(self):
+        """ All share index - geometric mean of the prices of stocks trading
+            across shards, from each shard's sum of log-prices.
+        
+        """
+        
+        results = self._call_all(dict((shard, (('store', 'share_index'), 'components', (), {})) \
+                                      for shard in range(self._shards)))
+        
+        count = sum(n for log_sum, n in results.values())
+        
+        if count == 0:
+            return float('nan')
+        
+        return math.exp(math.fsum(log_sum for log_sum, n in results.values()) / count)
+    
+    def compact(self, horizon, bucket=60, bar_horizon=None, bar_bucket=3600, time_ref=None):
+        """ Compact old trades of every shard - see ``Platform.compact``. """
+        
+        kwargs = {'bucket': bucket, 'bar_horizon': bar_horizon, 'bar_bucket': bar_bucket,
+                  'time_ref': time_ref if time_ref else datetime.now()}
+        results = self._call_all(dict((shard, ((), 'compact', (horizon,), kwargs)) \
+                                      for shard in range(self._shards)))
+        compacted = sum(results.values())
+        
+        if compacted:
+            self._bump_version()
+            
+        return compacted
+    
+    @property
+    def store(self):
+        raise ValueError("[ERROR] ShardedPlatform: Stores are held by shard workers.")
+    
+    def save_snapshot(self, path):
+        raise ValueError("[ERROR] ShardedPlatform: Snapshots aren't supported.")
+    
+    def simulate(self, *args, **kwargs):
+        """ Simulate random trading across shards - see ``Platform.simulate``. """
+        
+        return Platform.simulate(self, *args, **kwargs)
+    
+    def sequenced(self, max_pending=10000, batch_size=1000):
+        """ Sequenced mode - micro-batches are split across shards. See
+            ``Platform.sequenced``.
+            
+        """
+        
+        return Platform.sequenced(self, max_pending=max_pending, batch_size=batch_size)
+    
+    def volume_weighted_stock_price(self, since=15, time_ref=None, symbol=None):
+        """ Volume weighted stock price from shards' sums - see
+            ``Platform.volume_weighted_stock_price``.
+            
+        """
+        
+        return Platform.volume_weighted_stock_price(self, since, time_ref, symbol)
+    
+    def bar_volume_weighted_stock_price(self, start, end, symbol=None):
+        """ Volume weighted stock price from shards' bar sums - see
+            ``Platform.bar_volume_weighted_stock_price``.
+            
+        """
+        
+        return Platform.bar_volume_weighted_stock_price(self, start, end, symbol)
@@ -1,23 +1,168 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from functools import wraps
+from threading import Lock
+import time
 
 def validate_stock(*param):
+    """ Validate stock symbol - and price, if given - of decorated method 
+        ``func(self, symbol, [price, ...])`` against the stock symbols 
+        registered in ``self.store``.
+        
+        Validation is a set lookup. Methods called once validated should
+        use unvalidated internals rather than other decorated methods.
+        
+    """
+    
     def stock_decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
             """ func wrapper """
             
-            if len(args) == 0:
+            if len(args) < 2:
                 raise ValueError("SSSM - {}: [ERROR] No parameters provided.".format(param[0]))
-                
-            if not isinstance(args[1], str):
-                raise ValueError("SSSM - {}: [ERROR] Invalid Symbol {} specified.".format(param[0], args[1]))
             
-            if not args[0].store['stocks'].get(args[1]):
+            symbol = args[1]
+            
+            try:
+                registered = symbol in args[0].store.symbols
+            except TypeError:
+                # unhashable symbol
+                registered = False
+                
+            if not registered:
+                if not isinstance(symbol, str):
+                    raise ValueError("SSSM - {}: [ERROR] Invalid Symbol {} specified.".format(param[0], symbol))
+                
                 raise ValueError("SSSM - {}: [ERROR] Stock doesn't exist in database.".format(param[0])) 
             
-            if len(args) > 2 and type(args[2]) != float:
+            if len(args) > 2 and type(args[2]) is not float:
                 raise ValueError("SSSM - {}: [ERROR] Invalid Price {} specified.".format(param[0], args[2]))
                 
             return func(*args, **kwargs)
         return wrapper
-    return stock_decorator
\ No newline at end of file
+    return stock_decorator
+
+def synchronized(method):
+    """ Run decorated method holding its instance's ``_lock``. """
+    
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+class KeyedLocks(object):
+    """ A lock per key (e.g. stock symbol) - created on first use.
+    
+        ``hold`` acquires the locks of several keys in sorted order, so
+        callers holding overlapping sets of keys can't deadlock.
+        
+    """
+    
+    def __init__(self):
+        self._locks = {}
+        self._lock = Lock()
+        
+    def __len__(self):
+        return len(self._locks)
+        
+    def __getitem__(self, key):
+        lock = self._locks.get(key)
+        
+        if lock is None:
+            with self._lock:
+                lock = self._locks.setdefault(key, Lock())
+                
+        return lock
+    
+    @contextmanager
+    def hold(self, *keys):
+        """ Hold locks of ``keys`` while in context. """
+        
+        locks = [self[key] for key in sorted(set(keys))]
+        
+        for lock in locks:
+            lock.acquire()
+            
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+class MonotonicIds(object):
+    """ Unique, increasing integer ids - sortable by time of generation.
+    
+        An id is the microseconds since epoch it's generated at, shifted
+        left to make room for a sequence of up to 32 ids per microsecond,
+        then for ``node`` (0-15) - so ids of different nodes (e.g. shards)
+        never collide. Ids generated faster run ahead of the clock, and
+        never go backwards. Ids fit in 63 bits for the next ~500 years.
+        
+    Examples
+    --------
+    >>> from sssm.backend.util import MonotonicIds
+    >>> ids = MonotonicIds(node=1)
+    >>> first = ids.next()
+    >>> ids.take(3)[0] > first
+    True
+    
+    """
+    
+    SEQ_BITS = 5
+    NODE_BITS = 4
+    
+    def __init__(self, node=0):
+        if not 0 <= node < 1 << self.NODE_BITS:
+            raise ValueError("[ERROR] MonotonicIds: Node must be within [0, {}).".format(
+                             1 << self.NODE_BITS))
+        
+        self._node = node
+        self._last = 0
+        self._lock = Lock()
+        
+    @property
+    def node(self):
+        return self._node
+        
+    def next(self):
+        """ New id. """
+        
+        return self.take(1)[0]
+    
+    def take(self, n):
+        """ ``n`` new ids - in increasing order. """
+        
+        now = int(time.time() * 1e6) << self.SEQ_BITS
+        
+        with self._lock:
+            start = max(now, self._last + 1)
+            self._last = start + n - 1
+            
+        bits = self.NODE_BITS
+        
+        return list(range((start << bits) | self._node, (start + n) << bits, 1 << bits))
+    
+    def advance(self, txn_id):
+        """ Ensure ids generated from now on are greater than ``txn_id`` -
+            e.g. one generated before a restart, with the clock since set back.
+            
+        """
+        
+        with self._lock:
+            self._last = max(self._last, txn_id >> self.NODE_BITS)
+
+EPOCH = datetime(1970, 1, 1)
+
+def datetime_to_us(timestamp):
+    """ Convert naive datetime ``timestamp`` to microseconds since epoch. """
+    
+    delta = timestamp - EPOCH
+    
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def us_to_datetime(us):
+    """ Convert microseconds since epoch ``us`` back to naive datetime. """
+    
+    return EPOCH + timedelta(microseconds=int(us))
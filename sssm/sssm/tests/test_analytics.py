@@ -0,0 +1,147 @@
+import pytest
+from datetime import datetime
+from datetime import timedelta
+import math
+
+import numpy as np
+
+from sssm.backend import RollingVWSP, AllShareIndex, BarBuilder
+
+def test_rolling_vwsp():
+    now = datetime.now()
+    vwsp = RollingVWSP(window=15)
+    
+    with pytest.raises(ValueError):
+        vwsp.value(now)
+        
+    vwsp.add(now - timedelta(minutes=20), 30.0, 100)
+    vwsp.add(now - timedelta(minutes=10), 10.0, 100)
+    vwsp.add(now - timedelta(minutes=5), 20.0, 300)
+    
+    assert vwsp.value(now) == (10.0 * 100 + 20.0 * 300) / 400
+    assert len(vwsp) == 2
+    
+    # window moves on
+    assert vwsp.value(now + timedelta(minutes=6)) == 20.0
+    
+    # trades already out of window are ignored
+    vwsp.add(now - timedelta(minutes=12), 50.0, 100)
+    assert vwsp.value(now + timedelta(minutes=6)) == 20.0
+    
+    # window can't move back
+    assert not vwsp.covers(now)
+    assert vwsp.sums_if_covered(now) is None
+    assert vwsp.values_if_covered(now) is None
+    assert vwsp.sums_if_covered(now + timedelta(minutes=6)) == (20.0 * 300, 300)
+    
+    with pytest.raises(ValueError):
+        vwsp.value(now)
+        
+    with pytest.raises(ValueError):
+        vwsp.value(now + timedelta(minutes=30))
+
+
+def test_rolling_vwsp_symbols():
+    now = datetime.now()
+    vwsp = RollingVWSP(window=15)
+    
+    vwsp.add(now - timedelta(minutes=20), 30.0, 100, symbol='TEA')
+    vwsp.add(now - timedelta(minutes=10), 10.0, 100, symbol='TEA')
+    vwsp.add(now - timedelta(minutes=5), 20.0, 300, symbol='TEA')
+    vwsp.add(now - timedelta(minutes=5), 40.0, 100, symbol='GIN')
+    
+    assert vwsp.value(now, symbol='TEA') == (10.0 * 100 + 20.0 * 300) / 400
+    assert vwsp.value(now, symbol='GIN') == 40.0
+    assert vwsp.values(now) == {'TEA': (10.0 * 100 + 20.0 * 300) / 400, 'GIN': 40.0}
+    assert vwsp.values(now, symbols=['GIN', 'POP']) == {'GIN': 40.0}
+    
+    with pytest.raises(ValueError):
+        vwsp.value(now, symbol='POP')
+        
+    assert vwsp.values(now + timedelta(minutes=20)) == {}
+
+
+def test_all_share_index():
+    index = AllShareIndex()
+    
+    assert math.isnan(index.value())
+    
+    index.update('TEA', 2.0)
+    index.update('POP', 8.0)
+    index.update('GIN', -1.0)
+    
+    assert abs(index.value() - 4.0) < 1e-12
+    assert len(index) == 2
+    
+    index.update('TEA', 32.0)
+    assert abs(index.value() - 16.0) < 1e-12
+    
+    # stock no longer trading
+    index.update('POP', 8.0, trading=False)
+    assert abs(index.value() - 32.0) < 1e-12
+    
+    # large universe - product of prices would overflow
+    prices = np.random.uniform(100.0, 1000.0, 10000)
+    
+    index = AllShareIndex()
+    
+    for i, price in enumerate(prices):
+        index.update('S{}'.format(i), price)
+        
+    assert np.isinf(prices.prod())
+    assert abs(index.value() - np.exp(np.log(prices).mean())) < 1e-6
+
+def test_bar_builder():
+    start = datetime(2017, 1, 1, 10)
+    rng = np.random.RandomState(42)
+    
+    # 2 hours of trades - out of time order
+    trades = [(start + timedelta(seconds=float(secs)), float(price), int(qty), symbol) \
+              for secs, price, qty, symbol in zip(rng.uniform(0, 7200, 2000), rng.uniform(10, 20, 2000),
+                                                  rng.randint(1, 100, 2000), rng.choice(['TEA', 'GIN'], 2000))]
+    
+    added, extended = BarBuilder(symbols=1), BarBuilder(symbols=1)
+    
+    for trade in trades:
+        added.add(*trade)
+        
+    for i in range(0, len(trades), 300):
+        extended.extend(*zip(*trades[i:i + 300]))
+        
+    for res in added.resolutions:
+        for symbol in ('TEA', 'GIN'):
+            bars = added.bars(symbol, res)
+            
+            assert [dict(bar, vwap=None) for bar in extended.bars(symbol, res)] == \
+                   [dict(bar, vwap=None) for bar in bars]
+            assert [bar['vwap'] for bar in extended.bars(symbol, res)] == \
+                   pytest.approx([bar['vwap'] for bar in bars])
+            
+    # 5 min bars - in time order
+    in_order = sorted(trade for trade in trades if trade[3] == 'TEA' and trade[0] < start + timedelta(minutes=5))
+    bar = added.bars('TEA', 300)[0]
+    
+    assert bar['start'] == start
+    assert (bar['open'], bar['close']) == (in_order[0][1], in_order[-1][1])
+    assert (bar['low'], bar['high']) == (min(t[1] for t in in_order), max(t[1] for t in in_order))
+    assert (bar['volume'], bar['count']) == (sum(t[2] for t in in_order), len(in_order))
+    assert len(added.bars('TEA', 300)) == 24
+    assert len(added.bars('TEA', 300, start=start + timedelta(minutes=1), 
+                          end=start + timedelta(minutes=60))) == 11
+    
+    # 1 sec ring holds last 15 mins only
+    assert len(added.bars('TEA', 1)) <= 900
+    
+    # aligned intervals summed from bars
+    assert added.sums(start, start + timedelta(hours=2)) == \
+           pytest.approx((sum(t[1] * t[2] for t in trades), sum(t[2] for t in trades)))
+    assert added.sums(start + timedelta(minutes=10), start + timedelta(minutes=70), symbol='GIN') == \
+           pytest.approx((sum(t[1] * t[2] for t in trades if t[3] == 'GIN' and \
+                              start + timedelta(minutes=10) <= t[0] < start + timedelta(minutes=70)),
+                          sum(t[2] for t in trades if t[3] == 'GIN' and \
+                              start + timedelta(minutes=10) <= t[0] < start + timedelta(minutes=70))))
+    assert added.sums(start, start + timedelta(seconds=90)) is None
+    assert added.sums(start, start + timedelta(minutes=1), symbol='POP') == (0.0, 0)
+    
+    with pytest.raises(ValueError):
+        added.bars('TEA', 7)
@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+import json
+import pytest
+import threading
+import time
+from datetime import datetime
+from datetime import timedelta
+from concurrent.futures import Future
+
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from tornado.websocket import websocket_connect
+
+import api
+from sssm.backend import Store, Trader, Platform
+
+class APITestCase(AsyncHTTPTestCase):
+    
+    def setUp(self):
+        api.s = Store()
+        api.p = Platform(api.s)
+        
+        token = Trader('trader1', store=api.s).save()
+        now = datetime.now()
+        
+        api.p.trade('trader1', token, 'TEA', 100, 10.0, timestamp=now - timedelta(minutes=1))
+        api.p.trade('trader1', token, 'GIN', 300, 20.0, timestamp=now - timedelta(minutes=1))
+        
+        super(APITestCase, self).setUp()
+        
+    def get_app(self):
+        return api.Application(debug=False)
+    
+    def get_body(self, url):
+        response = self.fetch(url)
+        
+        self.assertEqual(response.code, 200)
+        
+        return response.body.decode()
+    
+class TestHandlers(APITestCase):
+    
+    def test_platform(self):
+        info = json.loads(self.get_body("/platform"))
+        
+        self.assertAlmostEqual(info["all_share_index"], (10.0 * 20.0) ** 0.5)
+        self.assertAlmostEqual(info["volume_weighted_stock_price"], 17.5)
+        self.assertEqual(info["volume_weighted_stock_prices"], {"TEA": 10.0, "GIN": 20.0})
+        
+        self.assertAlmostEqual(float(self.get_body("/platform/index")), (10.0 * 20.0) ** 0.5)
+        self.assertAlmostEqual(float(self.get_body("/platform/volume_weighted_stock_price")), 17.5)
+        self.assertEqual(float(self.get_body("/platform/volume_weighted_stock_price?symbol=GIN")), 20.0)
+        self.assertEqual(json.loads(self.get_body("/platform/volume_weighted_stock_price?symbol=GIN,POP")),
+                         {"GIN": 20.0})
+        self.assertEqual(self.get_body("/platform/volume_weighted_stock_price?symbol=XYZ"), 
+                         "Stock XYZ is not trading.")
+        
+        for interval in ("abc", "1.5", "0", "-5"):
+            self.assertEqual(self.get_body("/platform/volume_weighted_stock_price?interval=" + interval),
+                             "API: Interval must be a positive number of mins.")
+        
+    def test_stock(self):
+        self.assertEqual(float(self.get_body("/stock/POP?operation=dividend&price=16.0")), 0.5)
+        self.assertEqual(float(self.get_body("/stock/POP?operation=peratio&price=16.0")), 32.0)
+        self.assertEqual(self.get_body("/stock/XYZ?operation=peratio&price=16.0"), "Stock XYZ is not trading.")
+        self.assertEqual(self.get_body("/stock/POP?operation=peratio"), "Price must be provided for peratio")
+        
+    def test_bars(self):
+        bars = json.loads(self.get_body("/stock/TEA/bars?res=1m"))
+        
+        self.assertEqual(bars["res"], 60)
+        self.assertEqual([(bar["open"], bar["volume"], bar["vwap"]) for bar in bars["bars"]],
+                         [(10.0, 100, 10.0)])
+        
+        start = datetime.now().replace(microsecond=0).isoformat()
+        
+        self.assertEqual(json.loads(self.get_body("/stock/TEA/bars?res=60&from=" + start))["bars"], [])
+        self.assertEqual(self.get_body("/stock/TEA/bars?res=7"), 
+                         "[ERROR] BarBuilder: Resolution 7 isn't kept - one of [1, 60, 300, 3600].")
+        self.assertEqual(self.get_body("/stock/XYZ/bars"), "Stock XYZ is not trading.")
+        
+    def test_executor_limit(self):
+        self._app.executor = api.AnalyticsExecutor(workers=1, max_pending=0)
+        
+        self.assertEqual(self.fetch("/platform/index").code, 503)
+        
+    def test_response_cache(self):
+        self._app.cache = api.ResponseCache(bucket=3600)
+        
+        response = self.fetch("/platform/index")
+        etag = response.headers["Etag"]
+        
+        self.assertEqual(len(self._app.cache), 1)
+        
+        # unchanged store - cached response and revalidation
+        self.assertEqual(self.fetch("/platform/index").headers["Etag"], etag)
+        self.assertEqual(len(self._app.cache), 1)
+        self.assertEqual(self.fetch("/platform/index", headers={"If-None-Match": etag}).code, 304)
+        
+        # trade invalidates
+        token = api.s['traders']['trader1']['token']
+        api.p.trade('trader1', token, 'TEA', 100, 40.0, timestamp=datetime.now())
+        
+        response = self.fetch("/platform/index", headers={"If-None-Match": etag})
+        
+        self.assertEqual(response.code, 200)
+        self.assertNotEqual(response.headers["Etag"], etag)
+        self.assertAlmostEqual(float(response.body.decode()), (40.0 * 20.0) ** 0.5)
+        
+        # only time dependent responses expire with time bucket
+        self._app.cache = api.ResponseCache(bucket=0.01)
+        
+        etags = [self.fetch(url).headers["Etag"] for url in \
+                 ("/platform/index", "/platform/volume_weighted_stock_price")]
+        time.sleep(0.02)
+        
+        self.assertEqual(self.fetch("/platform/index", headers={"If-None-Match": etags[0]}).code, 
+                         304)
+        self.assertEqual(self.fetch("/platform/volume_weighted_stock_price", 
+                                    headers={"If-None-Match": etags[1]}).code, 200)
+
+    def test_transactions_executor_full(self):
+        token = api.s['traders']['trader1']['token']
+        api.p.trade_many(['trader1'] * 20, [token] * 20, ['TEA', 'GIN'] * 10, [100] * 20, 
+                         [10.0] * 20)
+        
+        executor = self._app.executor = api.AnalyticsExecutor(workers=2, max_pending=2)
+        chunk_size = api.options.transactions_chunk_size
+        transactions = api.p.transactions
+        expected = len(api.s['transactions'])
+        held, filling = [], []
+        
+        def fill():
+            # other requests take every slot freed
+            while executor.pending < 2:
+                slot = executor.reserve()
+                slot.__enter__()
+                held.append(slot)
+                
+            if filling:
+                self.io_loop.add_callback(fill)
+            
+        def export(*args, **kwargs):
+            if not filling:
+                filling.append(True)
+                self.io_loop.add_callback(fill)
+                
+            return transactions(*args, **kwargs)
+        
+        api.options.transactions_chunk_size = 3
+        api.p.transactions = export
+        
+        try:
+            page = json.loads(self.get_body("/transactions"))
+            
+            # export started is completed - further requests are rejected
+            self.assertEqual(len(page["transactions"]), expected)
+            self.assertEqual(self.fetch("/platform/index").code, 503)
+        finally:
+            del filling[:]
+            api.options.transactions_chunk_size = chunk_size
+            del api.p.transactions
+            
+            for slot in held:
+                slot.__exit__(None, None, None)
+                
+    def test_transactions(self):
+        token = api.s['traders']['trader1']['token']
+        now = datetime.now()
+        
+        api.p.trade_many(['trader1'] * 20, [token] * 20, ['TEA', 'GIN'] * 10, [100] * 20, 
+                         [10.0 + i for i in range(20)], 
+                         timestamps=[now - timedelta(seconds=i) for i in range(20)])
+        
+        expected = api.s['transactions'].find()
+        chunk_size = api.options.transactions_chunk_size
+        
+        # pages of several chunks
+        api.options.transactions_chunk_size = 3
+        
+        try:
+            for limit in (7, 50):
+                ids, cursor = [], None
+                
+                while True:
+                    url = "/transactions?limit={}".format(limit)
+                    page = json.loads(self.get_body(url + "&cursor=" + cursor if cursor else url))
+                    ids.extend(record["id"] for record in page["transactions"])
+                    cursor = page["cursor"]
+                    
+                    if cursor is None:
+                        break
+                    
+                self.assertEqual(ids, expected)
+        finally:
+            api.options.transactions_chunk_size = chunk_size
+            
+        page = json.loads(self.get_body("/transactions?symbol=GIN&since=" + 
+                                        (now - timedelta(seconds=5)).isoformat()))
+        
+        self.assertEqual([(record["symbol"], record["per_price"]) for record in page["transactions"]],
+                         [("GIN", 13.0), ("GIN", 11.0)])
+        self.assertEqual(page["transactions"][0]["ts"], (now - timedelta(seconds=3)).isoformat())
+        self.assertIsNone(page["cursor"])
+        
+        self.assertEqual(json.loads(self.get_body("/transactions?trader=trader2")),
+                         {"transactions": [], "cursor": None})
+        self.assertEqual(self.fetch("/transactions?cursor=abc").code, 400)
+        self.assertEqual(self.fetch("/transactions?limit=0").code, 400)
+        
+    @gen_test
+    def test_feed(self):
+        self._app.feed = api.MarketFeed(self._app.executor, tick=0.05)
+        
+        url = "ws://127.0.0.1:{}/feed?symbols=TEA".format(self.get_http_port())
+        conn = yield websocket_connect(url)
+        
+        # last values - none computed yet - then first update
+        self.assertEqual(json.loads((yield conn.read_message()))["stocks"], {})
+        
+        update = json.loads((yield conn.read_message()))
+        
+        self.assertEqual(update["stocks"], 
+                         {"TEA": {"price": 10.0, "volume_weighted_stock_price": 10.0}})
+        self.assertAlmostEqual(update["all_share_index"], (10.0 * 20.0) ** 0.5)
+        
+        # trades of other stocks aren't sent
+        token = api.s['traders']['trader1']['token']
+        api.p.trade('trader1', token, 'GIN', 100, 40.0)
+        api.p.trade('trader1', token, 'TEA', 100, 30.0)
+        
+        update = json.loads((yield conn.read_message()))
+        
+        self.assertEqual(update["stocks"], 
+                         {"TEA": {"price": 30.0, "volume_weighted_stock_price": 20.0}})
+        self.assertAlmostEqual(update["all_share_index"], (30.0 * 40.0) ** 0.5)
+        
+        # one update computed for all subscribers
+        other = yield websocket_connect(url.replace("?symbols=TEA", ""))
+        updates = self._app.feed.updates
+        
+        self.assertEqual(len(self._app.feed), 2)
+        self.assertEqual(len(json.loads((yield other.read_message()))["stocks"]), 2)
+        
+        api.p.trade('trader1', token, 'TEA', 100, 40.0)
+        
+        yield conn.read_message()
+        yield other.read_message()
+        
+        self.assertEqual(self._app.feed.updates, updates + 1)
+        
+        conn.close()
+        other.close()
+        self._app.feed.stop()
+
+
+def test_feed_subscription():
+    sent = []
+    closed = []
+    
+    def send(message):
+        sent.append(json.loads(message))
+        sent[-1]["future"] = Future()
+        
+        return sent[-1]["future"]
+    
+    subscription = api.FeedSubscription(send, lambda: closed.append(True), symbols=["TEA", "GIN"],
+                                        max_stalled=5)
+    update = {"time": 1, "all_share_index": 10.0, 
+              "stocks": {"TEA": {"price": 10.0}, "POP": {"price": 5.0}}}
+    messages = {}
+    
+    assert subscription.push(update, messages)
+    assert messages == {frozenset(["TEA", "GIN"]): json.dumps({"time": 1, "all_share_index": 10.0,
+                                                               "stocks": {"TEA": {"price": 10.0}}})}
+    assert len(sent) == 1
+    
+    # updates coalesced while subscriber is behind
+    assert subscription.push({"time": 2, "stocks": {"TEA": {"price": 11.0}}})
+    assert subscription.push({"time": 3, "stocks": {"GIN": {"price": 20.0}}})
+    assert subscription.push({"time": 4, "stocks": {"POP": {"price": 6.0}}})
+    assert len(sent) == 1
+    assert subscription.stalled == 3
+    
+    sent[0]["future"].set_result(None)
+    
+    assert subscription.push()
+    assert len(sent) == 2
+    assert sent[1]["time"] == 3
+    assert sent[1]["stocks"] == {"TEA": {"price": 11.0}, "GIN": {"price": 20.0}}
+    assert subscription.stalled == 0
+    
+    # nothing subscribed to - nothing sent
+    sent[1]["future"].set_result(None)
+    
+    assert subscription.push({"time": 5, "stocks": {"POP": {"price": 7.0}}})
+    assert len(sent) == 2
+    
+    # too slow - disconnected
+    assert subscription.push({"time": 6, "stocks": {"TEA": {"price": 12.0}}})
+    assert len(sent) == 3
+    
+    for i in range(4):
+        assert subscription.push({"time": 7 + i, "stocks": {"TEA": {"price": 13.0}}})
+        
+    assert not closed
+    assert not subscription.push({"time": 11, "stocks": {"TEA": {"price": 14.0}}})
+    assert closed == [True]
+
+
+def test_trade_stream_parser():
+    body = u'[{"symbol": "TEA", "qty": 1}, {"symbol": "GÏN", "qty": 2},\n {"symbol": "POP"}]'.encode("utf-8")
+    
+    # feed body in small chunks - splitting objects and multi-byte characters
+    parser = api.TradeStreamParser()
+    trades = []
+    
+    for i in range(0, len(body), 5):
+        trades.extend(parser.feed(body[i:i + 5]))
+        
+    parser.close()
+    
+    assert trades == [{"symbol": "TEA", "qty": 1}, {"symbol": u"GÏN", "qty": 2}, {"symbol": "POP"}]
+    
+    parser = api.TradeStreamParser()
+    
+    assert parser.feed(b'{"symbol": "TEA"}\n{"symbol": "GIN"}\n{"sym') == [{"symbol": "TEA"}, {"symbol": "GIN"}]
+    
+    with pytest.raises(ValueError):
+        parser.close()
+        
+class TestTradeHandler(APITestCase):
+    
+    def post_trades(self, body):
+        response = self.fetch("/platform/trade", method="POST", body=body)
+        
+        return response.code, json.loads(response.body.decode())
+    
+    def test_post_trades(self):
+        token = str(api.s['traders']['trader1']['token'])
+        trade = {"trader": "trader1", "token": token, "symbol": "POP", "qty": 10, "price": 16.0,
+                 "timestamp": "2017-01-01T10:00:00.500000"}
+        
+        # single trade
+        code, response = self.post_trades(json.dumps(trade))
+        
+        self.assertEqual(code, 200)
+        self.assertEqual(response["accepted"], 1)
+        
+        txn = api.s['transactions'][response["results"][0]["id"]]
+        
+        self.assertEqual(txn['ts'], datetime(2017, 1, 1, 10, 0, 0, 500000))
+        self.assertEqual(txn['volume'], 10)
+        
+        # newline delimited and array batches - applied in batches of 2
+        api.options.trade_batch_size = 2
+        
+        trades = [dict(trade, qty=i + 1) for i in range(3)] + \
+                 [dict(trade, type="SELL", qty=1000), dict(trade, token="invalid"), {"trader": "trader1"}]
+        
+        for body in ["\n".join(json.dumps(t) for t in trades), json.dumps(trades)]:
+            code, response = self.post_trades(body)
+            
+            self.assertEqual(code, 200)
+            self.assertEqual(response["accepted"], 3)
+            self.assertEqual(response["rejected"], 3)
+            self.assertEqual([r["status"] == "OK" for r in response["results"]], 
+                             [True, True, True, False, False, False])
+            self.assertTrue(all(r["id"] for r in response["results"][:3]))
+            
+        api.options.trade_batch_size = 1000
+        
+        self.assertEqual(api.s['traders']['trader1']['portfolio'].qty('POP'), 10 + 2 * (1 + 2 + 3))
+        
+    @gen_test
+    def test_post_trades_off_ioloop(self):
+        token = str(api.s['traders']['trader1']['token'])
+        trade = {"trader": "trader1", "token": token, "symbol": "POP", "qty": 10, "price": 16.0}
+        
+        # trading paused - as while snapshotting
+        held, resume = threading.Event(), threading.Event()
+        
+        def snapshot():
+            with api.p._trader_locks.hold('trader1'):
+                held.set()
+                resume.wait(2.0)
+                
+        thread = threading.Thread(target=snapshot)
+        thread.start()
+        held.wait()
+        
+        posted = self.http_client.fetch(self.get_url("/platform/trade"), method="POST", 
+                                        body=json.dumps(trade))
+        response = yield self.http_client.fetch(self.get_url("/platform/index"))
+        
+        # answered while trade waits
+        self.assertEqual(response.code, 200)
+        self.assertTrue(thread.is_alive())
+        self.assertFalse(posted.done())
+        
+        resume.set()
+        thread.join()
+        
+        response = yield posted
+        
+        self.assertEqual(json.loads(response.body.decode())["accepted"], 1)
+        
+    def test_post_trades_failing(self):
+        token = str(api.s['traders']['trader1']['token'])
+        trades = [{"trader": "trader1", "token": token, "symbol": "POP", "qty": 10, "price": 16.0}] * 3
+        
+        def trade_many(*args, **kwargs):
+            raise TypeError("Failed to record trades.")
+        
+        api.p.trade_many = trade_many
+        
+        try:
+            code, response = self.post_trades(json.dumps(trades))
+        finally:
+            del api.p.trade_many
+            
+        # reported per trade
+        self.assertEqual(code, 200)
+        self.assertEqual((response["accepted"], response["rejected"]), (0, 3))
+        self.assertEqual([r["status"] for r in response["results"]], 
+                         ["Failed to record trades."] * 3)
+        
+    def test_post_malformed_trades(self):
+        token = str(api.s['traders']['trader1']['token'])
+        trade = {"trader": "trader1", "token": token, "symbol": "POP", "qty": 10, "price": 16.0}
+        
+        code, response = self.post_trades(json.dumps(trade) + '\n{"trader": ')
+        
+        self.assertEqual(code, 400)
+        self.assertEqual(response["accepted"], 1)
+        self.assertIn("error", response)
+        
+class TestSequencedTradeHandler(TestTradeHandler):
+    
+    def get_app(self):
+        self.sequencer = api.p.sequenced(batch_size=2)
+        
+        return api.Application(debug=False, sequencer=self.sequencer)
+    
+    def tearDown(self):
+        self.sequencer.stop()
+        
+        super(TestSequencedTradeHandler, self).tearDown()
+        
+    def test_sequencer_metrics(self):
+        self.assertEqual(json.loads(self.get_body("/platform/sequencer"))["trades"], 0)
+        
+        token = str(api.s['traders']['trader1']['token'])
+        trades = [{"trader": "trader1", "token": token, "symbol": "POP", "qty": i + 1, "price": 16.0}
+                  for i in range(5)]
+        code, response = self.post_trades(json.dumps(trades))
+        
+        self.assertEqual(response["accepted"], 5)
+        
+        metrics = json.loads(self.get_body("/platform/sequencer"))
+        
+        self.assertEqual(metrics["trades"], 5)
+        self.assertEqual(metrics["depth"], 0)
+        self.assertLessEqual(metrics["max_batch"], 2)
+        self.assertGreaterEqual(metrics["batches"], 3)
+        
+    def test_sequencer_not_running(self):
+        self._app.sequencer = None
+        
+        self.assertEqual(self.fetch("/platform/sequencer").code, 404)
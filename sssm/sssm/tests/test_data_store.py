@@ -1,7 +1,13 @@
 import pytest
 from datetime import datetime
+from datetime import timedelta
+import uuid
 
-from sssm.backend import Store
+import numpy as np
+
+from sssm.backend import Store, Journal, Platform, Trader
+from sssm.backend.data_store import TransactionLog
+from sssm.backend.util import datetime_to_us, MonotonicIds
 
 def test_errors():
     
@@ -37,6 +43,39 @@ def test_traders_store():
     assert len(s.get_traders()) == 0
 
     
+def test_trader_sessions():
+    
+    s = Store()
+    token = Trader('trader1', store=s).save()
+    sessions = s.sessions
+    
+    # tokens compared by value - e.g. as received over HTTP
+    for candidate in (token, str(token), str(token).encode('utf-8'), uuid.UUID(str(token))):
+        assert sessions.authenticate('trader1', candidate) is s['traders']['trader1']
+        
+    for candidate in (None, 'token', str(uuid.uuid4()), str(token)[:-1]):
+        assert sessions.authenticate('trader1', candidate) is None
+        
+    assert sessions.authenticate('trader2', token) is None
+    assert len(sessions) == 1
+    
+    # records replaced or changed directly - e.g. replayed
+    s['traders']['trader1'] = {'id': 'trader1', 'token': 'new'}
+    
+    assert sessions.authenticate('trader1', token) is None
+    assert sessions.authenticate('trader1', u'new') is s['traders']['trader1']
+    
+    s['traders']['trader1']['token'] = 'newer'
+    
+    assert sessions.authenticate('trader1', 'new') is None
+    assert sessions.authenticate('trader1', 'newer') is not None
+    
+    del s['traders']['trader1']
+    
+    assert sessions.authenticate('trader1', 'newer') is None
+    assert len(sessions) == 0
+
+
 def test_transactions_store():
     
     s = Store()
@@ -117,4 +156,271 @@ def test_portfolio_store():
     assert len(s['traders']['trader1']['portfolio']) == 2
     assert s['traders']['trader1']['portfolio']['TEA']['qty'] == 9000
     assert s['traders']['trader1']['portfolio']['GIN']['qty'] == 8000
-    
\ No newline at end of file
+    
+    
+def test_transaction_log():
+    
+    log = TransactionLog(capacity=2)
+    now = datetime.now().replace(microsecond=0)
+    
+    # trades appended out of time order
+    for i in [3, 0, 4, 1, 2]:
+        log.append('txn{}'.format(i), now - timedelta(minutes=i), 
+                   'TEA' if i % 2 == 0 else 'GIN', 100 * (i + 1), 10.0 + i, 
+                   'BUY', 'trader{}'.format(i))
+        
+    assert len(log) == 5
+    assert list(log) == ['txn3', 'txn0', 'txn4', 'txn1', 'txn2']
+    assert log['txn1'] == {'trader': 'trader1', 'id': 'txn1', 'type': 'BUY',
+                           'ts': now - timedelta(minutes=1), 'symbol': 'GIN',
+                           'volume': 200, 'value': 200 * 11.0, 'per_price': 11.0}
+    
+    assert log.find() == ['txn4', 'txn3', 'txn2', 'txn1', 'txn0']
+    assert log.find(now - timedelta(minutes=3)) == ['txn2', 'txn1', 'txn0']
+    assert log.find(now - timedelta(minutes=3), now - timedelta(minutes=1)) == ['txn2', 'txn1']
+    assert log.find(symbol='GIN') == ['txn3', 'txn1']
+    assert log.find(symbol='POP') == []
+    
+    assert log.volume_weighted(symbol='GIN') == (400 * 13.0 + 200 * 11.0, 600)
+    assert log.volume_weighted_by_symbol(now - timedelta(minutes=3)) == \
+        {'TEA': (300 * 12.0 + 100 * 10.0, 400), 'GIN': (200 * 11.0, 200)}
+    
+    # deleted and replaced transactions
+    del log['txn0']
+    log['txn2'] = dict(log['txn2'], per_price=20.0)
+    
+    assert 'txn0' not in log
+    assert len(log) == 4
+    assert log['txn2']['value'] == 300 * 20.0
+    assert log.find(now - timedelta(minutes=3)) == ['txn2', 'txn1']
+    
+    with pytest.raises(KeyError):
+        log['txn0']
+        
+    with pytest.raises(ValueError):
+        log.append('txn5', now, 'TEA', 100, 10.0, 'HOLD', 'trader1')
+    
+def test_transaction_log_int_ids():
+    
+    log = TransactionLog(capacity=2)
+    now = datetime.now()
+    
+    # increasing ids are searched in place
+    log.extend([10, 20, 30], [now] * 3, ['TEA'] * 3, [100] * 3, [10.0] * 3, ['BUY'] * 3,
+               ['trader1'] * 3)
+    log.append(40, now, 'GIN', 100, 10.0, 'BUY', 'trader1')
+    
+    assert log._ids.array().dtype == np.int64
+    assert 20 in log and 25 not in log and 'txn' not in log
+    assert log[40]['symbol'] == 'GIN'
+    assert log.max_id() == 40
+    
+    del log[20]
+    
+    assert 20 not in log
+    assert list(log) == [10, 30, 40]
+    
+    # repeated and text ids
+    log.extend([30, 50, 50], [now] * 3, ['POP'] * 3, [100] * 3, [10.0] * 3, ['BUY'] * 3,
+               ['trader1'] * 3)
+    log.append('txn1', now, 'TEA', 100, 10.0, 'BUY', 'trader1')
+    
+    assert len(log) == 5
+    assert log[30]['symbol'] == 'POP'
+    assert sorted(log, key=str) == [10, 30, 40, 50, 'txn1']
+    assert log.find(symbol='POP') == [30, 50]
+
+
+def test_transaction_log_allocated_ids():
+    
+    log = TransactionLog()
+    now = datetime.now()
+    
+    with pytest.raises(ValueError):
+        log.append(None, now, 'TEA', 100, 10.0, 'BUY', 'trader1')
+        
+    # allocated as stored
+    log.ids = MonotonicIds()
+    first = log.append(None, now, 'TEA', 100, 10.0, 'BUY', 'trader1')
+    ids = log.extend(None, [now] * 3, ['GIN'] * 3, [100] * 3, [10.0] * 3, ['BUY'] * 3,
+                     ['trader1'] * 3)
+    
+    assert list(log) == [first] + ids
+    assert first < ids[0] < ids[1] < ids[2]
+    assert log[ids[2]]['symbol'] == 'GIN'
+    assert log.extend(None, [], [], [], [], [], []) == []
+
+
+def test_transaction_log_page():
+    
+    log = TransactionLog()
+    start = datetime(2017, 1, 1, 10)
+    
+    # 3 trades a minute - minutes out of time order
+    for minute in reversed(range(10)):
+        for i in range(3 * minute, 3 * minute + 3):
+            log.append(i, start + timedelta(minutes=minute), 'TEA' if i % 2 else 'GIN', 100, 10.0,
+                       'BUY', 'trader{}'.format(i % 3))
+    
+    def pages(limit, **kwargs):
+        ids, cursor = [], None
+        
+        while True:
+            records, cursor = log.page(after=cursor, limit=limit, **kwargs)
+            ids.extend(record['id'] for record in records)
+            
+            if cursor is None:
+                return ids
+    
+    for limit in (1, 2, 4, 30, 100):
+        assert pages(limit) == log.find() == list(range(30))
+        assert pages(limit, symbol='TEA') == log.find(symbol='TEA')
+        assert pages(limit, since=start + timedelta(minutes=2), trader='trader1') == [10, 13, 16, 19,
+                                                                                    22, 25, 28]
+        
+    assert log.page(symbol='XYZ') == ([], None)
+    assert log.page(trader='trader9') == ([], None)
+    
+    records, cursor = log.page(limit=4)
+    
+    assert records[0] == log[0]
+    assert cursor == (datetime_to_us(start + timedelta(minutes=1)), 3)
+    
+    # trades recorded, deleted meanwhile - cursor's too
+    log.append(30, start + timedelta(minutes=1), 'TEA', 100, 10.0, 'BUY', 'trader0')
+    log.append(31, start, 'TEA', 100, 10.0, 'BUY', 'trader0')
+    del log[3]
+    del log[5]
+    
+    records, cursor = log.page(after=cursor, limit=3)
+    
+    assert [record['id'] for record in records] == [4, 30, 6]
+    
+    records, cursor = log.page(after=(datetime_to_us(start), 'txn'), limit=3)
+    
+    assert [record['id'] for record in records] == [0, 1, 2]
+
+
+def test_transaction_log_compact(tmpdir):
+    
+    log = TransactionLog()
+    start = datetime(2017, 1, 1, 10)
+    
+    # a trade every 20 secs for 10 mins - out of time order
+    trades = [(i, start + timedelta(seconds=20 * i), 'TEA' if i % 3 else 'GIN', 10 * (i + 1),
+               10.0 + i) for i in range(30)]
+    
+    for i, ts, symbol, qty, price in reversed(trades):
+        log.append(i, ts, symbol, qty, price, 'BUY', 'trader1')
+        
+    del log[29]
+    totals = log.volume_weighted()
+    
+    assert log.compact(start + timedelta(minutes=5), bucket=60) == 15
+    assert len(log) == 14
+    assert 0 not in log and 15 in log
+    assert log.find() == list(range(15, 29))
+    assert log.volume_weighted() == pytest.approx(totals)
+    assert log.volume_weighted(since=start + timedelta(minutes=5)) == \
+           pytest.approx((totals[0] - sum(qty * price for i, ts, symbol, qty, price in trades[:16]),
+                          totals[1] - sum(qty for i, ts, symbol, qty, price in trades[:16])))
+    
+    # first minute of TEA - trades 1 and 2
+    bars = log.bars
+    
+    assert len(bars) == 10
+    assert [bars.column(name)[0] for name in ('count', 'qty', 'low', 'high', 'first', 'last')] == \
+           [2, 50, 11.0, 12.0, 11.0, 12.0]
+    assert log.volume_weighted_by_symbol()['GIN'] == \
+           pytest.approx((sum(qty * price for i, ts, symbol, qty, price in trades[:29] \
+                              if symbol == 'GIN'),
+                          sum(qty for i, ts, symbol, qty, price in trades[:29] if symbol == 'GIN')))
+    
+    # bars merged into coarser bars
+    assert log.compact_bars(start + timedelta(minutes=5), bucket=300) == 10
+    assert len(bars) == 2
+    assert list(bars.column('count')) == [10, 5]
+    assert log.volume_weighted() == pytest.approx(totals)
+    
+    # appended after compaction, saved with bars
+    log.append(30, start + timedelta(minutes=11), 'TEA', 100, 20.0, 'BUY', 'trader1')
+    
+    path = str(tmpdir)
+    loaded = TransactionLog.load(path, log.save(path))
+    
+    assert len(loaded) == 15
+    assert list(loaded.bars.column('qty')) == list(bars.column('qty'))
+    assert loaded.volume_weighted() == pytest.approx(log.volume_weighted())
+
+
+def test_snapshot(tmpdir):
+    path = str(tmpdir.join('snapshot'))
+    journal_path = str(tmpdir.join('sssm.journal'))
+    now = datetime.now()
+    
+    s = Store(journal=Journal(journal_path))
+    p = Platform(s)
+    
+    token = Trader('trader1', store=s).save()
+    s.add_stock('NEW', last_dividend=7, shares_trading=1000)
+    
+    p.trade_many(['trader1'] * 4, [token] * 4, ['TEA', 'NEW', 'TEA', 'GIN'], [100, 10, 40, 5], 
+                 [10.0, 20.0, 11.0, 20.0], trade_types=['BUY', 'BUY', 'SELL', 'BUY'],
+                 timestamps=[now - timedelta(seconds=i) for i in (5, 1, 3, 2)])
+    deleted = p.trade('trader1', token, 'GIN', 5, 21.0, timestamp=now)
+    del s['transactions'][deleted]
+    
+    p.save_snapshot(path)
+    
+    # journal tail
+    tail = p.trade('trader1', token, 'TEA', 7, 12.0, timestamp=now)
+    s.journal.close()
+    
+    restored = Store.load_snapshot(path, journal=Journal(journal_path))
+    log = restored['transactions']
+    
+    # columns memory-mapped - until trades are added
+    assert isinstance(Store.load_snapshot(path)['transactions'].column('ts'), np.memmap)
+    assert not isinstance(log.column('ts'), np.memmap)
+    
+    assert restored['stocks'] == s['stocks']
+    assert restored['shares_trading'] == s['shares_trading']
+    assert restored.all_share_index() == pytest.approx(s.all_share_index())
+    assert restored['traders']['trader1']['portfolio'] == s['traders']['trader1']['portfolio']
+    assert restored['traders']['trader1']['created'] == s['traders']['trader1']['created']
+    
+    # searchable before ids are indexed
+    assert log.find(now - timedelta(minutes=1)) == s['transactions'].find(now - timedelta(minutes=1))
+    assert len(log) == len(s['transactions']) == 5
+    assert deleted not in log and tail in log
+    assert all(log[txn] == s['transactions'][txn] for txn in s.get_transactions())
+    
+    # trades added to loaded store
+    restored.set_shares_trading('TEA', 100)
+    p = Platform(restored)
+    p.trade('trader1', restored['traders']['trader1']['token'], 'TEA', 1, 13.0, timestamp=now)
+    
+    assert len(log) == 6
+    assert p.volume_weighted_stock_price(since=5, time_ref=now, symbol='TEA') == \
+           pytest.approx((100 * 10.0 + 40 * 11.0 + 7 * 12.0 + 13.0) / 148)
+    
+    restored.journal.close()
+
+def test_transaction_ids(tmpdir):
+    s = Store(node=3)
+    
+    ids = [s.transaction_ids.next()] + s.transaction_ids.take(1000)
+    
+    assert ids == sorted(set(ids))
+    assert all(txn_id & 0xF == 3 for txn_id in ids)
+    
+    pytest.raises(ValueError, lambda: Store(node=16))
+    
+    # ids stay ahead of those restored - e.g. after clock set back
+    ahead = s.transaction_ids.take(1)[0] + (10 ** 9 << 9)
+    s['transactions'].append(ahead, datetime.now(), 'TEA', 100, 10.0, 'BUY', None)
+    
+    path = str(tmpdir.join('snapshot'))
+    s.save_snapshot(path)
+    
+    assert Store.load_snapshot(path).transaction_ids.next() > ahead
@@ -0,0 +1,130 @@
+import pytest
+from datetime import datetime
+from datetime import timedelta
+import os
+
+from sssm.backend import Store, Trader, Transaction, Platform, Journal
+
+def test_journal_replay(tmpdir):
+    path = str(tmpdir.join('sssm.journal'))
+    now = datetime.now()
+    
+    s = Store(journal=Journal(path, sync_interval=0.01))
+    p = Platform(s)
+    
+    token = Trader('trader1', store=s).save()
+    Trader('trader2', store=s).save()
+    s.add_stock('NEW', last_dividend=7, shares_trading=1000)
+    
+    txn_id = p.trade('trader1', token, 'TEA', 100, 10.0, timestamp=now - timedelta(minutes=1))
+    p.trade_many(['trader1', 'trader1', 'trader2'], [token, token, token],
+                 ['NEW', 'TEA', 'GIN'], [10, 40, 5], [20.0, 11.0, 20.0],
+                 trade_types=['BUY', 'SELL', 'BUY'],
+                 timestamps=[now - timedelta(seconds=i) for i in range(3)])
+    
+    # trade made without holding stock
+    Transaction('GIN', 5, 21.0, timestamp=now, user='trader2', store=s, trade_type='SELL').save()
+    del s['transactions'][txn_id]
+    
+    s.journal.close()
+    
+    restored = Store(journal=Journal(path))
+    
+    assert restored['stocks'] == s['stocks']
+    assert restored['shares_trading'] == s['shares_trading']
+    assert sorted(restored.get_traders()) == ['trader1', 'trader2']
+    assert restored['traders']['trader1']['portfolio'] == s['traders']['trader1']['portfolio']
+    assert restored['traders']['trader1']['token'] == str(token)
+    assert restored['traders']['trader1']['created'] == s['traders']['trader1']['created']
+    assert len(restored['traders']['trader2']['portfolio']) == 0
+    
+    assert sorted(restored.get_transactions()) == sorted(s.get_transactions())
+    assert all(restored['transactions'][txn] == s['transactions'][txn] for txn in s.get_transactions())
+    assert restored.all_share_index() == pytest.approx(s.all_share_index())
+    assert Platform(restored).volume_weighted_stock_prices(since=5, time_ref=now) == \
+           p.volume_weighted_stock_prices(since=5, time_ref=now)
+    
+    # changes after replay are appended
+    restored.set_price('TEA', 42.0)
+    restored.journal.close()
+    
+    assert Store(journal=Journal(path))['stocks']['TEA']['Price'] == 42.0
+    
+def test_journal_torn_record(tmpdir):
+    path = str(tmpdir.join('sssm.journal'))
+    
+    s = Store(journal=Journal(path))
+    s.set_price('TEA', 12.0)
+    s.set_price('GIN', 13.0)
+    s.journal.close()
+    
+    size = os.path.getsize(path)
+    
+    # crash mid-write of last record
+    with open(path, 'r+b') as f:
+        f.truncate(size - 3)
+        
+    s = Store(journal=Journal(path))
+    
+    assert s['stocks']['TEA']['Price'] == 12.0
+    assert s['stocks']['GIN']['Price'] != 13.0
+    
+    # torn record is discarded
+    s.set_price('POP', 14.0)
+    s.journal.close()
+    
+    s = Store(journal=Journal(path))
+    
+    assert s['stocks']['TEA']['Price'] == 12.0
+    assert s['stocks']['POP']['Price'] == 14.0
+    
+def test_journal_open_offset(tmpdir):
+    path = str(tmpdir.join('sssm.journal'))
+    
+    with open(path, 'wb') as f:
+        f.write(b'x' * 100)
+        
+    # synced offset is end of journal kept - before anything is written
+    journal = Journal(path)
+    journal.open(60)
+    
+    assert journal.sync() == 60
+    
+    journal.close()
+    
+    assert os.path.getsize(path) == 60
+    
+def test_journal_group_commit(tmpdir):
+    path = str(tmpdir.join('sssm.journal'))
+    
+    journal = Journal(path, sync_every=10, sync_interval=60)
+    s = Store(journal=journal)
+    
+    for i in range(25):
+        s.set_price('TEA', 10.0 + i)
+        
+    # synced every 10 records
+    assert journal.syncs == 2
+    assert journal.pending == 5
+    
+    journal.sync()
+    
+    assert journal.syncs == 3
+    assert journal.pending == 0
+    
+    journal.close()
+    
+    # synced within interval
+    journal = Journal(path, sync_interval=0.01)
+    s = Store(journal=journal)
+    s.set_price('TEA', 50.0)
+    
+    for i in range(100):
+        if journal.pending == 0:
+            break
+        
+        journal._closed.wait(0.01)
+        
+    assert journal.pending == 0
+    
+    journal.close()
@@ -1,7 +1,8 @@
 import pytest
 from datetime import datetime
+from datetime import timedelta
 
-from sssm.backend import CommonStock, PreferredStock, Transaction, Store, Trader, Shares_Trading
+from sssm.backend import CommonStock, PreferredStock, Transaction, Store, Trader, Portfolio, Shares_Trading
 from sssm.backend import data
 import uuid
 
@@ -158,21 +159,11 @@ def test_trades_access():
                  timestamp=timestamp, user=trader,
                  store=s, trade_type=trade_type)
     
-    expected_transaction_id = str(uuid.uuid3(
-                                        uuid.NAMESPACE_DNS,
-                                         str(timestamp) 
-                                         + trade_type  
-                                         + str(price) 
-                                         + trader 
-                                         + stock 
-                                         + str(qty)
-    ))
-    
     txn_value = qty * price
     
     expected_txn = {
                 'trader': trader,
-                'id': expected_transaction_id,
+                'id': None,
                 'type': trade_type,
                 'ts':  timestamp,
                 'symbol' : stock,
@@ -181,7 +172,80 @@ def test_trades_access():
                 'per_price': price
                }
     transaction_id = t.save()
+    expected_txn['id'] = transaction_id
+    
+    assert isinstance(transaction_id, int)
+    assert transaction_id in s.get_transactions()
+    assert t.load(transaction_id) == expected_txn
+    
+    # same trade again is a new transaction - with a greater id
+    repeated_id = Transaction(stock, qty, price, timestamp=timestamp, user=trader,
+                              store=s, trade_type=trade_type).save()
+    
+    assert repeated_id > transaction_id
+    assert len(s['transactions']) == 2
+
+def test_trades_find():
+    now = datetime.now()
+    s = Store()
+    trader = 'trader1'
+    
+    Trader(trader, store=s).save()
+    
+    txn_ids = []
+    
+    # save trades out of time order
+    for i, stock in zip([3, 0, 4, 1, 2], ['TEA', 'GIN', 'TEA', 'GIN', 'TEA']):
+        t = Transaction(stock, 100 + i, 15.0, 
+                 timestamp=now - timedelta(minutes=i), user=trader,
+                 store=s, trade_type='BUY')
+        txn_ids.append((i, t.save()))
+        
+    by_age = [txn_id for i, txn_id in sorted(txn_ids, reverse=True)]
     
-    assert expected_transaction_id == transaction_id
-    assert expected_transaction_id in s.get_transactions()
-    assert t.load(transaction_id) == expected_txn
\ No newline at end of file
+    txn_orm = Transaction(None, None, 'TEA', store=s)
+    
+    assert txn_orm.find(now - timedelta(minutes=10)) == by_age
+    assert txn_orm.find(now - timedelta(minutes=3)) == by_age[2:]
+    assert txn_orm.find(now - timedelta(minutes=3), until=now - timedelta(minutes=1)) == by_age[2:4]
+    assert txn_orm.find(now - timedelta(minutes=10), symbol='GIN') == [by_age[3], by_age[4]]
+    assert txn_orm.find(now - timedelta(minutes=10), symbol='POP') == []
+    
+    # deleted transactions are not returned
+    del s['transactions'][by_age[0]]
+    assert txn_orm.find(now - timedelta(minutes=10)) == by_age[1:]
+    
+    with pytest.raises(ValueError):
+        txn_orm.find()
+
+
+def test_portfolio():
+    portfolio = Portfolio([{'symbol': 'GIN', 'qty': 50, 'price': 12.0}])
+    
+    portfolio.buy('TEA', 100, 15.0)
+    portfolio.buy('TEA', 20, 16.0)
+    portfolio.sell('GIN', 50)
+    
+    assert portfolio.qty('TEA') == 120
+    assert portfolio.qty('GIN') == 0
+    assert portfolio.qty('POP') == 0
+    assert portfolio.get('POP') is None
+    assert portfolio.get('TEA') == {'symbol': 'TEA', 'qty': 120, 'price': 15.0}
+    
+    # reads as list of positions
+    assert portfolio == [{'symbol': 'GIN', 'qty': 0, 'price': 12.0},
+                         {'symbol': 'TEA', 'qty': 120, 'price': 15.0}]
+    assert portfolio[1]['symbol'] == 'TEA'
+    assert [record['symbol'] for record in portfolio] == ['GIN', 'TEA']
+    assert repr(portfolio[0]) == repr({'symbol': 'GIN', 'qty': 0, 'price': 12.0})
+    assert dict(portfolio.get('TEA')) == {'symbol': 'TEA', 'qty': 120, 'price': 15.0}
+    
+    with pytest.raises(KeyError):
+        portfolio.get('TEA')['value']
+    assert len(portfolio) == 2
+    
+    with pytest.raises(ValueError):
+        portfolio.sell('TEA', 121)
+        
+    with pytest.raises(ValueError):
+        portfolio.sell('POP', 1)
@@ -2,12 +2,14 @@ import pytest
 from datetime import datetime
 from datetime import timedelta
 import random
+import sys
 import uuid
 import logging
+import threading
 
 import numpy as np
 
-from sssm.backend import CommonStock, PreferredStock, Transaction, Store, Trader, Shares_Trading, Platform
+from sssm.backend import CommonStock, PreferredStock, Transaction, Store, Trader, Portfolio, Shares_Trading, Platform
 
 def test_dividend():
     pass
@@ -74,7 +76,64 @@ def test_trading():
     # no sufficient stock to trade
     with pytest.raises(ValueError):
         p.trade(trader, token, stock, qty, price)
+    
+    # trades are made now by default - not when module was loaded
+    before = datetime.now()
+    txn_id = p.trade(trader, token, stock, 10, price)
+    
+    assert s['transactions'][txn_id]['ts'] >= before
+    assert p.bars(stock, 1)[-1]['start'] >= before.replace(microsecond=0)
+    
+    # invalid trades leave positions, shares trading and price as they were
+    positions, shares, stock_price = td.portfolio, st.get_qty(stock), s['stocks'][stock]['Price']
+    
+    for qty, trade_type in ((10, 'buy'), (-10, 'BUY'), (-10, 'SELL'), (1.5, 'BUY')):
+        with pytest.raises(ValueError):
+            p.trade(trader, token, stock, qty, 99.0, trade_type=trade_type)
+            
+    assert td.portfolio == positions
+    assert st.get_qty(stock) == shares
+    assert s['stocks'][stock]['Price'] == stock_price
+    
+    # tokens over HTTP are text - no trader is constructed per trade
+    init, Trader.__init__ = Trader.__init__, None
+    
+    try:
+        assert p.trade(trader, str(token), stock, 10, price)
+        assert p.trade_many([trader, trader, 'trader2'], [str(token), 'invalid', str(token)],
+                            [stock] * 3, [10] * 3, [price] * 3)[0] == \
+               ['OK', "[ERROR] Platform: Failed authentication. Token doesn't match record.",
+                "[ERROR] Platform: Trader trader2 doesn't exist."]
         
+        with pytest.raises(ValueError):
+            p.trade(trader, 'invalid', stock, 10, price)
+        
+        with pytest.raises(ValueError):
+            p.trade('trader2', token, stock, 10, price)
+    finally:
+        Trader.__init__ = init
+        
+def test_stocks_written_to_store():
+    s = Store()
+    p = Platform(s)
+    token = Trader('trader1', store=s).save()
+    
+    # written straight into store - not through Store.add_stock
+    s['stocks']['NEW'] = {"Symbol": "NEW", "Type": "Common", "Last_Dividend": 0, 
+                          "Fixed_Dividend": "NA", "Par_Value": 100, "Price": 10.0}
+    s['shares_trading']['NEW'] = 1000
+    
+    assert 'NEW' in p.stock_symbols() and p.is_trading('NEW')
+    assert p.trade('trader1', token, 'NEW', 100, 12.0)
+    assert p.trade_many(['trader1'], [token], ['NEW'], [100], [12.0])[0] == ['OK']
+    assert p.compute_dividend_yield('NEW', 12.0) == 0
+    
+    del s['stocks']['NEW']
+    
+    with pytest.raises(ValueError):
+        p.trade('trader1', token, 'NEW', 100, 12.0)
+        
+
 def test_volume_weighted_stock_price():
     base_price = 22.0
     stocks = ['TEA', 'GIN', 'JOE', 'ALE', 'POP']
@@ -163,4 +222,424 @@ def test_volume_weighted_stock_price():
         p = Platform(s)
         
         assert ps.pe_ratio(symbol, price) == CommonStock(s).pe_ratio(symbol, price)
-        
\ No newline at end of file
+        
+
+def test_rolling_volume_weighted_stock_price():
+    s = Store()
+    p = Platform(s)
+    
+    trader = 'trader1'
+    token = Trader(trader, store=s).save()
+    now = datetime.now()
+    
+    p.trade(trader, token, 'TEA', 100, 10.0, timestamp=now - timedelta(minutes=20))
+    p.trade(trader, token, 'TEA', 100, 12.0, timestamp=now - timedelta(minutes=10))
+    p.trade(trader, token, 'POP', 300, 20.0, timestamp=now - timedelta(minutes=1))
+    
+    expected = (12.0 * 100 + 20.0 * 300) / 400
+    
+    assert p.volume_weighted_stock_price(time_ref=now) == expected
+    assert p.volume_weighted_stock_price(since=30, time_ref=now) == (10.0 * 100 + 12.0 * 100 + 20.0 * 300) / 500
+    
+    # earlier reference falls back to transactions search
+    assert p.volume_weighted_stock_price(time_ref=now - timedelta(seconds=30)) == expected
+    
+    # platform on existing store picks up trades in window
+    assert Platform(s).volume_weighted_stock_price() == expected
+    
+    # windows read concurrently - each thread's time reference may be behind another's
+    errors = []
+    
+    def read():
+        try:
+            for i in range(500):
+                p.volume_weighted_sums()
+                p.volume_weighted_stock_prices()
+        except ValueError as e:
+            errors.append(e)
+            
+    threads = [threading.Thread(target=read) for i in range(4)]
+    
+    for thread in threads:
+        thread.start()
+        
+    for thread in threads:
+        thread.join()
+        
+    assert errors == []
+
+
+def test_symbols_volume_weighted_stock_price():
+    s = Store()
+    p = Platform(s)
+    
+    trader = 'trader1'
+    token = Trader(trader, store=s).save()
+    now = datetime.now()
+    
+    p.trade(trader, token, 'TEA', 100, 10.0, timestamp=now - timedelta(minutes=20))
+    p.trade(trader, token, 'TEA', 100, 12.0, timestamp=now - timedelta(minutes=10))
+    p.trade(trader, token, 'TEA', 300, 14.0, timestamp=now - timedelta(minutes=2))
+    p.trade(trader, token, 'POP', 300, 20.0, timestamp=now - timedelta(minutes=1))
+    
+    expected = {'TEA': (12.0 * 100 + 14.0 * 300) / 400, 'POP': 20.0}
+    
+    assert p.volume_weighted_stock_price(time_ref=now, symbol='TEA') == expected['TEA']
+    assert p.volume_weighted_stock_prices(time_ref=now) == expected
+    assert p.volume_weighted_stock_prices(time_ref=now, symbols=['POP', 'GIN']) == {'POP': 20.0}
+    
+    # grouped pass over transactions
+    assert p.volume_weighted_stock_price(since=30, time_ref=now, symbol='TEA') == (10.0 * 100 + 12.0 * 100 + 14.0 * 300) / 500
+    
+    prices = p.volume_weighted_stock_prices(time_ref=now - timedelta(seconds=30))
+    
+    assert set(prices) == set(expected)
+    assert abs(prices['TEA'] - expected['TEA']) < 1e-9
+    assert prices['POP'] == expected['POP']
+    
+    with pytest.raises(ValueError):
+        p.volume_weighted_stock_price(time_ref=now, symbol='GIN')
+
+
+def test_trading_positions():
+    s = Store()
+    p = Platform(s)
+    
+    trader = 'trader1'
+    token = Trader(trader, store=s).save()
+    
+    p.trade(trader, token, 'TEA', 100, 15.0)
+    p.trade(trader, token, 'GIN', 50, 12.0)
+    p.trade(trader, token, 'TEA', 30, 16.0, trade_type='SELL')
+    
+    portfolio = s['traders'][trader]['portfolio']
+    
+    assert isinstance(portfolio, Portfolio)
+    assert portfolio.qty('TEA') == 70
+    assert portfolio.qty('GIN') == 50
+    
+    # trader records stored with plain list portfolios are upgraded
+    s['traders']['trader2'] = {'id': 'trader2', 'token': token, 'created': datetime.now(),
+                               'portfolio': [{'symbol': 'POP', 'qty': 10, 'price': 20.0}]}
+    
+    p.trade('trader2', token, 'POP', 10, 21.0, trade_type='SELL')
+    
+    assert s['traders']['trader2']['portfolio'] == [{'symbol': 'POP', 'qty': 0, 'price': 20.0}]
+    
+    with pytest.raises(ValueError):
+        p.trade('trader2', token, 'POP', 1, 21.0, trade_type='SELL')
+
+
+def test_platform_all_share_index():
+    stocks = ['TEA', 'GIN', 'JOE', 'ALE', 'POP']
+    s = Store()
+    p = Platform(s)
+    
+    # no stock priced yet
+    assert np.isnan(p.all_share_index())
+    
+    prices = dict((symbol, 22.0 * random.random() + 1.0) for symbol in stocks)
+    
+    for symbol in stocks:
+        if s.get_type(symbol) == "Preferred":
+            PreferredStock(s).set_current_price(symbol, prices[symbol])
+        else:
+            CommonStock(s).set_current_price(symbol, prices[symbol])
+            
+    expected = np.array([prices[symbol] for symbol in stocks]).prod() ** (1.0 / len(stocks))
+    
+    assert abs(p.all_share_index() - expected) < 1e-9
+    
+    # stock sold out is no longer trading
+    Shares_Trading(s).buy('TEA', s['shares_trading']['TEA'])
+    
+    expected = np.array([prices[symbol] for symbol in stocks[1:]]).prod() ** (1.0 / 4)
+    
+    assert abs(p.all_share_index() - expected) < 1e-9
+
+
+def test_trade_many():
+    s = Store()
+    p = Platform(s)
+    now = datetime.now()
+    
+    token1 = Trader('trader1', store=s).save()
+    token2 = Trader('trader2', store=s).save()
+    
+    tea_init_qty = s['shares_trading']['TEA']
+    
+    statuses, txn_ids = p.trade_many(
+        ['trader1', 'trader1', 'trader2', 'trader2', 'trader3', 'trader1', 'trader1', 'trader1'],
+        [token1, token1, token2, token1, token2, token1, token1, token1],
+        ['TEA', 'TEA', 'GIN', 'GIN', 'GIN', 'XYZ', 'TEA', 'TEA'],
+        np.array([100, 40, 50, 10, 10, 10, 100000000, 61]),
+        np.array([10.0, 11.0, 20.0, 20.0, 20.0, 20.0, 12.0, 12.0]),
+        trade_types=['BUY', 'SELL', 'BUY', 'BUY', 'BUY', 'BUY', 'BUY', 'SELL'],
+        timestamps=[now - timedelta(seconds=i) for i in range(8)])
+    
+    assert statuses[:3] == ['OK', 'OK', 'OK']
+    assert all(status != 'OK' for status in statuses[3:])
+    assert all(txn_ids[:3]) and not any(txn_ids[3:])
+    
+    # positions, shares and prices
+    assert s['traders']['trader1']['portfolio'].qty('TEA') == 60
+    assert s['traders']['trader2']['portfolio'].qty('GIN') == 50
+    assert s['shares_trading']['TEA'] == tea_init_qty - 100
+    assert CommonStock(s).get_current_price('TEA') == 11.0
+    assert PreferredStock(s).get_current_price('GIN') == 20.0
+    
+    # transactions recorded as by single trades
+    assert s['transactions'][txn_ids[1]] == {
+                'trader': 'trader1', 'id': txn_ids[1], 'type': 'SELL',
+                'ts': now - timedelta(seconds=1), 'symbol': 'TEA',
+                'volume': 40, 'value': 40 * 11.0, 'per_price': 11.0}
+    assert Transaction(None, None, 'TEA', store=s).find(now - timedelta(minutes=1)) == txn_ids[2::-1]
+    assert p.volume_weighted_stock_prices(time_ref=now) == {'TEA': (100 * 10.0 + 40 * 11.0) / 140,
+                                                            'GIN': 20.0}
+    
+    with pytest.raises(ValueError):
+        p.trade_many(['trader1'], [token1, token1], ['TEA'], [1], [10.0])
+    
+    # malformed timestamps rejected per trade - before positions are updated
+    recorded = len(s['transactions'])
+    
+    statuses, txn_ids = p.trade_many(['trader1'] * 2, [token1] * 2, ['ALE'] * 2, [5, 5], 
+                                     [10.0, 10.0], timestamps=[None, 'bad'])
+    
+    assert statuses == ['OK', '[ERROR] Platform: Invalid timestamp bad.']
+    assert s['traders']['trader1']['portfolio'].qty('ALE') == 5
+    assert len(s['transactions']) == recorded + 1
+    assert s['transactions'][txn_ids[0]]['ts'] >= now
+    
+    with pytest.raises(ValueError):
+        p.trade('trader1', token1, 'ALE', 5, 10.0, timestamp='bad')
+        
+    assert s['traders']['trader1']['portfolio'].qty('ALE') == 5
+
+
+def test_concurrent_trades():
+    s = Store()
+    p = Platform(s)
+    now = datetime.now()
+    
+    traders = ['trader{}'.format(i) for i in range(8)]
+    tokens = [Trader(trader, store=s).save() for trader in traders]
+    
+    symbols = ['TEA', 'POP', 'ALE']
+    init_qty = dict((symbol, s['shares_trading'][symbol]) for symbol in symbols)
+    
+    def trade(trader, token):
+        for i in range(150):
+            symbol = symbols[i % len(symbols)]
+            timestamp = now - timedelta(milliseconds=i)
+            
+            if i % 50 == 0:
+                p.trade_many([trader] * 3, [token] * 3, symbols, [1, 1, 1], [10.0, 10.0, 10.0],
+                             timestamps=[timestamp] * 3)
+            else:
+                p.trade(trader, token, symbol, 1, 10.0, timestamp=timestamp)
+                
+            if symbol == 'TEA':
+                p.trade(trader, token, symbol, 1, 10.0, trade_type='SELL', timestamp=timestamp)
+    
+    threads = [threading.Thread(target=trade, args=args) for args in zip(traders, tokens)]
+    
+    for thread in threads:
+        thread.start()
+        
+    for thread in threads:
+        thread.join()
+        
+    # no lost updates - each trader bought 52 of each stock and sold 50 TEA
+    for symbol in symbols:
+        assert s['shares_trading'][symbol] == init_qty[symbol] - len(traders) * 52
+        
+        for trader in traders:
+            assert s['traders'][trader]['portfolio'].qty(symbol) == (2 if symbol == 'TEA' else 52)
+            
+    assert len(s.get_transactions()) == len(traders) * (147 + 9 + 50)
+
+
+def test_concurrent_transaction_ids():
+    s = Store()
+    p = Platform(s)
+    
+    traders = ['trader{}'.format(i) for i in range(8)]
+    tokens = [Trader(trader, store=s).save() for trader in traders]
+    
+    def trade(trader, token):
+        for i in range(500):
+            if i % 10 == 0:
+                p.trade_many([trader] * 3, [token] * 3, ['TEA', 'POP', 'ALE'], [1, 1, 1], 
+                             [10.0, 10.0, 10.0])
+            else:
+                p.trade(trader, token, 'GIN', 1, 10.0)
+    
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    
+    try:
+        threads = [threading.Thread(target=trade, args=args) for args in zip(traders, tokens)]
+        
+        for thread in threads:
+            thread.start()
+            
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+        
+    # ids increase in the order stored - looked up without building an index
+    ids = s['transactions']._ids
+    
+    assert len(ids) == len(traders) * (450 + 150)
+    assert ids._increasing
+    assert s['transactions'][ids[0]]['volume'] == 1
+    assert ids._index is None
+
+
+def test_simulate():
+    s = Store()
+    p = Platform(s)
+    
+    recorded = p.simulate(traders=20, trades=5000, duration=10, symbols=50, 
+                          seed=42, batch_size=1000)
+    
+    assert len(s.get_traders()) == 20
+    assert len(s['stocks']) == 50
+    assert len(s.get_transactions()) == recorded
+    assert recorded > 2500
+    
+    # trades spread over last 10 mins
+    now = datetime.now()
+    assert len(Transaction(None, None, 'TEA', store=s).find(now - timedelta(minutes=10, seconds=1))) == recorded
+    assert len(Transaction(None, None, 'TEA', store=s).find(now - timedelta(minutes=5))) < recorded
+    
+    # same seed, same market
+    s2 = Store()
+    
+    assert Platform(s2).simulate(traders=20, trades=5000, duration=10, symbols=50, 
+                                 seed=42, batch_size=1000) == recorded
+    assert s2['shares_trading'] == s['shares_trading']
+
+
+def test_compact():
+    s = Store()
+    p = Platform(s)
+    now = datetime.now()
+    
+    recorded = p.simulate(traders=10, trades=3000, duration=60, symbols=5, seed=42)
+    prices = p.volume_weighted_stock_prices(since=90, time_ref=now)
+    price = p.volume_weighted_stock_price(since=90, time_ref=now, symbol='TEA')
+    recent = p.volume_weighted_stock_prices(time_ref=now)
+    
+    compacted = p.compact(20, bucket=60, time_ref=now)
+    
+    assert 0 < compacted < recorded
+    assert len(s['transactions']) == recorded - compacted
+    assert not s['transactions'].find(until=now - timedelta(minutes=21))
+    
+    # old ranges answered from bars - recent ones as before
+    assert p.volume_weighted_stock_prices(since=90, time_ref=now) == pytest.approx(prices)
+    assert p.volume_weighted_stock_price(since=90, time_ref=now, symbol='TEA') == \
+           pytest.approx(price)
+    assert p.volume_weighted_stock_prices(time_ref=now) == recent
+    
+    p.compact(20, bucket=60, bar_horizon=40, bar_bucket=600, time_ref=now)
+    
+    assert p.volume_weighted_stock_prices(since=90, time_ref=now) == pytest.approx(prices)
+    assert len(s['transactions'].bars) < 5 * 40
+    
+    with pytest.raises(ValueError):
+        p.compact(0)
+
+
+def test_bars():
+    s = Store()
+    p = Platform(s)
+    p.simulate(traders=10, trades=3000, duration=60, symbols=5, seed=42)
+    
+    log = s['transactions']
+    end = datetime.now().replace(second=0, microsecond=0)
+    
+    for start, symbol in ((end - timedelta(minutes=30), None), (end - timedelta(hours=2), 'TEA'),
+                          (end - timedelta(minutes=10, seconds=1), 'GIN')):
+        expected = log.volume_weighted(start - timedelta(microseconds=1), 
+                                       end - timedelta(microseconds=1), symbol=symbol)
+        
+        assert p.bar_volume_weighted_sums(start, end, symbol) == pytest.approx(expected)
+        assert p.bar_volume_weighted_stock_price(start, end, symbol) == \
+               pytest.approx(expected[0] / expected[1])
+        
+    bars = p.bars('TEA', 300)
+    
+    assert sum(bar['count'] for bar in bars) == len(log.find(symbol='TEA'))
+    
+    # seeded from store
+    assert Platform(s).bars('TEA', 300) == bars
+    
+    with pytest.raises(ValueError):
+        p.bar_volume_weighted_stock_price(end - timedelta(hours=3), end - timedelta(hours=2))
+
+
+def test_compacted_bars(tmpdir):
+    s = Store()
+    p = Platform(s)
+    now = datetime.now()
+    p.simulate(traders=10, trades=3000, duration=60, symbols=5, seed=42)
+    
+    bars = p.bars('TEA', 300)
+    
+    p.compact(20, bucket=60, time_ref=now)
+    p.save_snapshot(str(tmpdir))
+    
+    # seeded from bars compacted out of restored store
+    restored = Store.load_snapshot(str(tmpdir))
+    p = Platform(restored)
+    log = restored['transactions']
+    end = datetime.now().replace(second=0, microsecond=0)
+    
+    for start, symbol in ((end - timedelta(minutes=60), None), (end - timedelta(hours=2), 'TEA'),
+                          (end - timedelta(minutes=45), 'GIN'), 
+                          (end - timedelta(minutes=30, seconds=1), 'GIN')):
+        expected = log.volume_weighted(start - timedelta(microseconds=1), 
+                                       end - timedelta(microseconds=1), symbol=symbol)
+        
+        assert p.bar_volume_weighted_sums(start, end, symbol) == pytest.approx(expected)
+        
+    assert [(bar['start'], bar['volume'], bar['count']) for bar in p.bars('TEA', 300)] == \
+           [(bar['start'], bar['volume'], bar['count']) for bar in bars]
+    
+    compacted = log.bars.column('symbol') == log.symbols.get('TEA')
+    
+    assert sum(bar['count'] for bar in p.bars('TEA', 60)) == \
+           len(log.find(symbol='TEA')) + log.bars.column('count')[compacted].sum()
+
+def test_platform_dividend_pe_ratio():
+    s = Store()
+    p = Platform(s)
+    price = 14.0
+    
+    assert p.compute_dividend_yield('JOE', price) == CommonStock(s).dividend_yield('JOE', price)
+    assert p.compute_dividend_yield('GIN', price) == PreferredStock(s).dividend_yield('GIN', price)
+    assert p.pe_ratio('JOE', price) == CommonStock(s).pe_ratio('JOE', price)
+    assert p.pe_ratio('GIN', price) == PreferredStock(s).pe_ratio('GIN', price)
+    
+    # stocks added to store are validated
+    with pytest.raises(ValueError):
+        p.pe_ratio('NEW', price)
+        
+    s.add_stock('NEW', last_dividend=7, shares_trading=1000)
+    
+    assert p.pe_ratio('NEW', price) == price / (7 / price)
+    
+    with pytest.raises(ValueError):
+        s.add_stock('NEW')
+        
+    with pytest.raises(ValueError):
+        p.pe_ratio('NEW', 14)
+        
+    token = Trader('trader1', store=s).save()
+    
+    with pytest.raises(ValueError):
+        p.trade('trader1', token, 'XYZ', 10, price)
@@ -0,0 +1,83 @@
+import pytest
+from datetime import datetime
+from datetime import timedelta
+import threading
+
+from sssm.backend import Store, Trader, Platform, Sequencer
+
+def test_sequencer():
+    s = Store()
+    p = Platform(s)
+    now = datetime.now()
+    
+    token = Trader('trader1', store=s).save()
+    tea_init_qty = s['shares_trading']['TEA']
+    
+    sequencer = p.sequenced(batch_size=10)
+    
+    with pytest.raises(ValueError):
+        sequencer.start()
+        
+    futures = [sequencer.submit('trader1', token, 'TEA', 10, 10.0 + i, 
+                                timestamp=now - timedelta(seconds=i)) for i in range(25)]
+    sold = sequencer.submit('trader1', token, 'TEA', 100, 12.0, trade_type='SELL', timestamp=now)
+    failed = sequencer.submit('trader1', token, 'TEA', 10000, 12.0, trade_type='SELL', timestamp=now)
+    
+    txn_ids = [future.result(timeout=5) for future in futures]
+    
+    assert all(txn_ids) and len(set(txn_ids)) == 25
+    assert sold.result(timeout=5)
+    
+    with pytest.raises(ValueError):
+        failed.result(timeout=5)
+        
+    # applied in order submitted
+    assert s['stocks']['TEA']['Price'] == 12.0
+    assert s['traders']['trader1']['portfolio'].qty('TEA') == 250 - 100
+    assert s['shares_trading']['TEA'] == tea_init_qty - 250
+    
+    metrics = sequencer.metrics()
+    
+    assert metrics['trades'] == 27
+    assert metrics['depth'] == 0
+    assert metrics['max_batch'] <= 10
+    assert metrics['batches'] >= 3
+    assert metrics['mean_batch'] == 27 / metrics['batches']
+    
+    sequencer.stop()
+    
+    assert not sequencer.running
+    
+    with pytest.raises(ValueError):
+        sequencer.submit('trader1', token, 'TEA', 10, 10.0)
+
+def test_sequencer_concurrent_submit():
+    s = Store()
+    p = Platform(s)
+    now = datetime.now()
+    
+    traders = ['trader{}'.format(i) for i in range(4)]
+    tokens = [Trader(trader, store=s).save() for trader in traders]
+    tea_init_qty = s['shares_trading']['TEA']
+    
+    sequencer = Sequencer(p, max_pending=8, batch_size=4).start()
+    futures = []
+    
+    def submit(trader, token):
+        for i in range(100):
+            futures.append(sequencer.submit(trader, token, 'TEA', 1, 10.0, 
+                                            timestamp=now - timedelta(milliseconds=i)))
+            
+    threads = [threading.Thread(target=submit, args=args) for args in zip(traders, tokens)]
+    
+    for thread in threads:
+        thread.start()
+        
+    for thread in threads:
+        thread.join()
+        
+    assert all(future.result(timeout=5) for future in futures)
+    assert s['shares_trading']['TEA'] == tea_init_qty - 400
+    assert sequencer.metrics()['max_depth'] <= 8
+    
+    sequencer.stop()
@@ -0,0 +1,144 @@
+import pytest
+from datetime import datetime
+from datetime import timedelta
+
+from sssm.backend import Store, Trader, Platform, ShardedPlatform
+from sssm.backend.sharding import shard_of
+
+def test_shard_of():
+    assert shard_of('TEA', 4) == shard_of(u'TEA', 4)
+    assert set(shard_of('SYM{}'.format(i), 4) for i in range(100)) == set(range(4))
+    assert shard_of(None, 4) == 0
+    
+def test_sharded_platform():
+    now = datetime.now()
+    s = Store()
+    p = Platform(s)
+    
+    with ShardedPlatform(shards=3) as sp:
+        assert sp.stock_symbols() == p.stock_symbols()
+        
+        for platform in (p, sp):
+            token = platform.create_user('trader1', token='token1')
+            platform.create_user('trader2', token='token2')
+            platform.add_stock('NEW', last_dividend=7, shares_trading=1000)
+            
+            platform.trade('trader1', token, 'TEA', 100, 10.0, timestamp=now - timedelta(minutes=1))
+            
+            with pytest.raises(ValueError):
+                platform.trade('trader1', 'invalid', 'TEA', 100, 10.0)
+            
+            with pytest.raises(ValueError):
+                platform.trade('trader1', token, 'XYZ', 100, 10.0)
+                
+        batch = (['trader1', 'trader1', 'trader2', 'trader2', 'trader3', 'trader1', 'trader1'],
+                 ['token1', 'token1', 'token2', 'token2', 'token2', 'token1', 'token1'],
+                 ['TEA', 'NEW', 'GIN', 'POP', 'GIN', 'XYZ', 'TEA'],
+                 [40, 10, 50, 10, 10, 10, 61], [11.0, 20.0, 20.0, 5.0, 20.0, 20.0, 12.0])
+        kwargs = dict(trade_types=['SELL', 'BUY', 'BUY', 'BUY', 'BUY', 'BUY', 'SELL'],
+                      timestamps=[now - timedelta(seconds=i) for i in range(7)])
+        
+        statuses, txn_ids = p.trade_many(*batch, **kwargs)
+        sharded_statuses, sharded_txn_ids = sp.trade_many(*batch, **kwargs)
+        
+        assert sharded_statuses == statuses
+        assert [txn_id is None for txn_id in sharded_txn_ids] == \
+               [txn_id is None for txn_id in txn_ids]
+        
+        # ids generated by distinct nodes - unique across shards
+        sharded_txn_ids = [txn_id for txn_id in sharded_txn_ids if txn_id is not None]
+        assert len(set(sharded_txn_ids)) == len(sharded_txn_ids)
+        assert sp.version > 0
+        
+        # cross stock results combined from shards
+        assert sp.all_share_index() == pytest.approx(p.all_share_index())
+        
+        for since in (15, 5):
+            assert sp.volume_weighted_stock_price(since=since, time_ref=now) == \
+                   pytest.approx(p.volume_weighted_stock_price(since=since, time_ref=now))
+            assert sp.volume_weighted_stock_price(since=since, time_ref=now, symbol='GIN') == \
+                   p.volume_weighted_stock_price(since=since, time_ref=now, symbol='GIN')
+            assert sp.volume_weighted_stock_prices(since=since, time_ref=now) == \
+                   p.volume_weighted_stock_prices(since=since, time_ref=now)
+            
+        assert sp.volume_weighted_stock_prices(time_ref=now, symbols=['TEA', 'XYZ']) == \
+               p.volume_weighted_stock_prices(time_ref=now, symbols=['TEA', 'XYZ'])
+        
+        assert sp.stock_prices() == p.stock_prices()
+        
+        for limit, kwargs in ((7, {}), (3, {'symbol': 'GIN'}), (1000, {'trader': 'trader1'})):
+            pages, cursor = [], None
+            
+            while True:
+                records, cursor = sp.transactions(cursor=cursor, limit=limit, **kwargs)
+                pages.extend(records)
+                
+                if cursor is None:
+                    break
+                
+            # ids differ - generated per shard
+            expected = p.transactions(limit=1000, **kwargs)[0]
+            
+            assert [dict(record, id=None) for record in pages] == \
+                   [dict(record, id=None) for record in expected]
+            assert len(expected) > 0
+        assert sp.stock_prices(symbols=['TEA', 'XYZ']) == p.stock_prices(symbols=['TEA', 'XYZ'])
+        
+        with pytest.raises(ValueError):
+            sp.volume_weighted_stock_price(symbol='XYZ')
+            
+        # per stock queries routed
+        assert sp.pe_ratio('GIN', 14.0) == p.pe_ratio('GIN', 14.0)
+        assert sp.compute_dividend_yield('NEW', 14.0) == p.compute_dividend_yield('NEW', 14.0)
+        assert sp.is_trading('TEA') and not sp.is_trading('XYZ')
+        
+        with pytest.raises(ValueError):
+            sp.pe_ratio('XYZ', 14.0)
+            
+        with pytest.raises(ValueError):
+            sp.create_user('trader1')
+            
+def test_sharded_simulate():
+    with ShardedPlatform(shards=2) as sp:
+        recorded = sp.simulate(traders=10, trades=2000, symbols=20, seed=42)
+        
+        p = Platform(Store())
+        
+        assert p.simulate(traders=10, trades=2000, symbols=20, seed=42) == recorded
+        assert sp.all_share_index() == pytest.approx(p.all_share_index())
+        
+def test_sharded_platform_overrides():
+    # stores live in shard workers - no inherited method reads the (missing) store
+    assert [name for name in vars(Platform) if not name.startswith('_') and \
+            name not in vars(ShardedPlatform)] == []
+    
+    now = datetime.now().replace(second=0, microsecond=0)
+    
+    with ShardedPlatform(shards=2) as sp:
+        token = sp.create_user('trader1')
+        sp.trade('trader1', token, 'TEA', 100, 10.0, timestamp=now - timedelta(seconds=30))
+        
+        assert sp.bar_volume_weighted_stock_price(now - timedelta(minutes=1), now, 'TEA') == 10.0
+        
+        with pytest.raises(ValueError):
+            sp.save_snapshot('snapshot')
+            
+        with pytest.raises(ValueError):
+            sp.store
+            
+def test_sharded_trade_many_shard_failure():
+    with ShardedPlatform(shards=2) as sp:
+        token = sp.create_user('trader1')
+        symbols = sp.stock_symbols()
+        ok = symbols[0]
+        failing = [symbol for symbol in symbols if shard_of(symbol, 2) != shard_of(ok, 2)][0]
+        
+        # unhashable trader fails failing stock's shard as a whole
+        statuses, txn_ids = sp.trade_many(['trader1', ['trader1']], [token, token], 
+                                          [ok, failing], [10, 10], [10.0, 10.0])
+        
+        assert statuses[0] == 'OK' and txn_ids[0] is not None
+        assert statuses[1].startswith("[ERROR] Platform: Shard {} failed".format(
+                                      shard_of(failing, 2)))
+        assert txn_ids[1] is None
+        assert [record['id'] for record in sp.transactions()[0]] == [txn_ids[0]]